@@ -1,5 +1,6 @@
-from src.connection.request import request
-from src.connection.response import Response, OkResponse, ErrorResponse
+from src.connection.request import request, request_stream
+from src.connection.response import Response, OkResponse, ErrorResponse, BusyResponse, NotModifiedResponse, StreamResponse
 from src.connection.local import LocalConnection
 from src.connection.public import PublicConnection
 from src.connection.kademlia import KademliaConnection
+from src.connection.metrics import MetricsConnection
@@ -0,0 +1,56 @@
+"""Limits on the requests a connection handles at once and over time."""
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdmissionControl:
+    DEFAULT_MAX_CONCURRENT = 64
+    # Unlimited, nodes run on a single machine share an IP and peers may not say who they are
+    DEFAULT_MAX_PER_PEER = None
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT, max_per_peer=DEFAULT_MAX_PER_PEER, rate=None, burst=None):
+        self.max_concurrent = max_concurrent
+        self.max_per_peer = max_per_peer
+        self.bucket = None if rate is None else TokenBucket(rate, burst if burst is not None else max(1, rate))
+        self.concurrent = 0
+        self.per_peer = {}
+
+    def try_acquire(self, peer):
+        """Whether a request from the peer can be handled now. If so, it must be released when done."""
+        if self.concurrent >= self.max_concurrent:
+            return False
+        if self.max_per_peer is not None and self.per_peer.get(peer, 0) >= self.max_per_peer:
+            return False
+        if self.bucket is not None and not self.bucket.take():
+            return False
+
+        self.concurrent += 1
+        if self.max_per_peer is not None:
+            self.per_peer[peer] = self.per_peer.get(peer, 0) + 1
+        return True
+
+    def release(self, peer):
+        self.concurrent -= 1
+        if self.max_per_peer is None:
+            return
+        if self.per_peer[peer] == 1:
+            del self.per_peer[peer]
+        else:
+            self.per_peer[peer] -= 1
@@ -2,37 +2,135 @@
 import asyncio
 import json
 import logging
+import time
 
-from src.connection.response import ErrorResponse
+from src.connection.deadline import Deadline, deadline
+from src.connection.response import ErrorResponse, StreamResponse
+from src.monitoring.capture import capture
+from src.monitoring.metrics import metrics
+from src.monitoring.tracing import tracer
 
 log = logging.getLogger('timeline')
 
 class BaseConnection:
+    NAME = "base"
+    COMMANDS = ()
+    # Pool to encode responses in, so large ones do not block the loop
+    executor = None
+    # Longest a command may take, including the calls made for it, if the peer does not ask for less
+    BUDGET_S = None
+    # Commands that may take longer than that
+    COMMAND_BUDGET_S = {}
+
     async def handle_command(self, command, message):
         """Virtual method to be implemented by subclasses."""
         pass
 
+    def admit(self, message, addr):
+        """Returns a response to send right away instead of handling the command, or None to handle it."""
+        return None
+
+    def release(self, message, addr):
+        """Called once an admitted command has been handled."""
+        pass
+
     async def handle_request(self, reader, writer):
         data = await reader.read()
+        start = time.monotonic()
         message = json.loads(data.decode())
         addr = writer.get_extra_info('peername')
+        metrics.inc("bytes_received_total", len(data), connection=self.NAME)
 
         log.debug("Received from %r: %r", addr, message)
 
-        if "command" in message:
-            response = await self.handle_command(message["command"], message)
-            log.info("Received command %s: %s", message["command"], response.status)
-        else:
-            response = ErrorResponse("No command provided.")
+        admitted = False
+        # Calls made for the command get what is left of its budget
+        limit = self.COMMAND_BUDGET_S.get(str(message.get("command")), self.BUDGET_S)
+        with deadline.budget(Deadline.extract(message, limit)):
+            if "command" in message:
+                # Unknown commands share a label so peers cannot grow the metrics
+                command = message["command"] if message["command"] in self.COMMANDS else "unknown"
+                with metrics.timer("command_duration_seconds", connection=self.NAME, command=command), \
+                        tracer.trace(f"{self.NAME}:{command}", message.get("trace"), peer=str(addr)) as span:
+                    response = self.admit(message, addr)
+                    admitted = response is None
+                    if admitted:
+                        try:
+                            response = await self.handle_command(message["command"], message)
+                        except asyncio.TimeoutError:
+                            response = ErrorResponse("Deadline exceeded.")
+                        finally:
+                            # A streamed response keeps its slot until it is sent
+                            if not isinstance(response, StreamResponse):
+                                self.release(message, addr)
+                    if isinstance(response, StreamResponse):
+                        # Records are produced while they are sent, so the command lasts until the stream ends
+                        try:
+                            sent, status = await self.stream(writer, response.records, addr)
+                        finally:
+                            if admitted:
+                                self.release(message, addr)
+                    else:
+                        status = response.status
+                    span.set("status", status)
+                metrics.inc("commands_total", connection=self.NAME, command=command, status=status)
+                log.info("Received command %s: %s (trace %s)", message["command"], status, span.trace_id)
+            else:
+                response = ErrorResponse("No command provided.")
+                status = response.status
+
+            received = len(data)
+            if not isinstance(response, StreamResponse):
+                response = response.to_dict()
+                if self.executor is None:
+                    data = json.dumps(response).encode()
+                else:
+                    data = await asyncio.get_running_loop().run_in_executor(self.executor, BaseConnection.encode, response)
+                metrics.inc("bytes_sent_total", len(data), connection=self.NAME)
+                writer.write(data)
+                log.debug("Responded to %r: %r", addr, response)
+                await writer.drain()
+                writer.close()
+                sent = len(data)
 
-        response = response.to_dict()
-        writer.write(json.dumps(response).encode())
-        log.debug("Responded to %r: %r", addr, response)
+            if capture.is_running():
+                capture.record(self.NAME, message, received, sent, time.monotonic() - start, status)
+
+    async def stream(self, writer, records, addr):
+        """Writes each record as a line of JSON as soon as it is produced, then a last line with the status.
+
+        Returns the bytes sent and the status.
+        """
+        end = {"status": "ok"}
+        sent = 0
+        try:
+            async for record in records:
+                data = (json.dumps(record) + "\n").encode()
+                metrics.inc("bytes_sent_total", len(data), connection=self.NAME)
+                writer.write(data)
+                sent += len(data)
+                await writer.drain()
+        except ConnectionError as e:
+            log.debug("Stopped streaming to %r: %s", addr, e)
+            writer.close()
+            return sent, "error"
+        except Exception as e:
+            log.error("Could not stream response to %r: %s", addr, e)
+            end = ErrorResponse("Could not stream response.").to_dict()
+
+        data = (json.dumps(end) + "\n").encode()
+        writer.write(data)
         await writer.drain()
         writer.close()
+        return sent + len(data), end["status"]
+
+    @staticmethod
+    def encode(response):
+        return json.dumps(response).encode()
 
-    async def start(self, ip, port, debug_log=None):
-        server = await asyncio.start_server(self.handle_request, ip, port)
+    async def start(self, ip, port, debug_log=None, reuse_port=False):
+        # With reuse_port, other processes can listen on the same port
+        server = await asyncio.start_server(self.handle_request, ip, port, reuse_port=reuse_port)
 
         if debug_log is not None:
             debug_log()
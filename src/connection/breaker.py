@@ -0,0 +1,79 @@
+"""Circuit breakers that stop contacting peers that keep failing to answer.
+
+A peer that could not be reached is not tried again for a few seconds. After
+several failures in a row its circuit opens and it is not tried for a while,
+doubling each time it opens again. Once that time is over, a single request
+probes it: if it answers the circuit closes, otherwise it opens again.
+"""
+import time
+
+from src.monitoring.metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    FAILURE_THRESHOLD = 3
+    # Seconds a peer is not tried after any failure, even with the circuit closed
+    UNREACHABLE_S = 2
+    BASE_OPEN_S = 5
+    MAX_OPEN_S = 300
+    # Longest a probe may take before another request may probe instead
+    PROBE_TIMEOUT_S = 15
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.unreachable_until = 0
+        # When an open circuit may be probed, or when a probe is given up on
+        self.retry_at = 0
+
+    def allow(self, now):
+        if now < self.unreachable_until:
+            return False
+        if self.state == CLOSED:
+            return True
+        if now < self.retry_at:
+            return False
+
+        # The caller probes the peer, everyone else waits for the outcome
+        self.state = HALF_OPEN
+        self.retry_at = now + CircuitBreaker.PROBE_TIMEOUT_S
+        metrics.inc("peer_circuit_total", event="probed")
+        return True
+
+    def fail(self, now):
+        self.failures += 1
+        self.unreachable_until = now + CircuitBreaker.UNREACHABLE_S
+        if self.state == HALF_OPEN or self.failures >= CircuitBreaker.FAILURE_THRESHOLD:
+            self.opens += 1
+            self.state = OPEN
+            self.retry_at = now + min(
+                CircuitBreaker.BASE_OPEN_S * 2 ** (self.opens - 1), CircuitBreaker.MAX_OPEN_S
+            )
+            metrics.inc("peer_circuit_total", event="opened")
+
+
+class CircuitBreakers:
+    def __init__(self):
+        # peer -> its breaker, only for peers that failed since they last answered
+        self.breakers = {}
+
+    def allow(self, peer):
+        """Whether the peer should be contacted now. If so, the outcome must be reported."""
+        breaker = self.breakers.get(str(peer))
+        if breaker is None or breaker.allow(time.monotonic()):
+            return True
+        metrics.inc("peer_circuit_total", event="skipped")
+        return False
+
+    def succeeded(self, peer):
+        breaker = self.breakers.pop(str(peer), None)
+        if breaker is not None and breaker.state != CLOSED:
+            metrics.inc("peer_circuit_total", event="closed")
+
+    def failed(self, peer):
+        self.breakers.setdefault(str(peer), CircuitBreaker()).fail(time.monotonic())
@@ -0,0 +1,80 @@
+"""Deadlines of the commands a node handles, inherited by the calls made for them and propagated to peers."""
+import asyncio
+import contextvars
+import time
+from contextlib import contextmanager
+
+from src.monitoring.metrics import metrics
+
+# When the current command must be done by, in time.monotonic(), or None if it has no limit
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+class Deadline:
+    @contextmanager
+    def budget(self, seconds, detached=False):
+        """Runs the block with the given seconds, or less if the current deadline is sooner.
+
+        A detached budget does not inherit the current deadline, for work that
+        outlives the command that started it.
+        """
+        deadline = None if seconds is None else time.monotonic() + seconds
+        current = None if detached else current_deadline.get()
+        if current is not None and (deadline is None or current < deadline):
+            deadline = current
+
+        token = current_deadline.set(deadline)
+        try:
+            yield
+        finally:
+            current_deadline.reset(token)
+
+    def remaining(self, timeout=None):
+        """Seconds left until the current deadline, at most timeout. None if there is no limit."""
+        deadline = current_deadline.get()
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.monotonic()
+        return remaining if timeout is None else min(remaining, timeout)
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    async def bounded(self, site, awaitable, timeout=None):
+        """Awaits within the remaining time, cancelling it when it runs out. Timeouts are counted by site."""
+        remaining = self.remaining(timeout)
+        if remaining is None:
+            return await awaitable
+
+        if remaining <= 0:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            metrics.inc("timeouts_total", site=site)
+            raise asyncio.TimeoutError()
+
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError:
+            metrics.inc("timeouts_total", site=site)
+            raise
+
+    def inject(self, data):
+        """Adds the remaining time to a request, so the peer does not work for longer than it is awaited."""
+        remaining = self.remaining()
+        if remaining is None:
+            return data
+        return {**data, "budget": max(remaining, 0)}
+
+    @staticmethod
+    def extract(message, limit=None):
+        """The budget a request came with, at most limit. None if it has no limit."""
+        budget = message.get("budget")
+        if isinstance(budget, bool) or not isinstance(budget, (int, float)) or budget < 0:
+            budget = None
+        if limit is None:
+            return budget
+        return limit if budget is None else min(budget, limit)
+
+
+deadline = Deadline()
@@ -0,0 +1,39 @@
+"""A server that listens locally for commands to any of the users hosted by the process."""
+import logging
+
+from src.connection.base import BaseConnection
+from src.connection.local import LocalConnection
+from src.connection.response import ErrorResponse
+from src.data.user import User
+
+log = logging.getLogger("timeline")
+
+
+class HostConnection(BaseConnection):
+    NAME = "local"
+    COMMANDS = LocalConnection.COMMANDS
+    BUDGET_S = LocalConnection.BUDGET_S
+    COMMAND_BUDGET_S = LocalConnection.COMMAND_BUDGET_S
+
+    def __init__(self, connections):
+        # userid -> the local connection of that user's node
+        self.connections = connections
+
+    async def handle_command(self, command, message):
+        if "as" not in message:
+            return ErrorResponse("No user provided, this process hosts several.")
+        try:
+            userid = User.from_str(message["as"])
+        except ValueError:
+            return ErrorResponse(f"Invalid userid: {message['as']}")
+
+        connection = self.connections.get(str(userid))
+        if connection is None:
+            return ErrorResponse(f"User not hosted here: {userid}")
+        return await connection.handle_command(command, message)
+
+    async def start(self, port):
+        debug_message = lambda: log.info(
+            "Locally listening for instructions to %s users on port %s", len(self.connections), port
+        )
+        await super().start("127.0.0.1", port, debug_message)
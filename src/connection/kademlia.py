@@ -3,9 +3,14 @@ import asyncio
 import random
 import logging
 import json
+import time
 from kademlia.network import Server
+from kademlia.storage import ForgetfulStorage
 
+from src.connection.deadline import deadline
 from src.data.user import User
+from src.monitoring.metrics import metrics
+from src.monitoring.tracing import tracer
 from src.validator import IpPortValidator
 
 log = logging.getLogger("timeline")
@@ -16,23 +21,54 @@ class KademliaConnection:
     BACKOFF_MIN_RANDOM_WAIT_S = 0.2
     BACKOFF_MAX_RANDOM_WAIT_S = 1.0
     MAX_BACKOFF_S = 15
+    # How long a looked up value is reused, by the suffix of its key
+    CACHE_TTL_S = {"subscribers": 30, "subscribed": 120}
+    DEFAULT_CACHE_TTL_S = 30
+    # How long expired values are still kept, for callers that accept outdated ones
+    STALE_CACHE_S = 600
+    MAX_CONCURRENT_LOOKUPS = 8
+    # Longest a lookup or a put may take, even if whoever asked for it has more time
+    LOOKUP_TIMEOUT_S = 10
+    PUT_TIMEOUT_S = 10
+    # Values stored in the DHT expire after this long, unless stored again
+    KEY_TTL_S = 604800
+    # Fraction of its time to live after which a key this node depends on is stored again
+    REPUBLISH_AFTER = 0.8
+    MAX_CONCURRENT_REPUBLISHES = 4
 
     def __init__(self, userid):
         self.connection = None
         self.userid = userid
 
+        # key -> (expiry, raw value), the raw value is decoded on every hit so callers can modify it
+        self.cache = {}
+        # key -> (lookup being made, when it started), shared by everyone who asks for the same key meanwhile
+        self.lookups = {}
+        # key -> puts to it not done yet, and when the last one was done, so lookups made before a put are not used
+        self.putting = {}
+        self.written_at = {}
+        self.lookup_limit = asyncio.Semaphore(KademliaConnection.MAX_CONCURRENT_LOOKUPS)
+        # key -> when it was last stored by this process
+        self.stored_at = {}
+        # key -> users of this process that depend on it, so it is republished before it expires
+        self.dependents = {}
+        self.republishing = asyncio.Lock()
+
+    def share(self, userid):
+        """A connection for another user of this process, using the same DHT node, cache and lookups."""
+        shared = KademliaConnection.__new__(KademliaConnection)
+        shared.__dict__.update(self.__dict__)
+        shared.userid = userid
+        return shared
+
     async def subscribe(self, userid, subscriptions):
         # This node owns this key. It can just set the value without worries.
         await self.put(f"{self.userid}-subscribed", subscriptions)
 
         # This key is shared, so the logic is more complicated
         await self.set_subscription(f"{userid}-subscribers", self.userid, True)
-    
-    async def republish(self, userid):
-        key = f"{userid}-subscribers"
-        response = await self.get(key)
-        if response is not None:
-            await self.put(key, response)
+        self.depend(f"{self.userid}-subscribed")
+        self.depend(f"{userid}-subscribers")
 
     async def unsubscribe(self, userid, subscriptions):
         # This node owns this key. It can just set the value without worries.
@@ -40,6 +76,97 @@ class KademliaConnection:
 
         # This key is shared, so the logic is more complicated
         await self.set_subscription(f"{userid}-subscribers", self.userid, False)
+        self.forget(f"{userid}-subscribers")
+
+    async def set_subscriptions(self, changes):
+        """Subscribes to (True) or unsubscribes from (False) several users concurrently, updating each of their keys once.
+
+        Returns the users whose keys could not be updated. The key with this node's subscriptions is published apart.
+        """
+        userids = list(changes)
+        results = await asyncio.gather(
+            *(self.set_subscription(f"{userid}-subscribers", self.userid, changes[userid]) for userid in userids),
+            return_exceptions=True,
+        )
+        failed = []
+        for userid, result in zip(userids, results):
+            if isinstance(result, Exception):
+                failed.append(userid)
+            elif changes[userid]:
+                self.depend(f"{userid}-subscribers")
+            else:
+                self.forget(f"{userid}-subscribers")
+        return failed
+
+    async def publish_subscribed(self, subscriptions):
+        await self.put(f"{self.userid}-subscribed", subscriptions)
+        self.depend(f"{self.userid}-subscribed")
+
+    def depend(self, key):
+        self.dependents.setdefault(key, set()).add(str(self.userid))
+
+    def forget(self, key):
+        dependents = self.dependents.get(key, set())
+        dependents.discard(str(self.userid))
+        if not dependents:
+            self.dependents.pop(key, None)
+
+    def track_subscriptions(self, subscriptions):
+        """Keeps the keys of the given subscriptions of this user, and the key with them, from expiring."""
+        if subscriptions:
+            self.depend(f"{self.userid}-subscribed")
+        for userid in subscriptions:
+            self.depend(f"{userid}-subscribers")
+
+    async def republish(self, key):
+        # Stored as it is now, since others may have changed it
+        response = await self.get(key, cached=False)
+        if response is None:
+            metrics.inc("dht_republish_total", result="missing")
+            return
+        stored = await self.put(key, response)
+        metrics.inc("dht_republish_total", result="republished" if stored else "failed")
+
+    def prune_cache(self):
+        """Drops the values that expired a while ago, such as those of chunks read once."""
+        oldest = time.monotonic() - KademliaConnection.STALE_CACHE_S
+        for key in [key for key, (expiry, _) in self.cache.items() if expiry < oldest]:
+            del self.cache[key]
+        # No lookup takes that long, so none started before these puts
+        for key in [key for key, written_at in self.written_at.items() if written_at < oldest]:
+            del self.written_at[key]
+
+    async def republish_due(self):
+        """Stores again the keys depended on that are close to expiring, a few at a time.
+
+        Keys not stored since this process started are republished once, as when they were stored is unknown.
+        """
+        # Once per caching period too
+        self.prune_cache()
+        if self.republishing.locked():
+            return
+
+        async with self.republishing:
+            now = time.monotonic()
+            horizon = KademliaConnection.KEY_TTL_S * KademliaConnection.REPUBLISH_AFTER
+            due = [
+                key for key in self.dependents
+                if key not in self.stored_at or now - self.stored_at[key] >= horizon
+            ]
+            if len(due) < len(self.dependents):
+                metrics.inc("dht_republish_total", len(self.dependents) - len(due), result="not-due")
+
+            limit = asyncio.Semaphore(KademliaConnection.MAX_CONCURRENT_REPUBLISHES)
+
+            async def republish(key):
+                async with limit:
+                    try:
+                        await self.republish(key)
+                    except Exception as e:
+                        metrics.inc("dht_republish_total", result="failed")
+                        log.debug("Could not republish %s: %s", key, e)
+
+            await asyncio.gather(*(republish(key) for key in due))
 
     async def get_subscribers(self, userid):
         response = await self.get(f"{userid}-subscribers")
@@ -55,10 +182,41 @@ class KademliaConnection:
 
         return [User(IpPortValidator().ip_address(s)) for s in response]
 
+    def get_cached_subscribers(self, userid):
+        """The subscribers last looked up for a user, even if outdated, without a new lookup."""
+        entry = self.cache.get(f"{userid}-subscribers")
+        if entry is None or entry[1] is None:
+            return []
+        return [User(IpPortValidator().ip_address(s)) for s in json.loads(entry[1])]
+
+    async def get_subscribed_many(self, userids):
+        """Looks up who each of the given users is subscribed to, concurrently."""
+        responses = await self.get_many([f"{userid}-subscribed" for userid in userids])
+        return {
+            userid: [User(IpPortValidator().ip_address(s)) for s in responses[f"{userid}-subscribed"] or []]
+            for userid in userids
+        }
+
+    async def publish_chunks(self, manifest, chunks):
+        # Chunks go first, so whoever finds the new manifest also finds its chunks
+        await asyncio.gather(*(
+            self.put(f"{self.userid}-chunk-{i}", chunk) for i, chunk in enumerate(chunks)
+        ))
+        await self.put(f"{self.userid}-chunks", manifest)
+
+    async def get_chunk_manifest(self, userid):
+        return await self.get(f"{userid}-chunks")
+
+    async def get_chunks(self, userid, count, cached=True):
+        """Looks up the first count chunks of a timeline concurrently. Missing chunks are None."""
+        keys = [f"{userid}-chunk-{i}" for i in range(count)]
+        responses = await self.get_many(keys, cached)
+        return [responses[key] for key in keys]
+
     async def set_subscription(self, key, target, subscribed):
         # Exponential backoff and multiple tries to minimize concurrency issues
         subscription = str(target)
-        response = await self.get(key)
+        response = await self.get(key, cached=False)
         if response is None:
             response = []
 
@@ -97,7 +255,7 @@ class KademliaConnection:
             await asyncio.sleep(backoff)
 
             # Check if the value has changed in the meantime
-            updated_response = await self.get(key)
+            updated_response = await self.get(key, cached=False)
             log.debug(
                 f"(un)sub iter: {n} ; UPDATED ; key: {key} ; value: {updated_response}"
             )
@@ -119,17 +277,87 @@ class KademliaConnection:
                     log.debug("Concurrency issue detected, trying again")
                     response = updated_response
 
-    async def get(self, key):
-        response = await self.connection.get(key)
-        if response is None:
-            return None
-        return json.loads(response)
+    @staticmethod
+    def cache_ttl(key):
+        return KademliaConnection.CACHE_TTL_S.get(
+            key.rsplit("-", 1)[-1], KademliaConnection.DEFAULT_CACHE_TTL_S
+        )
+
+    async def get(self, key, cached=True):
+        """Looks up a key, reusing a recent value unless cached is False.
+
+        Without the cache, a lookup being made is only joined if it started after the last put to the key.
+        """
+        if cached:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                metrics.inc("dht_cache_total", result="hit")
+                return None if entry[1] is None else json.loads(entry[1])
+            metrics.inc("dht_cache_total", result="miss")
+
+        lookup = self.lookups.get(key)
+        if lookup is None or (not cached and not self.sees_puts(key, lookup[1])):
+            started = time.monotonic()
+            future = asyncio.ensure_future(self.lookup(key, started))
+            lookup = self.lookups[key] = (future, started)
+            future.add_done_callback(lambda future: self.lookup_done(key, future))
+            # Retrieved here too, as everyone who asked may have given up before it failed
+            future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+        # Shielded so a caller giving up does not cancel the lookup for everyone else
+        response = await deadline.bounded("dht-get", asyncio.shield(lookup[0]))
+        return None if response is None else json.loads(response)
+
+    async def get_many(self, keys, cached=True):
+        """Looks up several keys concurrently, bounded by the shared limit of lookups."""
+        responses = await asyncio.gather(*(self.get(key, cached) for key in keys))
+        return dict(zip(keys, responses))
+
+    def sees_puts(self, key, started):
+        """Whether a lookup that started then sees every put to the key made so far."""
+        return not self.putting.get(key) and self.written_at.get(key, float("-inf")) < started
+
+    def lookup_done(self, key, future):
+        # Unless a newer lookup of the key replaced it
+        if key in self.lookups and self.lookups[key][0] is future:
+            del self.lookups[key]
+
+    async def lookup(self, key, started):
+        # Shared by everyone who asks, so it is not limited by the deadline of the first one
+        with deadline.budget(KademliaConnection.LOOKUP_TIMEOUT_S, detached=True):
+            async with self.lookup_limit:
+                with metrics.timer("dht_duration_seconds", operation="get"), \
+                        tracer.span("dht-get", key=key):
+                    response = await deadline.bounded("dht-lookup", self.connection.get(key))
+
+        metrics.inc("dht_operations_total", operation="get", result="miss" if response is None else "hit")
+        if self.sees_puts(key, started):
+            self.cache[key] = (time.monotonic() + KademliaConnection.cache_ttl(key), response)
+        return response
 
     async def put(self, key, value):
-        await self.connection.set(key, json.dumps(value))
+        self.putting[key] = self.putting.get(key, 0) + 1
+        self.cache.pop(key, None)
+
+        try:
+            with metrics.timer("dht_duration_seconds", operation="put"), \
+                    tracer.span("dht-put", key=key):
+                stored = await deadline.bounded(
+                    "dht-put", self.connection.set(key, json.dumps(value)), timeout=KademliaConnection.PUT_TIMEOUT_S
+                )
+        finally:
+            self.written_at[key] = time.monotonic()
+            if self.putting[key] == 1:
+                del self.putting[key]
+            else:
+                self.putting[key] -= 1
+        metrics.inc("dht_operations_total", operation="put", result="ok" if stored else "failed")
+        if stored:
+            self.stored_at[key] = time.monotonic()
+        return stored
 
     async def start(self, port, bootstrap_nodes):
-        self.connection = Server()
+        self.connection = Server(storage=ForgetfulStorage(KademliaConnection.KEY_TTL_S))
 
         await self.connection.listen(port)
 
@@ -9,6 +9,15 @@ log = logging.getLogger("timeline")
 
 
 class LocalConnection(BaseConnection):
+    NAME = "local"
+    COMMANDS = ("get", "post", "remove", "sub", "unsub", "view", "people-i-may-know", "stats",
+                "profile-start", "profile-stop", "memory-snapshot", "slow-callbacks",
+                "traces", "search", "batch", "archive", "get-post")
+    BATCH_COMMANDS = ("post", "remove", "sub", "unsub")
+    BUDGET_S = 15
+    # A batch may update the subscriptions of many users in the DHT
+    COMMAND_BUDGET_S = {"batch": 120}
+
     def __init__(
         self,
         handle_get,
@@ -17,7 +26,17 @@ class LocalConnection(BaseConnection):
         handle_sub,
         handle_unsub,
         handle_view,
-        handle_people_i_may_know
+        handle_people_i_may_know,
+        handle_stats,
+        handle_profile_start,
+        handle_profile_stop,
+        handle_memory_snapshot,
+        handle_slow_callbacks,
+        handle_traces,
+        handle_search,
+        handle_batch,
+        handle_archive,
+        handle_get_post
     ):
         self.handle_get = handle_get
         self.handle_post = handle_post
@@ -26,6 +45,16 @@ class LocalConnection(BaseConnection):
         self.handle_unsub = handle_unsub
         self.handle_view = handle_view
         self.handle_people_i_may_know = handle_people_i_may_know
+        self.handle_stats = handle_stats
+        self.handle_profile_start = handle_profile_start
+        self.handle_profile_stop = handle_profile_stop
+        self.handle_memory_snapshot = handle_memory_snapshot
+        self.handle_slow_callbacks = handle_slow_callbacks
+        self.handle_traces = handle_traces
+        self.handle_search = handle_search
+        self.handle_batch = handle_batch
+        self.handle_archive = handle_archive
+        self.handle_get_post = handle_get_post
 
     async def handle_command(self, command, message):
         if command == "get":
@@ -37,7 +66,7 @@ class LocalConnection(BaseConnection):
                 userid = User.from_str(message["userid"])
             except ValueError:
                 return ErrorResponse(f"Invalid userid: {message['userid']}")
-            return await self.handle_get(userid, message["max-posts"])
+            return await self.handle_get(userid, message["max-posts"], message.get("stream", False))
         elif command == "post":
             if "content" not in message:
                 return ErrorResponse("No content provided.")
@@ -65,14 +94,107 @@ class LocalConnection(BaseConnection):
         elif command == "view":
             if "max-posts" not in message:
                 message["max-posts"] = None
-            return await self.handle_view(message["max-posts"])
+            return await self.handle_view(message["max-posts"], message.get("stream", False))
         elif command == "people-i-may-know":
             if "max-people" not in message:
                 message["max-people"] = None
             return await self.handle_people_i_may_know(message["max-people"])
+        elif command == "stats":
+            if "format" not in message:
+                message["format"] = "json"
+            if message["format"] not in ("json", "prometheus"):
+                return ErrorResponse(f"Invalid format: {message['format']}")
+            return await self.handle_stats(message["format"])
+        elif command == "profile-start":
+            if "mode" not in message:
+                message["mode"] = "cprofile"
+            if message["mode"] not in ("cprofile", "sampling"):
+                return ErrorResponse(f"Invalid mode: {message['mode']}")
+            return await self.handle_profile_start(message["mode"])
+        elif command == "profile-stop":
+            return await self.handle_profile_stop()
+        elif command == "memory-snapshot":
+            if "stop" not in message:
+                message["stop"] = False
+            return await self.handle_memory_snapshot(message["stop"])
+        elif command == "slow-callbacks":
+            if "threshold" not in message:
+                message["threshold"] = None
+            if message["threshold"] is not None and (
+                not isinstance(message["threshold"], (int, float)) or message["threshold"] <= 0
+            ):
+                return ErrorResponse(f"Invalid threshold: {message['threshold']}")
+            if "stop" not in message:
+                message["stop"] = False
+            return await self.handle_slow_callbacks(message["threshold"], message["stop"])
+        elif command == "traces":
+            if "trace-id" not in message:
+                message["trace-id"] = None
+            if "clear" not in message:
+                message["clear"] = False
+            return await self.handle_traces(message["trace-id"], message["clear"])
+        elif command == "search":
+            if "query" not in message:
+                return ErrorResponse("No query provided.")
+            if "max-results" not in message:
+                message["max-results"] = None
+            if message["max-results"] is not None and (not isinstance(message["max-results"], int) or message["max-results"] < 1):
+                return ErrorResponse(f"Invalid max-results: {message['max-results']}")
+            if "page" not in message:
+                message["page"] = 1
+            if not isinstance(message["page"], int) or message["page"] < 1:
+                return ErrorResponse(f"Invalid page: {message['page']}")
+            return await self.handle_search(message["query"], message["max-results"], message["page"])
+        elif command == "batch":
+            if "operations" not in message:
+                return ErrorResponse("No operations provided.")
+            if not isinstance(message["operations"], list):
+                return ErrorResponse(f"Invalid operations: {message['operations']}")
+            return await self.handle_batch([LocalConnection.parse_operation(o) for o in message["operations"]])
+        elif command == "archive":
+            if "page" not in message:
+                message["page"] = 1
+            if not isinstance(message["page"], int) or message["page"] < 1:
+                return ErrorResponse(f"Invalid page: {message['page']}")
+            return await self.handle_archive(message["page"])
+        elif command == "get-post":
+            if "userid" not in message:
+                return ErrorResponse("No userid provided.")
+            if "post-id" not in message:
+                return ErrorResponse("No post-id provided.")
+            try:
+                userid = User.from_str(message["userid"])
+            except ValueError:
+                return ErrorResponse(f"Invalid userid: {message['userid']}")
+            if isinstance(message["post-id"], bool) or not isinstance(message["post-id"], int):
+                return ErrorResponse(f"Invalid post-id: {message['post-id']}")
+            return await self.handle_get_post(userid, message["post-id"])
         else:
             return ErrorResponse("Unknown command.")
 
+    @staticmethod
+    def parse_operation(operation):
+        """The command and argument of an operation of a batch, or an ErrorResponse if it is invalid."""
+        if not isinstance(operation, dict) or operation.get("command") not in LocalConnection.BATCH_COMMANDS:
+            return ErrorResponse("Unknown command.")
+        command = operation["command"]
+
+        if command == "post":
+            if "content" not in operation:
+                return ErrorResponse("No content provided.")
+            return command, operation["content"]
+        if command == "remove":
+            if "post-id" not in operation:
+                return ErrorResponse("No post-id provided.")
+            return command, operation["post-id"]
+
+        if "userid" not in operation:
+            return ErrorResponse("No userid provided.")
+        try:
+            return command, User.from_str(operation["userid"])
+        except ValueError:
+            return ErrorResponse(f"Invalid userid: {operation['userid']}")
+
     async def start(self, port):
         debug_message = lambda: log.info(
             "Locally listening for instructions on port %s", port
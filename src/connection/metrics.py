@@ -0,0 +1,33 @@
+"""A minimal HTTP server that exposes the node's metrics in the Prometheus text format."""
+import asyncio
+import logging
+
+from src.monitoring.metrics import metrics
+
+log = logging.getLogger("timeline")
+
+
+class MetricsConnection:
+    async def handle_request(self, reader, writer):
+        # Only the request line matters, every path gets the metrics
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+        body = metrics.to_prometheus().encode()
+        writer.write(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+        writer.close()
+
+    async def start(self, port):
+        server = await asyncio.start_server(self.handle_request, "127.0.0.1", port)
+        log.info("Serving metrics locally on port %s", port)
+
+        async with server:
+            await server.serve_forever()
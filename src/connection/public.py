@@ -2,15 +2,49 @@
 import logging
 
 from src.connection.base import BaseConnection
-from src.connection.response import ErrorResponse
+from src.connection.response import BusyResponse, ErrorResponse
+from src.monitoring.metrics import metrics
 from src.data.user import User
 
 log = logging.getLogger("timeline")
 
 
 class PublicConnection(BaseConnection):
-    def __init__(self, handle_get_timeline):
+    NAME = "public"
+    COMMANDS = ("get-timeline", "get-post")
+
+    def __init__(self, handle_get_timeline, get_replicas, handle_get_post):
         self.handle_get_timeline = handle_get_timeline
+        self.get_replicas = get_replicas
+        self.handle_get_post = handle_get_post
+        self.admission = None
+
+    @staticmethod
+    def get_peer(message, addr):
+        """Who the request counts against: the node it says it is from, if it sends from that node's IP, or else its IP.
+
+        Nodes that share an IP can still claim each other's ports.
+        """
+        try:
+            peer = User.from_str(message["from"])
+        except (KeyError, TypeError, ValueError):
+            return addr[0]
+        return str(peer) if peer.ip == addr[0] else addr[0]
+
+    def admit(self, message, addr):
+        if self.admission is None or self.admission.try_acquire(PublicConnection.get_peer(message, addr)):
+            return None
+
+        metrics.inc("requests_shed_total", connection=self.NAME)
+        try:
+            userid = User.from_str(message["userid"])
+        except (KeyError, ValueError):
+            return BusyResponse([])
+        return BusyResponse([str(r) for r in self.get_replicas(userid, message.get("from"))])
+
+    def release(self, message, addr):
+        if self.admission is not None:
+            self.admission.release(PublicConnection.get_peer(message, addr))
 
     async def handle_command(self, command, message):
         if command == "get-timeline":
@@ -22,10 +56,37 @@ class PublicConnection(BaseConnection):
                 userid = User.from_str(message["userid"])
             except ValueError:
                 return ErrorResponse(f"Invalid userid: {message['userid']}")
-            return await self.handle_get_timeline(userid, message["max-posts"])
+            # Who is asking, if they said so, to suggest them as a replica later
+            requester = message.get("from")
+            if requester is not None:
+                try:
+                    requester = str(User.from_str(requester))
+                except ValueError:
+                    requester = None
+            # Hashes of the posts the requester already has, to send only theirs
+            known_posts = message.get("known-posts")
+            if not isinstance(known_posts, list):
+                known_posts = []
+            # Version of the timeline the requester has, to only send it again if it changed
+            condition = (message.get("if-revision"), message.get("if-digest"))
+            if isinstance(condition[0], bool) or not isinstance(condition[0], int) or not isinstance(condition[1], str):
+                condition = None
+            return await self.handle_get_timeline(userid, message["max-posts"], requester, known_posts, condition)
+        elif command == "get-post":
+            if "userid" not in message:
+                return ErrorResponse("No userid provided.")
+            if "post-id" not in message:
+                return ErrorResponse("No post-id provided.")
+            try:
+                userid = User.from_str(message["userid"])
+            except ValueError:
+                return ErrorResponse(f"Invalid userid: {message['userid']}")
+            if isinstance(message["post-id"], bool) or not isinstance(message["post-id"], int):
+                return ErrorResponse(f"Invalid post-id: {message['post-id']}")
+            return await self.handle_get_post(userid, message["post-id"])
         else:
             return ErrorResponse("Unknown command.")
 
-    async def start(self, userid):
+    async def start(self, userid, reuse_port=False):
         debug_message = lambda: log.debug("Listening for other nodes on %s", userid)
-        await super().start(userid.ip, userid.port, debug_message)
+        await super().start(userid.ip, userid.port, debug_message, reuse_port)
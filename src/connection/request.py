@@ -3,20 +3,75 @@ import asyncio
 import json
 import logging
 
+from src.connection.deadline import deadline
+from src.monitoring.metrics import metrics
+from src.monitoring.tracing import tracer
+
 log = logging.getLogger('timeline')
 
-async def request(data, ip, port):
-    reader, writer = await asyncio.open_connection(ip, port)
+# Longest line of a streamed response, a single post may be large
+STREAM_LINE_LIMIT = 2 ** 24
+CONNECT_TIMEOUT_S = 5
+
+async def request(data, ip, port, site=None):
+    """Sends a request within the remaining time of the current deadline. Timeouts are counted by site."""
+    command = data.get("command", "unknown")
+    site = command if site is None else site
+    with metrics.timer("request_duration_seconds", command=command), \
+            tracer.span("request", command=command, peer=f"{ip}:{port}"):
+        writer = None
+        try:
+            # Connecting is bounded even without a deadline, so a peer that is gone is noticed quickly
+            reader, writer = await deadline.bounded(
+                site, asyncio.open_connection(ip, port), timeout=CONNECT_TIMEOUT_S
+            )
+
+            log.debug("Sending message: %s", data)
+            data = json.dumps(deadline.inject(tracer.inject(data))).encode()
+            metrics.inc("bytes_sent_total", len(data), connection="outgoing")
+            writer.write(data)
+            writer.write_eof()
+            await deadline.bounded(site, writer.drain())
 
-    log.debug("Sending message: %s", data)
-    writer.write(json.dumps(data).encode())
-    writer.write_eof()
-    await writer.drain()
-    
-    data = await reader.read()
-    response = json.loads(data.decode())
-    log.debug("Received message: %s from %s:%s", response, ip, port)
-    writer.close()
-    await writer.wait_closed()
+            data = await deadline.bounded(site, reader.read())
+            metrics.inc("bytes_received_total", len(data), connection="outgoing")
+            response = json.loads(data.decode())
+            log.debug("Received message: %s from %s:%s", response, ip, port)
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            metrics.inc("request_errors_total", command=command)
+            if writer is not None:
+                writer.close()
+            raise
 
     return response
+
+
+async def request_stream(data, ip, port):
+    """Like request, but yields the records of a streamed response as they arrive. The last one has the status."""
+    command = data.get("command", "unknown")
+    reader, writer = await asyncio.open_connection(ip, port, limit=STREAM_LINE_LIMIT)
+    try:
+        log.debug("Sending message: %s", data)
+        data = json.dumps(tracer.inject(data)).encode()
+        metrics.inc("bytes_sent_total", len(data), connection="outgoing")
+        writer.write(data)
+        writer.write_eof()
+        await writer.drain()
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("Stream ended without a status.")
+            metrics.inc("bytes_received_total", len(line), connection="outgoing")
+            record = json.loads(line.decode())
+            yield record
+            # Also the whole response of a command that was not streamed
+            if "status" in record:
+                break
+    except Exception:
+        metrics.inc("request_errors_total", command=command)
+        raise
+    finally:
+        writer.close()
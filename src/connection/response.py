@@ -20,3 +20,19 @@ class OkResponse(Response):
 class ErrorResponse(Response):
     def __init__(self, message):
         super().__init__("error", {"error": message})
+
+class StreamResponse(Response):
+    """Records sent one per line as they are produced, from an async iterator, followed by the status."""
+    def __init__(self, records):
+        super().__init__("ok")
+        self.records = records
+
+class NotModifiedResponse(Response):
+    """The timeline asked for is the same the requester has, valid until the given time."""
+    def __init__(self, last_updated, valid_until):
+        super().__init__("not-modified", {"last_updated": last_updated, "valid_until": valid_until})
+
+class BusyResponse(Response):
+    """The node cannot handle the request now, the replicas listed may."""
+    def __init__(self, replicas):
+        super().__init__("busy", {"error": "Busy.", "replicas": replicas})
@@ -0,0 +1,94 @@
+"""Archive of the old posts of the own timeline, in immutable segments ordered by time.
+
+The own timeline only keeps its newest posts, so posting and publishing
+do not get slower as the history grows. Older posts are moved, a segment
+at a time, into files that are never written again. Posts removed after
+being archived are only marked as such in the index of the segments.
+"""
+import os
+from datetime import datetime
+
+
+class Archive:
+    ARCHIVE_FOLDER = "archive"
+    ARCHIVE_FILE = "archive.json"
+    SEGMENT_POSTS = 200
+
+    def __init__(self, segments, removed):
+        # Oldest first, each with its file, time range, id range, number of posts and estimated size
+        self.segments = segments
+        # Ids of archived posts that were removed since
+        self.removed = removed
+
+    @staticmethod
+    def get_segment_file(name):
+        return os.path.join(Archive.ARCHIVE_FOLDER, name)
+
+    def add_segment(self, userid, posts, size):
+        """Indexes a segment with the given posts, oldest first. Returns its file name and contents."""
+        first = datetime.fromisoformat(posts[0]["timestamp"])
+        name = f"{first.strftime('%Y%m%dT%H%M%S')}-{posts[0]['id']}.json"
+        self.segments.append({
+            "name": name,
+            "first": posts[0]["timestamp"],
+            "last": posts[-1]["timestamp"],
+            "first-id": posts[0]["id"],
+            "last-id": posts[-1]["id"],
+            "count": len(posts),
+            "bytes": size,
+        })
+        return name, {"userid": str(userid), "posts": posts}
+
+    def find_segment(self, post_id):
+        """The segment a post would be in, since ids only grow. None if it is newer than them all."""
+        for segment in self.segments:
+            if segment["first-id"] <= post_id <= segment["last-id"]:
+                return segment
+        return None
+
+    def find_post(self, storage, post_id):
+        """An archived post that was not removed, or None."""
+        segment = self.find_segment(post_id)
+        if segment is None or post_id in self.removed:
+            return None
+        return Archive.read_post(storage, segment, post_id)
+
+    @staticmethod
+    def read_post(storage, segment, post_id):
+        data = storage.read(Archive.get_segment_file(segment["name"]))
+        for post in data["posts"]:
+            if post["id"] == post_id:
+                return post
+        return None
+
+    def total_posts(self):
+        return sum(segment["count"] for segment in self.segments) - len(self.removed)
+
+    def total_bytes(self):
+        return sum(segment["bytes"] for segment in self.segments)
+
+    def pages(self):
+        return len(self.segments)
+
+    def get_page(self, page):
+        """The segment of a page. Page 1 is the newest segment."""
+        return self.segments[len(self.segments) - page]
+
+    @staticmethod
+    def read_segment(storage, segment, removed):
+        """The posts of a segment that were not removed, newest first."""
+        data = storage.read(Archive.get_segment_file(segment["name"]))
+        return [post for post in reversed(data["posts"]) if post["id"] not in removed]
+
+    @staticmethod
+    def from_serializable(data):
+        return Archive(data["segments"], data["removed"])
+
+    def to_serializable(self):
+        return {"segments": list(self.segments), "removed": list(self.removed)}
+
+    @staticmethod
+    def read(storage):
+        if storage.exists(Archive.ARCHIVE_FILE):
+            return Archive.from_serializable(storage.read(Archive.ARCHIVE_FILE))
+        return Archive([], [])
@@ -0,0 +1,46 @@
+"""Bodies of the posts of other users read by this node, kept so they are only fetched once."""
+from collections import OrderedDict
+
+
+class BodyCache:
+    BODY_CACHE_FILE = "body_cache.json"
+    # Characters of the cached bodies, the least recently read are dropped once over it
+    MAX_CHARS = 16 * 1024 * 1024
+
+    def __init__(self, entries):
+        # file -> length of the body, least recently read first
+        self.entries = OrderedDict(entries)
+
+    def touch(self, file):
+        """Whether the body is cached, marking it as just read if so."""
+        if file not in self.entries:
+            return False
+        self.entries.move_to_end(file)
+        return True
+
+    def add(self, file, length):
+        """Caches a body. Returns the files of the bodies dropped to make room for it."""
+        self.entries[file] = length
+        self.entries.move_to_end(file)
+
+        dropped = []
+        total = sum(self.entries.values())
+        while total > BodyCache.MAX_CHARS and len(self.entries) > 1:
+            dropped_file, dropped_length = self.entries.popitem(last=False)
+            total -= dropped_length
+            dropped.append(dropped_file)
+        return dropped
+
+    @staticmethod
+    def from_serializable(data):
+        return BodyCache(data)
+
+    def to_serializable(self):
+        # Pairs rather than an object, to keep their order
+        return [[file, length] for file, length in self.entries.items()]
+
+    @staticmethod
+    def read(storage):
+        if storage.exists(BodyCache.BODY_CACHE_FILE):
+            return BodyCache.from_serializable(storage.read(BodyCache.BODY_CACHE_FILE))
+        return BodyCache([])
@@ -0,0 +1,77 @@
+"""Keeps the space taken by the timelines of a node under a budget.
+
+Sizes are estimated from the posts, the same for every storage engine. The
+own timeline and its archive are never evicted. When over the budget, the
+cached timelines read least recently are first trimmed to their newest
+posts, and then evicted. Evicted timelines are not cached again until they
+are read.
+"""
+from collections import OrderedDict
+
+
+class DiskBudget:
+    # Estimated bytes a post takes besides its content
+    POST_OVERHEAD_BYTES = 100
+    TRIMMED_POSTS = 5
+
+    def __init__(self, budget):
+        # In bytes, None if unlimited
+        self.budget = budget
+        self.own = 0
+        # userid -> (estimated bytes, number of posts) of each cached timeline, least recently read first
+        self.cached = OrderedDict()
+        self.evicted = set()
+
+    @staticmethod
+    def estimate(posts):
+        return sum(len(post["content"]) + DiskBudget.POST_OVERHEAD_BYTES for post in posts)
+
+    def usage(self):
+        return self.own + sum(size for size, _ in self.cached.values())
+
+    def stored(self, userid, posts):
+        # A timeline stored for the first time goes last, it was just subscribed to or read
+        self.cached[str(userid)] = (DiskBudget.estimate(posts), len(posts))
+
+    def removed(self, userid):
+        self.cached.pop(str(userid), None)
+
+    def read(self, userid):
+        userid = str(userid)
+        self.evicted.discard(userid)
+        if userid in self.cached:
+            self.cached.move_to_end(userid)
+
+    def evict(self, userid):
+        self.removed(userid)
+        self.evicted.add(str(userid))
+
+    def is_evicted(self, userid):
+        return str(userid) in self.evicted
+
+    def plan(self):
+        """The cached timelines to trim and the ones to evict to get under the budget, least recently read first."""
+        if self.budget is None:
+            return [], []
+        over = self.usage() - self.budget
+        if over <= 0:
+            return [], []
+
+        sizes = {userid: size for userid, (size, _) in self.cached.items()}
+        trims = []
+        for userid, (size, posts) in self.cached.items():
+            if over <= 0:
+                break
+            if posts > DiskBudget.TRIMMED_POSTS:
+                sizes[userid] = size * DiskBudget.TRIMMED_POSTS // posts
+                over -= size - sizes[userid]
+                trims.append(userid)
+
+        evictions = []
+        for userid in self.cached:
+            if over <= 0:
+                break
+            over -= sizes[userid]
+            evictions.append(userid)
+
+        return [userid for userid in trims if userid not in evictions], evictions
@@ -0,0 +1,10 @@
+"""The storage engines a node can keep its data in."""
+from src.data.mmap_storage import MmapStorage
+from src.data.sqlite_storage import SqliteStorage
+from src.data.storage import PersistentStorage
+
+STORAGE_ENGINES = {
+    "json": PersistentStorage,
+    "sqlite": SqliteStorage,
+    "mmap": MmapStorage,
+}
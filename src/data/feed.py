@@ -0,0 +1,89 @@
+"""The feed of a node, kept merged as the timelines it is made of change.
+
+The posts of the own and cached timelines are kept in a single list sorted
+by timestamp, so reading the newest posts of the feed does not merge the
+timelines again. Each timeline remembers until when it is valid, so only
+the outdated ones need to be looked up again.
+"""
+import bisect
+from datetime import datetime
+
+from src.data.post_body import PostBody
+
+
+class Feed:
+    def __init__(self):
+        # [(timestamp, userid, post id)], oldest first
+        self.entries = []
+        # (userid, post id) -> post
+        self.posts = {}
+        # userid -> (valid until, or None if it does not expire, ids of its posts)
+        self.timelines = {}
+
+    def has_timeline(self, userid):
+        return str(userid) in self.timelines
+
+    def add_post(self, userid, post):
+        key = (str(userid), post["id"])
+        if key in self.posts:
+            return
+
+        self.posts[key] = post
+        self.timelines.setdefault(key[0], (None, set()))[1].add(post["id"])
+        bisect.insort(self.entries, (post["timestamp"], *key))
+
+    def remove_post(self, userid, post_id):
+        key = (str(userid), post_id)
+        post = self.posts.pop(key, None)
+        if post is None:
+            return
+
+        self.timelines[key[0]][1].discard(post_id)
+        self.entries.pop(bisect.bisect_left(self.entries, (post["timestamp"], *key)))
+
+    def set_timeline(self, userid, posts, valid_until=None):
+        """Makes the posts of a timeline in the feed be the given ones, touching only those that changed."""
+        userid = str(userid)
+        ids = {post["id"] for post in posts}
+        _, current = self.timelines.get(userid, (None, set()))
+        for post_id in current - ids:
+            self.remove_post(userid, post_id)
+        for post in posts:
+            self.add_post(userid, post)
+        self.timelines[userid] = (valid_until, self.timelines.get(userid, (None, set()))[1])
+
+    def set_valid_until(self, userid, valid_until):
+        """Extends the validity of a timeline in the feed, whose posts did not change."""
+        userid = str(userid)
+        if userid in self.timelines:
+            self.timelines[userid] = (valid_until, self.timelines[userid][1])
+
+    def remove_timeline(self, userid):
+        userid = str(userid)
+        if userid not in self.timelines:
+            return
+        for post_id in list(self.timelines[userid][1]):
+            self.remove_post(userid, post_id)
+        del self.timelines[userid]
+
+    def stale(self, userids):
+        """The given timelines that are not in the feed or are no longer valid."""
+        now = datetime.now()
+        stale = []
+        for userid in userids:
+            timeline = self.timelines.get(str(userid))
+            if timeline is None or (timeline[0] is not None and now > timeline[0]):
+                stale.append(userid)
+        return stale
+
+    def read(self, max_posts):
+        """The newest max_posts posts of the feed, or all of them if it is None, newest first."""
+        entries = self.entries if max_posts is None else self.entries[-max_posts:]
+        posts = []
+        for timestamp, userid, post_id in reversed(entries):
+            post = self.posts[(userid, post_id)]
+            posts.append({
+                "id": post_id, "userid": userid, "timestamp": timestamp, "content": post["content"],
+                **PostBody.length_field(post),
+            })
+        return posts
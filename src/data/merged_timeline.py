@@ -2,6 +2,7 @@
 from datetime import datetime
 import copy
 from tabulate import tabulate
+from src.data.post_body import PostBody
 from src.data.user import User
 
 
@@ -27,6 +28,7 @@ class MergedTimeline:
                 "userid": p["userid"],
                 "timestamp": datetime.fromisoformat(p["timestamp"]),
                 "content": p["content"],
+                **PostBody.length_field(p),
             }
             for p in all_posts
         ]
@@ -39,6 +41,7 @@ class MergedTimeline:
                 "userid": p["userid"],
                 "timestamp": p["timestamp"].isoformat(),
                 "content": p["content"],
+                **PostBody.length_field(p),
             }
             for p in posts
         ]
@@ -65,7 +68,7 @@ class MergedTimeline:
             {
                 "userid": p["userid"],
                 "timestamp": datetime.fromisoformat(p["timestamp"]),
-                "content": p["content"],
+                "content": PostBody.listing(p),
             }
             for p in self.posts
         ]
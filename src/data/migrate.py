@@ -0,0 +1,49 @@
+"""Imports the JSON data directories of nodes into the SQLite storage engine."""
+import logging
+import os
+
+from src.data.next_post_id import NextPostId
+from src.data.sqlite_storage import SqliteStorage
+from src.data.storage import PersistentStorage
+from src.data.subscriptions import Subscriptions
+from src.data.timeline import Timeline
+from src.data.user import User
+
+log = logging.getLogger("timeline")
+
+
+def migrate(userid):
+    """Copies every timeline, the subscriptions and the next post id of a node. Returns the number of timelines."""
+    source = PersistentStorage(userid)
+    destination = SqliteStorage(userid)
+
+    timelines = 0
+    if source.exists(Timeline.TIMELINES_FOLDER):
+        for filename in os.listdir(source.get_path(Timeline.TIMELINES_FOLDER)):
+            if not filename.endswith(".json"):
+                continue
+            timeline_userid = User.from_filename(filename[:-len(".json")])
+            Timeline.read(source, timeline_userid).store(destination)
+            timelines += 1
+            log.debug("Migrated timeline of %s", timeline_userid)
+
+    Subscriptions.read(source).store(destination)
+    NextPostId.read(source).store(destination)
+    return timelines
+
+
+def migrate_all():
+    """Migrates every node found in the data directory. Returns the migrated users."""
+    users = []
+    if not os.path.isdir(PersistentStorage.BASE_DIR):
+        return users
+
+    for directory in sorted(os.listdir(PersistentStorage.BASE_DIR)):
+        try:
+            userid = User.from_filename(directory)
+        except ValueError:
+            log.debug("Skipping %s, not a node's data directory", directory)
+            continue
+        migrate(userid)
+        users.append(userid)
+    return users
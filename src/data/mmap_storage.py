@@ -0,0 +1,133 @@
+"""Persistent storage for data of a given node, with timelines that are read lazily through mmap.
+
+A timeline file starts with a one line header and is followed by one line per
+post, newest first. Checking a cache's validity only decodes the header and
+reading the newest posts only touches the lines of those posts.
+"""
+import json
+import mmap
+import os
+from datetime import datetime
+
+from src.data.storage import PersistentStorage
+from src.data.timeline import Timeline
+from src.data.timeline_index import TimelineIndex
+from src.data.user import User
+
+
+class MmapStorage(PersistentStorage):
+    TIMELINE_EXTENSION = ".tl"
+    FORMAT_VERSION = 1
+
+    @staticmethod
+    def get_timeline_file(userid):
+        return os.path.join(Timeline.TIMELINES_FOLDER, f"{userid.to_filename()}{MmapStorage.TIMELINE_EXTENSION}")
+
+    def stored_timelines(self):
+        # Timelines stored by the JSON engine are still readable
+        return super().stored_timelines() + [
+            User.from_filename(filename[:-len(MmapStorage.TIMELINE_EXTENSION)])
+            for filename in os.listdir(self.get_path(Timeline.TIMELINES_FOLDER))
+            if filename.endswith(MmapStorage.TIMELINE_EXTENSION)
+        ]
+
+    def timeline_file_exists(self, userid):
+        return self.exists(MmapStorage.get_timeline_file(userid)) or super().timeline_file_exists(userid)
+
+    @staticmethod
+    def read_lines(mm, start, count):
+        """Decodes count lines starting at the offset start. Returns them and the offset after them."""
+        lines = []
+        for _ in range(count):
+            end = mm.find(b"\n", start)
+            lines.append(json.loads(mm[start:end]))
+            start = end + 1
+        return lines, start
+
+    def scan_timeline(self, userid):
+        if not self.exists(MmapStorage.get_timeline_file(userid)):
+            return super().scan_timeline(userid)
+
+        with open(self.get_path(MmapStorage.get_timeline_file(userid)), "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            (header,), start = MmapStorage.read_lines(mm, 0, 1)
+        entry = TimelineIndex.entry(header, header["count"], start)
+        entry["cached"] = header["cached"]
+        return entry
+
+    def read_timeline(self, userid, max_posts=None):
+        if not self.exists(MmapStorage.get_timeline_file(userid)):
+            return super().read_timeline(userid, max_posts)
+
+        # The index tells where the posts start, so the header is not decoded again
+        header = self.timeline_header(userid)
+        with open(self.get_path(MmapStorage.get_timeline_file(userid)), "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = header["count"] if max_posts is None else min(max_posts, header["count"])
+            posts, _ = MmapStorage.read_lines(mm, header["offset"], count)
+
+        data = {"userid": str(userid), "posts": posts}
+        if not header["cached"]:
+            # The own timeline keeps its posts in the order they were made
+            posts.reverse()
+            return data
+
+        data["total_posts"] = header["total_posts"]
+        data["last_updated"] = header["last_updated"]
+        data["valid_until"] = header["valid_until"]
+        data["revision"] = header.get("revision")
+        data["digest"] = header.get("digest")
+        return data
+
+    def store_timeline(self, userid, data):
+        posts = sorted(
+            data["posts"], key=lambda p: datetime.fromisoformat(p["timestamp"]), reverse=True
+        )
+        header = {
+            "version": MmapStorage.FORMAT_VERSION,
+            "userid": data["userid"],
+            "cached": "valid_until" in data,
+            "count": len(posts),
+            "total_posts": data.get("total_posts"),
+            "last_updated": data.get("last_updated"),
+            "valid_until": data.get("valid_until"),
+            "revision": data.get("revision"),
+            "digest": data.get("digest"),
+        }
+        header = (json.dumps(header) + "\n").encode()
+
+        # Written aside and renamed, so readers never map a half written file
+        path = self.get_path(MmapStorage.get_timeline_file(userid))
+        with open(path + ".tmp", "wb") as f:
+            f.write(header)
+            for post in posts:
+                f.write((json.dumps(post) + "\n").encode())
+        os.replace(path + ".tmp", path)
+
+        super().remove_timeline(userid)
+        return TimelineIndex.entry(data, len(posts), len(header))
+
+    # A single file holds every post, so these read it whole
+
+    def timeline_post_hashes(self, userid):
+        if not self.exists(MmapStorage.get_timeline_file(userid)):
+            return super().timeline_post_hashes(userid)
+        return [Timeline.hash_post(userid, post) for post in self.read_timeline(userid)["posts"]]
+
+    def read_posts(self, userid, hashes):
+        if not self.exists(MmapStorage.get_timeline_file(userid)):
+            return super().read_posts(userid, hashes)
+        return PersistentStorage.posts_by_hash(userid, self.read_timeline(userid)["posts"], hashes)
+
+    def update_timeline_validity(self, userid, last_updated, valid_until):
+        if not self.exists(MmapStorage.get_timeline_file(userid)):
+            return super().update_timeline_validity(userid, last_updated, valid_until)
+        # The header may change length, so the file is written again
+        data = self.read_timeline(userid)
+        data["last_updated"] = last_updated
+        data["valid_until"] = valid_until
+        self.write_timeline(userid, data)
+
+    def remove_timeline(self, userid):
+        self.delete(MmapStorage.get_timeline_file(userid))
+        super().remove_timeline(userid)
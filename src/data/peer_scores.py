@@ -0,0 +1,90 @@
+"""Scores of the peers timelines are fetched from, to prefer the fast, reliable and fresh ones.
+
+Each peer keeps moving averages of its latency, of how often it fails and of
+how old its copies were. Without new observations these decay back to the
+values assumed for an unknown peer.
+"""
+import random as rnd
+import time
+
+
+class PeerScores:
+    PEER_SCORES_FILE = "peer_scores.json"
+    # Weight of a new observation in the moving averages
+    SMOOTHING = 0.3
+    HALF_LIFE_S = 3600
+    # Seconds of latency a failure and a second of staleness are worth
+    ERROR_PENALTY_S = 5.0
+    STALENESS_PENALTY = 0.01
+    # Random factor applied when ranking, so that other peers are tried now and then
+    EXPLORATION = 0.1
+    UNKNOWN_PEER = {"latency": 0.2, "errors": 0.2, "staleness": 60.0}
+    MAX_PEERS = 1000
+
+    def __init__(self, scores):
+        self.scores = scores
+
+    def get(self, peer, now=None):
+        """The averages of a peer, decayed towards those of an unknown peer."""
+        entry = self.scores.get(str(peer))
+        if entry is None:
+            return dict(PeerScores.UNKNOWN_PEER)
+
+        now = time.time() if now is None else now
+        weight = 0.5 ** (max(0.0, now - entry["updated"]) / PeerScores.HALF_LIFE_S)
+        return {
+            key: prior + (entry[key] - prior) * weight
+            for key, prior in PeerScores.UNKNOWN_PEER.items()
+        }
+
+    def observe(self, peer, latency=None, error=False, staleness=None):
+        now = time.time()
+        entry = self.get(peer, now)
+
+        def average(key, value):
+            entry[key] += PeerScores.SMOOTHING * (value - entry[key])
+
+        average("errors", 1.0 if error else 0.0)
+        if latency is not None:
+            average("latency", latency)
+        if staleness is not None:
+            average("staleness", max(0.0, staleness))
+
+        entry["updated"] = now
+        self.scores[str(peer)] = entry
+
+    def score(self, peer):
+        """Expected cost of fetching from the peer, in seconds. Lower is better."""
+        entry = self.get(peer)
+        return (
+            entry["latency"]
+            + entry["errors"] * PeerScores.ERROR_PENALTY_S
+            + entry["staleness"] * PeerScores.STALENESS_PENALTY
+        )
+
+    def rank(self, peers):
+        return sorted(
+            peers,
+            key=lambda p: self.score(p) * rnd.uniform(1 - PeerScores.EXPLORATION, 1 + PeerScores.EXPLORATION),
+        )
+
+    @staticmethod
+    def from_serializable(data):
+        return PeerScores(data)
+
+    def to_serializable(self):
+        # Peers not heard of for the longest are forgotten first
+        peers = sorted(self.scores.items(), key=lambda item: item[1]["updated"], reverse=True)
+        return dict(peers[:PeerScores.MAX_PEERS])
+
+    def store(self, storage):
+        storage.write(self.to_serializable(), PeerScores.PEER_SCORES_FILE)
+
+    @staticmethod
+    def read(storage):
+        if storage.exists(PeerScores.PEER_SCORES_FILE):
+            return PeerScores.from_serializable(
+                storage.read(PeerScores.PEER_SCORES_FILE)
+            )
+        else:
+            return PeerScores({})
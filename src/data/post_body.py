@@ -0,0 +1,62 @@
+"""Full contents of posts, kept apart from the timelines, which only carry a preview of them.
+
+A post longer than its preview also has its full length in the timeline, so
+readers know there is more and can ask for it by the id of the post. Bodies
+are sent in chunks, so a large one is never a single line of a response.
+"""
+import os
+
+
+class PostBody:
+    BODIES_FOLDER = "bodies"
+    PREVIEW_CHARS = 280
+    CHUNK_CHARS = 64 * 1024
+
+    @staticmethod
+    def get_file(userid, post_id):
+        return os.path.join(PostBody.BODIES_FOLDER, f"{userid.to_filename()}-{post_id}.json")
+
+    @staticmethod
+    def preview(content):
+        """The content to keep in the timeline, and the length of the body if it does not fit, else None."""
+        if len(content) <= PostBody.PREVIEW_CHARS:
+            return content, None
+        return content[:PostBody.PREVIEW_CHARS], len(content)
+
+    @staticmethod
+    def is_truncated(post):
+        return post.get("length") is not None
+
+    @staticmethod
+    def length_field(post):
+        """The length of a truncated post, to be kept when its other fields are copied."""
+        return {"length": post["length"]} if PostBody.is_truncated(post) else {}
+
+    @staticmethod
+    def listing(post):
+        """The content of a post as shown in a listing, telling if there is more."""
+        if not PostBody.is_truncated(post):
+            return post["content"]
+        return f"{post['content']}... (post {post['id']} has {post['length']} characters, see them with get-post)"
+
+    @staticmethod
+    def is_body_of(post, content):
+        """Whether content is the full content of the post, as its preview and length tell."""
+        length = post["length"] if PostBody.is_truncated(post) else len(post["content"])
+        return len(content) == length and content.startswith(post["content"])
+
+    @staticmethod
+    def chunks(content):
+        for start in range(0, len(content), PostBody.CHUNK_CHARS):
+            yield content[start:start + PostBody.CHUNK_CHARS]
+
+    @staticmethod
+    async def stream(content):
+        """The records of a streamed body: its length first, so the receiver knows when it has all of it, then its chunks."""
+        yield {"length": len(content)}
+        for chunk in PostBody.chunks(content):
+            yield {"chunk": chunk}
+
+    @staticmethod
+    def read(storage, userid, post_id):
+        return storage.read(PostBody.get_file(userid, post_id))["content"]
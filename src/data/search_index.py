@@ -0,0 +1,95 @@
+"""Inverted index over the posts of the own and cached timelines, to search them by content.
+
+Each term keeps the posts that contain it sorted by timestamp, so the most
+recent matches are found without looking at older posts.
+"""
+import bisect
+import re
+
+from src.data.post_body import PostBody
+
+TERM = re.compile(r"\w+")
+
+
+class SearchIndex:
+    def __init__(self):
+        # (userid, post id) -> the post, with its author and terms
+        self.posts = {}
+        # term -> [(timestamp, userid, post id)], oldest first
+        self.postings = {}
+        # userid -> ids of the indexed posts of that timeline
+        self.timelines = {}
+
+    @staticmethod
+    def terms(text):
+        return set(TERM.findall(text.lower()))
+
+    def has_timeline(self, userid):
+        return str(userid) in self.timelines
+
+    def add_post(self, userid, post):
+        key = (str(userid), post["id"])
+        if key in self.posts:
+            return
+
+        terms = SearchIndex.terms(post["content"])
+        self.posts[key] = {
+            "id": post["id"],
+            "userid": key[0],
+            "timestamp": post["timestamp"],
+            "content": post["content"],
+            **PostBody.length_field(post),
+            "terms": terms,
+        }
+        self.timelines.setdefault(key[0], set()).add(post["id"])
+        for term in terms:
+            bisect.insort(self.postings.setdefault(term, []), (post["timestamp"], *key))
+
+    def remove_post(self, userid, post_id):
+        post = self.posts.pop((str(userid), post_id), None)
+        if post is None:
+            return
+
+        self.timelines[post["userid"]].discard(post_id)
+        if not self.timelines[post["userid"]]:
+            del self.timelines[post["userid"]]
+        entry = (post["timestamp"], post["userid"], post["id"])
+        for term in post["terms"]:
+            postings = self.postings[term]
+            postings.pop(bisect.bisect_left(postings, entry))
+            if not postings:
+                del self.postings[term]
+
+    def set_posts(self, userid, posts):
+        """Makes the indexed posts of a timeline be the given ones, touching only those that changed."""
+        userid = str(userid)
+        ids = {post["id"] for post in posts}
+        for post_id in self.timelines.get(userid, set()) - ids:
+            self.remove_post(userid, post_id)
+        for post in posts:
+            self.add_post(userid, post)
+
+    def remove_timeline(self, userid):
+        self.set_posts(userid, [])
+
+    def search(self, query, max_results, page=1):
+        """The posts with every term of the query, most recent first. Also tells if there are more pages."""
+        terms = SearchIndex.terms(query)
+        if not terms or any(term not in self.postings for term in terms):
+            return [], False
+
+        # Walks the shortest postings list and checks the other terms on each post
+        rarest = min(terms, key=lambda term: len(self.postings[term]))
+        skip = (page - 1) * max_results
+        results = []
+        for _, userid, post_id in reversed(self.postings[rarest]):
+            post = self.posts[(userid, post_id)]
+            if not terms <= post["terms"]:
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            if len(results) == max_results:
+                return results, True
+            results.append({key: value for key, value in post.items() if key != "terms"})
+        return results, False
@@ -0,0 +1,69 @@
+"""Read-only copy of the timelines a node serves, published by the node for its public workers."""
+import json
+import os
+
+
+class Snapshot:
+    SNAPSHOT_FILE = "snapshot.json"
+
+    def __init__(self, userid, time_to_live, timelines, replicas, revision=None, digest=None, archived_posts=0):
+        self.userid = userid
+        self.time_to_live = time_to_live
+        # Of the own timeline
+        self.revision = revision
+        self.digest = digest
+        # Counted in the total posts of the own timeline, like the node does
+        self.archived_posts = archived_posts
+        # userid -> serialized timeline, the own one included
+        self.timelines = timelines
+        # userid -> subscribers to suggest when busy
+        self.replicas = replicas
+
+    def set_timeline(self, timeline):
+        self.timelines[str(timeline.userid)] = timeline
+
+    def remove_timeline(self, userid):
+        self.timelines.pop(str(userid), None)
+
+    @staticmethod
+    def from_serializable(data):
+        return Snapshot(**data)
+
+    @staticmethod
+    def serialize_timeline(timeline):
+        if isinstance(timeline, dict):
+            return timeline
+        data = timeline.to_serializable()
+        # The posts as they are now, the timeline may change before it is written
+        data["posts"] = list(data["posts"])
+        return data
+
+    def to_serializable(self):
+        return {
+            "userid": self.userid,
+            "time_to_live": self.time_to_live,
+            "timelines": {
+                userid: Snapshot.serialize_timeline(timeline) for userid, timeline in self.timelines.items()
+            },
+            "replicas": self.replicas,
+            "revision": self.revision,
+            "digest": self.digest,
+            "archived_posts": self.archived_posts,
+        }
+
+    @staticmethod
+    def get_file(storage):
+        # A plain file whatever the storage engine, so that workers can read it
+        return storage.get_path(Snapshot.SNAPSHOT_FILE)
+
+    @staticmethod
+    def write(path, data):
+        # Written aside and renamed, so workers never read a half written snapshot
+        with open(path + ".tmp", "w") as f:
+            f.write(json.dumps(data))
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def read(path):
+        with open(path, "r") as f:
+            return Snapshot.from_serializable(json.loads(f.read()))
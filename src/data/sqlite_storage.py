@@ -0,0 +1,223 @@
+"""Persistent storage for data of a given node, kept in a single SQLite database."""
+import json
+import sqlite3
+
+from src.data.storage import PersistentStorage
+from src.data.subscriptions import Subscriptions
+from src.data.timeline import Timeline
+
+
+class SqliteStorage(PersistentStorage):
+    DATABASE_FILE = "storage.db"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS timelines (
+            userid TEXT PRIMARY KEY,
+            total_posts INTEGER,
+            last_updated TEXT,
+            valid_until TEXT,
+            cached INTEGER NOT NULL,
+            revision INTEGER,
+            digest TEXT
+        );
+        CREATE TABLE IF NOT EXISTS posts (
+            userid TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            content TEXT NOT NULL,
+            length INTEGER,
+            PRIMARY KEY (userid, id)
+        );
+        CREATE INDEX IF NOT EXISTS posts_by_timestamp ON posts (userid, timestamp);
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            position INTEGER PRIMARY KEY,
+            userid TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS documents (
+            path TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+    """
+    # Columns added to each table since it was first created, with their types
+    ADDED_COLUMNS = {
+        "timelines": {"revision": "INTEGER", "digest": "TEXT"},
+        "posts": {"length": "INTEGER"},
+    }
+
+    def __init__(self, userid):
+        super().__init__(userid)
+        # Used from the storage thread, one operation at a time
+        self.database = sqlite3.connect(self.get_path(SqliteStorage.DATABASE_FILE), check_same_thread=False)
+        self.database.execute("PRAGMA journal_mode=WAL")
+        self.database.execute("PRAGMA synchronous=NORMAL")
+        self.database.executescript(SqliteStorage.SCHEMA)
+
+        for table, added_columns in SqliteStorage.ADDED_COLUMNS.items():
+            columns = {row[1] for row in self.database.execute(f"PRAGMA table_info({table})")}
+            for column, type in added_columns.items():
+                if column not in columns:
+                    self.database.execute(f"ALTER TABLE {table} ADD COLUMN {column} {type}")
+
+    @staticmethod
+    def get_key(*paths):
+        return "/".join(paths)
+
+    # Small documents, such as the subscriptions and the next post id
+
+    def exists(self, *paths):
+        if self.get_key(*paths) == Subscriptions.SUBSCRIPTIONS_FILE:
+            return True
+        row = self.database.execute(
+            "SELECT 1 FROM documents WHERE path = ?", (self.get_key(*paths),)
+        ).fetchone()
+        return row is not None
+
+    def write(self, data, *paths):
+        with self.database:
+            if self.get_key(*paths) == Subscriptions.SUBSCRIPTIONS_FILE:
+                self.database.execute("DELETE FROM subscriptions")
+                self.database.executemany(
+                    "INSERT INTO subscriptions (position, userid) VALUES (?, ?)",
+                    enumerate(data),
+                )
+            else:
+                self.database.execute(
+                    "INSERT OR REPLACE INTO documents (path, data) VALUES (?, ?)",
+                    (self.get_key(*paths), json.dumps(data)),
+                )
+
+    def read(self, *paths):
+        if self.get_key(*paths) == Subscriptions.SUBSCRIPTIONS_FILE:
+            rows = self.database.execute("SELECT userid FROM subscriptions ORDER BY position")
+            return [userid for (userid,) in rows]
+
+        row = self.database.execute(
+            "SELECT data FROM documents WHERE path = ?", (self.get_key(*paths),)
+        ).fetchone()
+        if row is None:
+            raise FileNotFoundError(self.get_key(*paths))
+        return json.loads(row[0])
+
+    def delete(self, *paths):
+        with self.database:
+            if self.get_key(*paths) == Subscriptions.SUBSCRIPTIONS_FILE:
+                self.database.execute("DELETE FROM subscriptions")
+            else:
+                self.database.execute("DELETE FROM documents WHERE path = ?", (self.get_key(*paths),))
+
+    # Timelines
+
+    def timeline_exists(self, userid):
+        row = self.database.execute(
+            "SELECT 1 FROM timelines WHERE userid = ?", (str(userid),)
+        ).fetchone()
+        return row is not None
+
+    def timeline_header(self, userid):
+        row = self.database.execute(
+            "SELECT total_posts, last_updated, valid_until, cached, revision, digest FROM timelines WHERE userid = ?",
+            (str(userid),),
+        ).fetchone()
+        if row is None:
+            return None
+
+        total_posts, last_updated, valid_until, cached, revision, digest = row
+        (count,) = self.database.execute(
+            "SELECT COUNT(*) FROM posts WHERE userid = ?", (str(userid),)
+        ).fetchone()
+        return {
+            "cached": bool(cached),
+            "total_posts": total_posts,
+            "count": count,
+            "last_updated": last_updated,
+            "valid_until": valid_until,
+            "revision": revision,
+            "digest": digest,
+            "offset": None,
+        }
+
+    def read_timeline(self, userid, max_posts=None):
+        userid = str(userid)
+        total_posts, last_updated, valid_until, cached, revision, digest = self.database.execute(
+            "SELECT total_posts, last_updated, valid_until, cached, revision, digest FROM timelines WHERE userid = ?",
+            (userid,),
+        ).fetchone()
+
+        # Served by the (userid, timestamp) index, newest first
+        rows = self.database.execute(
+            "SELECT id, timestamp, content, length FROM posts WHERE userid = ? ORDER BY timestamp DESC LIMIT ?",
+            (userid, -1 if max_posts is None else max_posts),
+        ).fetchall()
+        posts = []
+        for id, timestamp, content, length in rows:
+            posts.append({"id": id, "timestamp": timestamp, "content": content})
+            if length is not None:
+                posts[-1]["length"] = length
+
+        if not cached:
+            # The own timeline keeps its posts in the order they were made
+            posts.reverse()
+            return {"userid": userid, "posts": posts}
+
+        return {
+            "userid": userid,
+            "posts": posts,
+            "total_posts": total_posts,
+            "last_updated": last_updated,
+            "valid_until": valid_until,
+            "revision": revision,
+            "digest": digest,
+        }
+
+    def write_timeline(self, userid, data):
+        userid = str(userid)
+        cached = "valid_until" in data
+        with self.database:
+            self.database.execute(
+                "INSERT OR REPLACE INTO timelines (userid, total_posts, last_updated, valid_until, cached, revision, digest) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    userid, data.get("total_posts"), data.get("last_updated"), data.get("valid_until"), cached,
+                    data.get("revision"), data.get("digest"),
+                ),
+            )
+
+            # Posts are immutable, so only the ones that were added or removed are touched
+            stored_ids = {id for (id,) in self.database.execute(
+                "SELECT id FROM posts WHERE userid = ?", (userid,)
+            )}
+            new_ids = {post["id"] for post in data["posts"]}
+
+            self.database.executemany(
+                "DELETE FROM posts WHERE userid = ? AND id = ?",
+                [(userid, id) for id in stored_ids - new_ids],
+            )
+            self.database.executemany(
+                "INSERT INTO posts (userid, id, timestamp, content, length) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (userid, post["id"], post["timestamp"], post["content"], post.get("length"))
+                    for post in data["posts"] if post["id"] not in stored_ids
+                ],
+            )
+
+    def timeline_post_hashes(self, userid):
+        rows = self.database.execute(
+            "SELECT id, timestamp, content FROM posts WHERE userid = ?", (str(userid),)
+        )
+        return [
+            Timeline.hash_post(userid, {"id": id, "timestamp": timestamp, "content": content})
+            for id, timestamp, content in rows
+        ]
+
+    def read_posts(self, userid, hashes):
+        return PersistentStorage.posts_by_hash(userid, self.read_timeline(userid)["posts"], hashes)
+
+    def update_timeline_validity(self, userid, last_updated, valid_until):
+        with self.database:
+            self.database.execute(
+                "UPDATE timelines SET last_updated = ?, valid_until = ? WHERE userid = ?",
+                (last_updated, valid_until, str(userid)),
+            )
+
+    def delete_timeline(self, userid):
+        with self.database:
+            self.database.execute("DELETE FROM timelines WHERE userid = ?", (str(userid),))
+            self.database.execute("DELETE FROM posts WHERE userid = ?", (str(userid),))
@@ -1,15 +1,27 @@
-"""Persistent storage for data of a given node."""
+"""Persistent storage for data of a given node.
+
+Timeline files only keep the hashes of their posts, newest first. The posts
+are stored once each under posts/, named by their hash, so refreshing a
+timeline only writes the posts that are new.
+"""
 import os
 import json
+from datetime import datetime
 from pathlib import Path
 
+from src.data.timeline import Timeline
+from src.data.timeline_index import TimelineIndex
+from src.data.user import User
+
 
 class PersistentStorage:
     BASE_DIR = "data"
+    POSTS_FOLDER = "posts"
 
     def __init__(self, userid):
         self.base_dir = os.path.join(self.BASE_DIR, userid.to_filename())
         Path(self.base_dir).mkdir(parents=True, exist_ok=True)
+        self.index = None
 
     def create_dir(self, *paths):
         Path(self.get_path(*paths)).mkdir(parents=True, exist_ok=True)
@@ -36,3 +48,129 @@ class PersistentStorage:
             os.remove(self.get_path(*paths))
         except OSError:
             pass
+
+    # Timelines, checked through the index so that their files are only opened to read posts
+
+    def get_index(self):
+        if self.index is None:
+            self.create_dir(Timeline.TIMELINES_FOLDER)
+            self.index = TimelineIndex.load(self)
+        return self.index
+
+    def timeline_exists(self, userid):
+        return self.timeline_header(userid) is not None
+
+    def timeline_header(self, userid):
+        """The index entry of a stored timeline, or None if there is none."""
+        header = self.get_index().get(userid)
+        if header is None and self.timeline_file_exists(userid):
+            # Stored but not indexed, for example after a crash between both writes
+            header = self.scan_timeline(userid)
+            self.get_index().update(userid, header)
+        return header
+
+    def write_timeline(self, userid, data):
+        self.get_index().update(userid, self.store_timeline(userid, data))
+
+    def delete_timeline(self, userid):
+        self.remove_timeline(userid)
+        self.get_index().remove(userid)
+
+    # Timeline files, to be overridden by engines with another format
+
+    def stored_timelines(self):
+        return [
+            User.from_filename(filename[:-len(".json")])
+            for filename in os.listdir(self.get_path(Timeline.TIMELINES_FOLDER))
+            if filename.endswith(".json")
+        ]
+
+    def timeline_file_exists(self, userid):
+        return self.exists(Timeline.get_file(userid))
+
+    def scan_timeline(self, userid):
+        data = self.read(Timeline.get_file(userid))
+        count = len(data["hashes"]) if "hashes" in data else len(data["posts"])
+        return TimelineIndex.entry(data, count)
+
+    @staticmethod
+    def get_post_file(post_hash):
+        return os.path.join(PersistentStorage.POSTS_FOLDER, f"{post_hash}.json")
+
+    def read_timeline(self, userid, max_posts=None):
+        data = self.read(Timeline.get_file(userid))
+        if "hashes" not in data:
+            # Written before posts were stored apart, with every post in the file
+            return data
+
+        hashes = data.pop("hashes")
+        if max_posts is not None:
+            hashes = hashes[:max_posts]
+        data["posts"] = [self.read(self.get_post_file(h)) for h in hashes]
+        if "valid_until" not in data:
+            # The own timeline keeps its posts in the order they were made
+            data["posts"].reverse()
+        return data
+
+    def store_timeline(self, userid, data):
+        """Writes the timeline and returns its index entry."""
+        posts = sorted(
+            data["posts"], key=lambda p: datetime.fromisoformat(p["timestamp"]), reverse=True
+        )
+        hashes = [Timeline.hash_post(userid, post) for post in posts]
+        stored_hashes = set(self.timeline_hashes(userid))
+
+        # Posts never change, so the ones already stored are not written again
+        self.create_dir(PersistentStorage.POSTS_FOLDER)
+        for post_hash, post in zip(hashes, posts):
+            if post_hash not in stored_hashes and not self.exists(self.get_post_file(post_hash)):
+                self.write(post, self.get_post_file(post_hash))
+
+        manifest = {key: value for key, value in data.items() if key != "posts"}
+        manifest["hashes"] = hashes
+        self.write(manifest, Timeline.get_file(userid))
+
+        # Hashes include the author, so no other timeline has these posts
+        for post_hash in stored_hashes.difference(hashes):
+            self.delete(self.get_post_file(post_hash))
+        return TimelineIndex.entry(data, len(posts))
+
+    def timeline_hashes(self, userid):
+        if not self.exists(Timeline.get_file(userid)):
+            return []
+        return self.read(Timeline.get_file(userid)).get("hashes", [])
+
+    def timeline_post_hashes(self, userid):
+        """The hashes of the posts of a stored timeline, without reading the posts."""
+        data = self.read(Timeline.get_file(userid))
+        if "hashes" in data:
+            return data["hashes"]
+        return [Timeline.hash_post(userid, post) for post in data["posts"]]
+
+    def read_posts(self, userid, hashes):
+        """The posts of a stored timeline with the given hashes, by hash. Only those are read."""
+        data = self.read(Timeline.get_file(userid))
+        if "hashes" not in data:
+            return PersistentStorage.posts_by_hash(userid, data["posts"], hashes)
+        stored_hashes = set(data["hashes"])
+        return {post_hash: self.read(self.get_post_file(post_hash)) for post_hash in hashes if post_hash in stored_hashes}
+
+    @staticmethod
+    def posts_by_hash(userid, posts, hashes):
+        hashes = set(hashes)
+        by_hash = {Timeline.hash_post(userid, post): post for post in posts}
+        return {post_hash: post for post_hash, post in by_hash.items() if post_hash in hashes}
+
+    def update_timeline_validity(self, userid, last_updated, valid_until):
+        """Changes when a stored cached timeline was last updated and until when it is valid, keeping its posts."""
+        data = self.read(Timeline.get_file(userid))
+        data["last_updated"] = last_updated
+        data["valid_until"] = valid_until
+        self.write(data, Timeline.get_file(userid))
+        count = len(data["hashes"]) if "hashes" in data else len(data["posts"])
+        self.get_index().update(userid, TimelineIndex.entry(data, count))
+
+    def remove_timeline(self, userid):
+        for post_hash in self.timeline_hashes(userid):
+            self.delete(self.get_post_file(post_hash))
+        self.delete(Timeline.get_file(userid))
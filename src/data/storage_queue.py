@@ -0,0 +1,67 @@
+"""Runs storage operations away from the event loop, delaying writes so repeated ones are made once.
+
+Every operation runs on the same thread, in the order it was submitted.
+Writes wait in a queue for a moment, keyed by what they write, and a newer
+write to the same key replaces the older one. A read of a key first submits
+the write pending for it, so it always sees it.
+"""
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.monitoring.metrics import metrics
+
+log = logging.getLogger("timeline")
+
+
+class StorageQueue:
+    WRITE_DELAY_S = 0.05
+
+    def __init__(self, executor=None):
+        # A single thread, since storage engines are not meant to be used concurrently
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self.executor = executor
+        # key -> the latest write to it that was not submitted yet
+        self.pending = {}
+        self.flusher = None
+
+    async def run(self, fn, *args, key=None):
+        """Runs a storage operation on the storage thread, after the write pending for key if any."""
+        if key is not None:
+            self.submit(key)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def write(self, key, fn, *args):
+        """Queues a write, replacing the one pending for the same key."""
+        metrics.inc("storage_writes_total", result="collapsed" if key in self.pending else "queued")
+        self.pending[key] = functools.partial(fn, *args)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush_later())
+
+    def submit(self, key):
+        write = self.pending.pop(key, None)
+        if write is None:
+            return None
+
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, write)
+
+        def done(future):
+            metrics.observe("storage_write_seconds", time.perf_counter() - start)
+            if future.exception() is not None:
+                metrics.inc("storage_write_errors_total")
+                log.error("Could not write %s to storage: %s", key, future.exception())
+
+        future.add_done_callback(done)
+        return future
+
+    async def flush_later(self):
+        await asyncio.sleep(StorageQueue.WRITE_DELAY_S)
+        await self.flush()
+
+    async def flush(self):
+        futures = [self.submit(key) for key in list(self.pending)]
+        await asyncio.gather(*futures, return_exceptions=True)
@@ -1,7 +1,10 @@
 """Classes to represent a timeline of posts from a user and a cached timeline."""
+import hashlib
+import json
 import os
 from datetime import datetime, timedelta
 from tabulate import tabulate
+from src.data.post_body import PostBody
 from src.data.user import User
 
 
@@ -15,7 +18,7 @@ class Timeline:
     def is_valid(self):
         return True  # A non-cached timeline is always valid
 
-    def add_post(self, post, post_id): # post_id was already validated
+    def add_post(self, post, post_id, length=None): # post_id was already validated
         self.posts.append(
             {
                 "id": post_id,
@@ -23,6 +26,9 @@ class Timeline:
                 "content": post,
             }
         )
+        if length is not None:
+            # Only a preview of the post, with the length of its body
+            self.posts[-1]["length"] = length
         return self.posts[-1]
 
     def remove_post(self, post):
@@ -44,6 +50,36 @@ class Timeline:
             return self.remove_post(post)
         return False
 
+    @staticmethod
+    def hash_post(userid, post):
+        """Identifies a post by its author and contents, which never change."""
+        data = json.dumps([str(userid), post["id"], post["timestamp"], post["content"]])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def post_hashes(self):
+        return {Timeline.hash_post(self.userid, post): post for post in self.posts}
+
+    def digest(self):
+        """Identifies the posts of the timeline, whatever their order."""
+        hashes = sorted(Timeline.hash_post(self.userid, post) for post in self.posts)
+        return hashlib.sha256("".join(hashes).encode()).hexdigest()
+
+    @staticmethod
+    def strip_known_posts(data, known_hashes):
+        """Replaces the serialized posts whose hash is known by just their hash."""
+        known_hashes = set(known_hashes)
+        posts = []
+        for post in data["posts"]:
+            post_hash = Timeline.hash_post(data["userid"], post)
+            posts.append({"hash": post_hash} if post_hash in known_hashes else post)
+        return {**data, "posts": posts}
+
+    @staticmethod
+    def fill_known_posts(data, known_posts):
+        """Undoes strip_known_posts with the posts of the given hashes. Raises KeyError if one is missing."""
+        posts = [known_posts[post["hash"]] if "hash" in post else post for post in data["posts"]]
+        return {**data, "posts": posts}
+
     @staticmethod
     def from_serializable(data):
         if "valid_until" in data:
@@ -62,30 +98,49 @@ class Timeline:
 
     @staticmethod
     def exists(storage, userid):
-        return storage.exists(Timeline.get_file(userid))
+        return storage.timeline_exists(userid)
 
     def store(self, storage):
-        storage.write(self.to_serializable(), Timeline.get_file(self.userid))
+        storage.write_timeline(self.userid, self.to_serializable())
 
     @staticmethod
-    def read(storage, userid):
+    def read(storage, userid, max_posts=None):
+        # With max_posts, storage engines may only return the newest posts
         if Timeline.exists(storage, userid):
             return Timeline.from_serializable(
-                storage.read(Timeline.get_file(userid))
+                storage.read_timeline(userid, max_posts)
             )
         else:
             return Timeline(userid, [])
 
+    @staticmethod
+    def read_metadata(storage, userid):
+        """A stored cached timeline without its posts, or None if there is none."""
+        header = storage.timeline_header(userid)
+        if header is None or not header["cached"]:
+            return None
+        return TimelineCache.from_serializable(
+            {
+                "userid": str(userid),
+                "posts": [],
+                "total_posts": header["total_posts"],
+                "last_updated": header["last_updated"],
+                "valid_until": header["valid_until"],
+                "revision": header.get("revision"),
+                "digest": header.get("digest"),
+            }
+        )
+
     @staticmethod
     def delete(storage, userid):
-        storage.delete(Timeline.get_file(userid))
+        storage.delete_timeline(userid)
 
     def pretty_str(self):
         posts = [
             {
                 "id": p["id"],
                 "timestamp": datetime.fromisoformat(p["timestamp"]),
-                "content": p["content"],
+                "content": PostBody.listing(p),
             }
             for p in self.posts
         ]
@@ -102,12 +157,13 @@ class Timeline:
         tabledata = [table_row(post) for post in posts]
         return tabulate(tabledata, headers=["id", "time", "content"])
 
-    def cache(self, max_posts, time_to_live=None):
+    def cache(self, max_posts, time_to_live=None, revision=None, digest=None):
         posts = [
             {
                 "id": p["id"],
                 "timestamp": datetime.fromisoformat(p["timestamp"]),
                 "content": p["content"],
+                **PostBody.length_field(p),
             }
             for p in self.posts
         ]
@@ -119,6 +175,7 @@ class Timeline:
                 "id": p["id"],
                 "timestamp": p["timestamp"].isoformat(),
                 "content": p["content"],
+                **PostBody.length_field(p),
             }
             for p in posts
         ]
@@ -133,25 +190,38 @@ class Timeline:
             total_posts=len(self.posts),
             last_updated=now,
             valid_until=valid_until,
+            revision=revision,
+            digest=digest,
         )
 
 
 class TimelineCache(Timeline):
-    def __init__(self, userid, posts, total_posts, last_updated, valid_until):
+    def __init__(self, userid, posts, total_posts, last_updated, valid_until, revision=None, digest=None):
         super().__init__(userid, posts)
         self.total_posts = total_posts
         self.last_updated = last_updated
         self.valid_until = valid_until
+        # Version of the owner's timeline this was cached from, and the digest of its posts, if known
+        self.revision = revision
+        self.digest = digest
 
     def is_valid(self):
         return self.valid_until is None or datetime.now() <= self.valid_until
 
+    def is_current(self, revision, digest):
+        """Whether this was cached from the same version of the owner's timeline as the given one."""
+        return self.revision is not None and self.revision == revision and self.digest == digest
+
+    def is_older(self, revision):
+        return self.revision is not None and self.revision < revision
+
     def cache(self, max_posts):
         posts = [
             {
                 "id": p["id"],
                 "timestamp": datetime.fromisoformat(p["timestamp"]),
                 "content": p["content"],
+                **PostBody.length_field(p),
             }
             for p in self.posts
         ]
@@ -163,6 +233,7 @@ class TimelineCache(Timeline):
                 "id": p["id"],
                 "timestamp": p["timestamp"].isoformat(),
                 "content": p["content"],
+                **PostBody.length_field(p),
             }
             for p in posts
         ]
@@ -173,6 +244,8 @@ class TimelineCache(Timeline):
             total_posts=self.total_posts,
             last_updated=self.last_updated,
             valid_until=self.valid_until,
+            revision=self.revision,
+            digest=self.digest,
         )
 
     def to_serializable(self):
@@ -0,0 +1,91 @@
+"""Splits the newest posts of a timeline into chunks small enough to be stored in the DHT.
+
+A manifest tells the version of the chunks and how many posts each one has,
+so readers can tell when they got chunks of different versions.
+"""
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+from src.data.timeline import TimelineCache
+
+log = logging.getLogger("timeline")
+
+
+class TimelineChunks:
+    DEFAULT_CHUNK_SIZE = 10
+    # Values travel in a single UDP datagram
+    MAX_CHUNK_BYTES = 8000
+
+    @staticmethod
+    def split(timeline, chunk_size, chunk_count, time_to_live=None):
+        """Returns the manifest and the chunks with the newest posts of the timeline.
+
+        Readers keep the posts for the owner's time to live since the chunks were published.
+        """
+        cache = timeline.cache(chunk_size * chunk_count)
+        # Milliseconds, so versions keep increasing across restarts
+        version = int(time.time() * 1000)
+
+        chunks = []
+        current = []
+        current_bytes = 0
+        for post in cache.posts:
+            post_bytes = len(json.dumps(post))
+            if post_bytes > TimelineChunks.MAX_CHUNK_BYTES:
+                log.debug("Post %s is too large to be published in a chunk", post["id"])
+                continue
+
+            if len(current) == chunk_size or current_bytes + post_bytes > TimelineChunks.MAX_CHUNK_BYTES:
+                chunks.append(current)
+                current = []
+                current_bytes = 0
+                if len(chunks) == chunk_count:
+                    break
+
+            current.append(post)
+            current_bytes += post_bytes
+
+        if current and len(chunks) < chunk_count:
+            chunks.append(current)
+
+        manifest = {
+            "version": version,
+            "last_updated": cache.last_updated.isoformat(),
+            "total_posts": cache.total_posts,
+            "time_to_live": time_to_live,
+            "chunks": [len(chunk) for chunk in chunks],
+        }
+        return manifest, [{"version": version, "posts": chunk} for chunk in chunks]
+
+    @staticmethod
+    def chunks_needed(manifest, max_posts):
+        if max_posts is None:
+            return len(manifest["chunks"])
+
+        posts = 0
+        for i, count in enumerate(manifest["chunks"]):
+            posts += count
+            if posts >= max_posts:
+                return i + 1
+        return len(manifest["chunks"])
+
+    @staticmethod
+    def join(userid, manifest, chunks, max_posts):
+        """Rebuilds a cached timeline from the chunks, or None if any is missing or of another version."""
+        posts = []
+        for chunk in chunks:
+            if chunk is None or chunk["version"] != manifest["version"]:
+                return None
+            posts.extend(chunk["posts"])
+
+        last_updated = datetime.fromisoformat(manifest["last_updated"])
+        time_to_live = manifest.get("time_to_live")
+        return TimelineCache(
+            userid=userid,
+            posts=posts if max_posts is None else posts[:max_posts],
+            total_posts=manifest["total_posts"],
+            last_updated=last_updated,
+            valid_until=None if time_to_live is None else last_updated + timedelta(seconds=time_to_live),
+        )
@@ -0,0 +1,99 @@
+"""Index with the metadata of every stored timeline, so that it can be checked without opening them.
+
+The index is an append-only log of entries, replayed on load and compacted
+once most of its records are outdated.
+"""
+import json
+import logging
+import os
+
+from src.data.timeline import Timeline
+
+log = logging.getLogger("timeline")
+
+
+class TimelineIndex:
+    INDEX_FILE = os.path.join(Timeline.TIMELINES_FOLDER, "index.log")
+    COMPACT_MIN_RECORDS = 100
+
+    def __init__(self, storage, entries, records):
+        self.storage = storage
+        self.entries = entries
+        self.records = records
+
+    @staticmethod
+    def entry(data, count, offset=None):
+        """The metadata of a serialized timeline, with the number of posts stored and where they start."""
+        return {
+            "cached": "valid_until" in data,
+            "total_posts": data.get("total_posts"),
+            "count": count,
+            "last_updated": data.get("last_updated"),
+            "valid_until": data.get("valid_until"),
+            "revision": data.get("revision"),
+            "digest": data.get("digest"),
+            "offset": offset,
+        }
+
+    @staticmethod
+    def load(storage):
+        if not storage.exists(TimelineIndex.INDEX_FILE):
+            return TimelineIndex.rebuild(storage)
+
+        entries = {}
+        records = 0
+        with open(storage.get_path(TimelineIndex.INDEX_FILE), "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A record cut short by a crash, the rest of the log is still valid
+                    continue
+                records += 1
+                if record["entry"] is None:
+                    entries.pop(record["userid"], None)
+                else:
+                    entries[record["userid"]] = record["entry"]
+
+        return TimelineIndex(storage, entries, records)
+
+    @staticmethod
+    def rebuild(storage):
+        log.info("Indexing stored timelines")
+        entries = {}
+        for userid in storage.stored_timelines():
+            try:
+                entries[str(userid)] = storage.scan_timeline(userid)
+            except Exception as e:
+                log.error("Could not index timeline of %s: %s", userid, e)
+
+        index = TimelineIndex(storage, entries, 0)
+        index.compact()
+        return index
+
+    def get(self, userid):
+        return self.entries.get(str(userid))
+
+    def append(self, userid, entry):
+        with open(self.storage.get_path(TimelineIndex.INDEX_FILE), "a") as f:
+            f.write(json.dumps({"userid": str(userid), "entry": entry}) + "\n")
+        self.records += 1
+
+        if self.records > TimelineIndex.COMPACT_MIN_RECORDS and self.records > 2 * len(self.entries):
+            self.compact()
+
+    def update(self, userid, entry):
+        self.entries[str(userid)] = entry
+        self.append(userid, entry)
+
+    def remove(self, userid):
+        if self.entries.pop(str(userid), None) is not None:
+            self.append(userid, None)
+
+    def compact(self):
+        path = self.storage.get_path(TimelineIndex.INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            for userid, entry in self.entries.items():
+                f.write(json.dumps({"userid": userid, "entry": entry}) + "\n")
+        os.replace(path + ".tmp", path)
+        self.records = len(self.entries)
@@ -0,0 +1,29 @@
+"""Version of the local user's timeline, advanced every time its posts change."""
+
+
+class TimelineRevision:
+    TIMELINE_REVISION_FILE = "timeline_revision.json"
+    START_REVISION = 0
+
+    def __init__(self, revision):
+        self.revision = revision
+
+    def advance(self):
+        self.revision += 1
+        return self.revision
+
+    @staticmethod
+    def from_serializable(data):
+        return TimelineRevision(**data)
+
+    def to_serializable(self):
+        return self.__dict__.copy()
+
+    @staticmethod
+    def read(storage):
+        if storage.exists(TimelineRevision.TIMELINE_REVISION_FILE):
+            return TimelineRevision.from_serializable(
+                storage.read(TimelineRevision.TIMELINE_REVISION_FILE)
+            )
+        else:
+            return TimelineRevision(TimelineRevision.START_REVISION)
@@ -0,0 +1,90 @@
+"""Runs the nodes of many users in a single process.
+
+The nodes share the event loop, one node of the DHT, the thread pools and a
+refresh schedule that spreads their caching periods over time. Each keeps
+its own storage and its public address, since that is how others reach it.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from src.connection import KademliaConnection, MetricsConnection
+from src.connection.admission import AdmissionControl
+from src.connection.host import HostConnection
+from src.data.timeline_chunks import TimelineChunks
+from src.data.user import User
+from src.monitoring.tracing import tracer
+from src.node import Node
+
+log = logging.getLogger("timeline")
+
+
+class Host:
+    def __init__(self, userids, storage_engine=Node.DEFAULT_STORAGE_ENGINE):
+        # The same user twice would share its storage and public port
+        self.userids = []
+        for userid in userids:
+            if User(userid) in map(User, self.userids):
+                log.info("%s is given more than once, hosting it once", User(userid))
+                continue
+            self.userids.append(userid)
+        self.storage_engine = storage_engine
+        self.nodes = []
+
+        self.kademlia_connection = KademliaConnection(None)
+        self.pool = ThreadPoolExecutor(max_workers=Node.POOL_WORKERS, thread_name_prefix="work")
+        self.storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+    async def run(
+        self, port, bootstrap_nodes, local_port, cache_frequency, time_to_live, max_cached_posts,
+        metrics_port=None, trace_sample_rate=0.0, admission_limits=None,
+        dht_chunk_count=Node.DEFAULT_DHT_CHUNK_COUNT, dht_chunk_size=TimelineChunks.DEFAULT_CHUNK_SIZE,
+        disk_budget=None
+    ):
+        """admission_limits are the arguments of the AdmissionControl of each node, disk_budget is per node."""
+        await self.kademlia_connection.start(port, bootstrap_nodes)
+
+        # Nodes are made once the DHT is running, since they share its connection
+        for userid in self.userids:
+            # A user whose storage cannot be read is skipped, the others are still hosted
+            try:
+                node = Node(
+                    userid,
+                    self.storage_engine,
+                    kademlia_connection=self.kademlia_connection.share(User(userid)),
+                    pool=self.pool,
+                    storage_executor=self.storage_executor,
+                )
+                node.start(
+                    None, time_to_live, max_cached_posts,
+                    trace_sample_rate=trace_sample_rate,
+                    admission=None if admission_limits is None else AdmissionControl(*admission_limits),
+                    dht_chunk_count=dht_chunk_count,
+                    dht_chunk_size=dht_chunk_size,
+                    disk_budget=disk_budget,
+                )
+            except SystemExit:
+                # The node already logged why
+                log.error("Could not host %s, skipping it", User(userid))
+                continue
+            except Exception as e:
+                log.error("Could not host %s, skipping it: %s", User(userid), e)
+                continue
+            self.nodes.append(node)
+        if not self.nodes:
+            log.error("No user could be hosted.")
+            exit(1)
+        tracer.node = f"host:{local_port}"
+
+        connection = HostConnection({str(node.userid): node.local_connection for node in self.nodes})
+        connection.executor = self.pool
+        asyncio.create_task(connection.start(local_port))
+        if metrics_port is not None:
+            asyncio.create_task(MetricsConnection().start(metrics_port))
+        log.debug("Hosting %s users", len(self.nodes))
+
+        while True:
+            # Each node still refreshes once per period, but not all at the same time
+            for node in self.nodes:
+                node.refresh()
+                await asyncio.sleep(cache_frequency / len(self.nodes))
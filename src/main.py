@@ -2,9 +2,16 @@
 import argparse
 import logging
 import asyncio
+from src.data.engines import STORAGE_ENGINES
+from src.data.migrate import migrate, migrate_all
+from src.data.timeline_chunks import TimelineChunks
+from src.data.user import User
+from src.connection.admission import AdmissionControl
+from src.host import Host
+from src.monitoring.capture import capture
 from src.node import Node
-from src.operation import get, post, remove, sub, unsub, view, people_i_may_know
-from src.validator import IpPortValidator, PortValidator, PositiveIntegerValidator, NonNegativeIntegerValidator
+from src.operation import get, post, remove, sub, unsub, view, people_i_may_know, stats, profile, memory_snapshot, slow_callbacks, traces, search, batch, archive, get_post, replay, act_as
+from src.validator import IpPortValidator, PortValidator, PositiveIntegerValidator, NonNegativeIntegerValidator, PositiveFloatValidator, FractionValidator
 
 handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
@@ -17,6 +24,7 @@ def parse_arguments():
     subparsers = parser.add_subparsers(required=True, dest="command")
 
     start_parser = subparsers.add_parser("start", description="Start running the user's node.")
+    host_parser = subparsers.add_parser("host", description="Start running the nodes of several users in a single process.")
     view_parser = subparsers.add_parser("view", description="View your feed with the posts made by you and the users you are subscribed to.")
     get_parser = subparsers.add_parser("get", description="Find a user's timeline.")
     post_parser = subparsers.add_parser("post", description="Post in your timeline.")
@@ -24,19 +32,46 @@ def parse_arguments():
     sub_parser = subparsers.add_parser("sub", description="Subscribe to a user's timeline.")
     unsub_parser = subparsers.add_parser("unsub", description="Unsubscribe to a user's timeline.")
     may_know_parser = subparsers.add_parser("people-i-may-know", description="Find people you may know based on your subscriptions.")
-    all_parsers = [start_parser, post_parser, remove_parser, get_parser, sub_parser, unsub_parser, view_parser, may_know_parser]
+    stats_parser = subparsers.add_parser("stats", description="Show the counters and latency histograms of the node.")
+    profile_parser = subparsers.add_parser("profile", description="Start or stop profiling the running node. Results are written to the node's data directory.")
+    memory_parser = subparsers.add_parser("memory-snapshot", description="Snapshot the memory allocations of the running node. The first call starts tracing them.")
+    slow_parser = subparsers.add_parser("slow-callbacks", description="Report callbacks that block the node's event loop. The first call starts monitoring.")
+    traces_parser = subparsers.add_parser("traces", description="Dump the traces recorded by the node.")
+    search_parser = subparsers.add_parser("search", description="Search the posts of your timeline and of the cached timelines of your subscriptions. Most recent first.")
+    batch_parser = subparsers.add_parser("batch", description="Apply several posts, removals, subscriptions and unsubscriptions at once.")
+    get_post_parser = subparsers.add_parser("get-post", description="Show the whole content of a post, which timelines only show the start of.")
+    archive_parser = subparsers.add_parser("archive", description="Browse the archived old posts of your timeline, a page per segment. Most recent first.")
+    replay_parser = subparsers.add_parser("replay", description="Send the commands captured by a node to a node, at the pace they were captured, and report their latencies.")
+    migrate_parser = subparsers.add_parser("migrate", description="Import the JSON data directory of a node into the SQLite storage engine.")
+    all_parsers = [start_parser, host_parser, post_parser, remove_parser, get_parser, sub_parser, unsub_parser, view_parser, may_know_parser, stats_parser, profile_parser, memory_parser, slow_parser, traces_parser, search_parser, batch_parser, archive_parser, get_post_parser]
 
-    for subparser in all_parsers:
+    for subparser in all_parsers + [replay_parser, migrate_parser]:
         # Adding command here instead of main parser so that they appear
         # in subcommand help
         subparser.add_argument("-d", "--debug", help="Debug and log to stdout.", action="store_true")
 
     start_parser.add_argument("userid", help="ID of the user, composed of the node's IP and public port.", type=IpPortValidator(Node.DEFAULT_PUBLIC_PORT).ip_address)
-    start_parser.add_argument("-k", "--kademlia-port", help="Kademlia port number to serve at.", type=PortValidator.port, default=Node.DEFAULT_KADEMLIA_PORT)
-    start_parser.add_argument("-b", "--bootstrap-nodes", help="IP addresses of existing nodes.", type=IpPortValidator(Node.DEFAULT_KADEMLIA_PORT).ip_address, nargs='+', default=[])
-    start_parser.add_argument("-f", "--cache-frequency", help="The time in seconds it takes between caching periods.", type=PositiveIntegerValidator.positive_integer, default=Node.DEFAULT_SLEEP_TIME_BETWEEN_CACHING)
-    start_parser.add_argument("-t", "--cache-time-to-live", help="The maximum time (in seconds) a cache from this node's timeline is valid for.", type=PositiveIntegerValidator.positive_integer, default=None)
-    start_parser.add_argument("-c", "--max-cached-posts", help="The maximum number of posts to cache per subscription.", type=PositiveIntegerValidator.positive_integer, default=Node.DEFAULT_MAX_CACHED_POSTS)
+    host_parser.add_argument("userids", help="IDs of the users, composed of each node's IP and public port.", type=IpPortValidator(Node.DEFAULT_PUBLIC_PORT).ip_address, nargs="+")
+    start_parser.add_argument("-w", "--public-workers", help="Number of extra processes serving other nodes on the public port. Each applies its own request limits.", type=NonNegativeIntegerValidator.non_negative_integer, default=0)
+
+    for subparser in [start_parser, host_parser]:
+        subparser.add_argument("-k", "--kademlia-port", help="Kademlia port number to serve at.", type=PortValidator.port, default=Node.DEFAULT_KADEMLIA_PORT)
+        subparser.add_argument("-b", "--bootstrap-nodes", help="IP addresses of existing nodes.", type=IpPortValidator(Node.DEFAULT_KADEMLIA_PORT).ip_address, nargs='+', default=[])
+        subparser.add_argument("-f", "--cache-frequency", help="The time in seconds it takes between caching periods.", type=PositiveIntegerValidator.positive_integer, default=Node.DEFAULT_SLEEP_TIME_BETWEEN_CACHING)
+        subparser.add_argument("-t", "--cache-time-to-live", help="The maximum time (in seconds) a cache from this node's timeline is valid for.", type=PositiveIntegerValidator.positive_integer, default=None)
+        subparser.add_argument("-c", "--max-cached-posts", help="The maximum number of posts to cache per subscription.", type=PositiveIntegerValidator.positive_integer, default=Node.DEFAULT_MAX_CACHED_POSTS)
+        subparser.add_argument("--max-public-requests", help="The maximum number of requests from other nodes handled at once.", type=PositiveIntegerValidator.positive_integer, default=AdmissionControl.DEFAULT_MAX_CONCURRENT)
+        subparser.add_argument("--max-requests-per-peer", help="The maximum number of requests from the same peer handled at once. A peer is a node, or an IP when a request says it is from a node of another IP. Unlimited by default.", type=PositiveIntegerValidator.positive_integer, default=AdmissionControl.DEFAULT_MAX_PER_PEER)
+        subparser.add_argument("--public-rate-limit", help="The maximum number of requests per second from other nodes. Unlimited by default.", type=PositiveFloatValidator.positive_float, default=None)
+        subparser.add_argument("--public-burst", help="How many requests above the rate limit can be handled in a burst.", type=PositiveIntegerValidator.positive_integer, default=None)
+        subparser.add_argument("--dht-chunk-count", help="Publish the newest posts in up to this many chunks in the DHT, so they are available while no one else is. Disabled by default.", type=NonNegativeIntegerValidator.non_negative_integer, default=Node.DEFAULT_DHT_CHUNK_COUNT)
+        subparser.add_argument("--dht-chunk-size", help="The maximum number of posts in each chunk published in the DHT.", type=PositiveIntegerValidator.positive_integer, default=TimelineChunks.DEFAULT_CHUNK_SIZE)
+        subparser.add_argument("--disk-budget", help="The maximum space in MB the timelines of a node may take, evicting the least recently read cached timelines when over it. Unlimited by default.", type=PositiveIntegerValidator.positive_integer, default=None)
+        subparser.add_argument("-e", "--storage-engine", help="How the node's data is kept on disk.", choices=list(STORAGE_ENGINES), default=Node.DEFAULT_STORAGE_ENGINE)
+        subparser.add_argument("-s", "--trace-sample-rate", help="Fraction of the operations started by this node to trace.", type=FractionValidator.fraction, default=0.0)
+        subparser.add_argument("-m", "--metrics-port", help="Port number to locally serve metrics at, in the Prometheus text format.", type=PortValidator.port, default=None)
+        subparser.add_argument("--capture", help="Append the commands received to this file, to replay them later.", default=None)
+        subparser.add_argument("--capture-redact", help="Capture the content of posts and search queries as x's of the same length.", action="store_true")
 
     post_parser.add_argument("filepath", help="Path to file to post.")
     get_parser.add_argument("userid", help="ID of user to get timeline of.", type=IpPortValidator(Node.DEFAULT_PUBLIC_PORT).ip_address)
@@ -44,12 +79,41 @@ def parse_arguments():
     sub_parser.add_argument("userid", help="ID of user to subscribe to.", type=IpPortValidator(Node.DEFAULT_PUBLIC_PORT).ip_address)
     unsub_parser.add_argument("userid", help="ID of user to unsubscribe from.", type=IpPortValidator(Node.DEFAULT_PUBLIC_PORT).ip_address)
     view_parser.add_argument("max_posts", help="Limit the number of posts to get.", type=PositiveIntegerValidator.positive_integer, default=None, nargs="?")
+    view_parser.add_argument("-s", "--stream", help="Print the posts of each timeline as soon as it is found, instead of the whole feed sorted. Limits the posts of each timeline.", action="store_true")
+    get_parser.add_argument("-s", "--stream", help="Print the posts as they are received.", action="store_true")
     may_know_parser.add_argument("max_users", help="Limit the number of users to get.", type=PositiveIntegerValidator.positive_integer, default=None, nargs="?")
     remove_parser.add_argument("post_id", help="ID of post to remove.", type=NonNegativeIntegerValidator.non_negative_integer)
+    stats_parser.add_argument("-p", "--prometheus", help="Print the metrics in the Prometheus text format.", action="store_true")
+    profile_parser.add_argument("action", help="Whether to start or stop the profiling session.", choices=["start", "stop"])
+    profile_parser.add_argument("-m", "--mode", help="Profile deterministically (cprofile) or by sampling the stack.", choices=["cprofile", "sampling"], default="cprofile")
+    memory_parser.add_argument("-s", "--stop", help="Stop tracing after this snapshot.", action="store_true")
+    slow_parser.add_argument("-t", "--threshold", help="Time in seconds a callback must block the loop to be reported.", type=PositiveFloatValidator.positive_float, default=None)
+    slow_parser.add_argument("-s", "--stop", help="Stop monitoring after this report.", action="store_true")
+    search_parser.add_argument("query", help="Words the posts must contain.", nargs="+")
+    search_parser.add_argument("-n", "--max-results", help="Limit the number of posts per page.", type=PositiveIntegerValidator.positive_integer, default=None)
+    search_parser.add_argument("-p", "--page", help="Page of results to show.", type=PositiveIntegerValidator.positive_integer, default=1)
+    get_post_parser.add_argument("userid", help="ID of the user who made the post.", type=IpPortValidator(Node.DEFAULT_PUBLIC_PORT).ip_address)
+    get_post_parser.add_argument("post_id", help="ID of the post.", type=NonNegativeIntegerValidator.non_negative_integer)
+    archive_parser.add_argument("page", help="Page of the archive to show, 1 being the most recent.", type=PositiveIntegerValidator.positive_integer, default=1, nargs="?")
+    batch_parser.add_argument("filepath", help='Path to a JSON file with a list of operations, such as {"command": "post", "content": "..."}, {"command": "remove", "post-id": 0}, {"command": "sub", "userid": "127.0.0.1:8001"} or {"command": "unsub", "userid": "127.0.0.1:8001"}.')
+    replay_parser.add_argument("filepath", help="Path to a file captured with --capture.")
+    replay_parser.add_argument("target", help="IP and port of the node to send the commands to, its local port for local commands or its public port for public ones.", type=IpPortValidator(Node.DEFAULT_LOCAL_PORT).ip_address)
+    replay_parser.add_argument("-x", "--speed", help="How many times faster than captured to send the commands.", type=PositiveFloatValidator.positive_float, default=1.0)
+    replay_parser.add_argument("-a", "--as-fast-as-possible", help="Send the commands as soon as the concurrency allows, ignoring when they were captured.", action="store_true")
+    replay_parser.add_argument("-c", "--concurrency", help="The maximum number of commands waiting for an answer at once.", type=PositiveIntegerValidator.positive_integer, default=8)
+    replay_parser.add_argument("--connection", help="Which of the captured commands to send, those of local operations or those of other nodes.", choices=["local", "public"], default="local")
+    migrate_group = migrate_parser.add_mutually_exclusive_group(required=True)
+    migrate_group.add_argument("userid", help="ID of the user whose data to migrate.", type=IpPortValidator(Node.DEFAULT_PUBLIC_PORT).ip_address, nargs="?")
+    migrate_group.add_argument("-a", "--all", help="Migrate the data of every user in the data directory.", action="store_true")
+    traces_parser.add_argument("trace_id", help="Only dump the spans of this trace.", default=None, nargs="?")
+    traces_parser.add_argument("-o", "--output", help="Write the dump to this file instead of stdout.", default=None)
+    traces_parser.add_argument("-c", "--clear", help="Discard the dumped spans from the node.", action="store_true")
 
     for subparser in all_parsers:
         # Adding command here so it appears at the end of the help
         subparser.add_argument("-l", "--local-port", help="Port number that listens for local operations.", type=PortValidator.port, default=Node.DEFAULT_LOCAL_PORT)
+        if subparser not in (start_parser, host_parser):
+            subparser.add_argument("-u", "--user", help="ID of the user to act as, when the node hosts several.", type=IpPortValidator(Node.DEFAULT_PUBLIC_PORT).ip_address, default=None)
 
     return parser.parse_args()
 
@@ -63,17 +127,75 @@ def main():
 
     log.debug("Called with arguments: %s", args)
 
+    if args.command == "migrate":
+        if args.all:
+            users = migrate_all()
+        else:
+            users = [User(args.userid)]
+            migrate(users[0])
+        for userid in users:
+            print(f"Migrated the data of {userid} to the SQLite storage engine.")
+        return
+
+    if args.command == "replay":
+        ip, port = args.target
+        asyncio.run(replay(
+            args.filepath, ip, port,
+            speed=0 if args.as_fast_as_possible else args.speed,
+            concurrency=args.concurrency,
+            connection=args.connection
+        ), debug=args.debug)
+        return
+
+    if args.command in ("start", "host") and args.capture is not None:
+        capture.start(args.capture, redacted=args.capture_redact)
+
+    if args.command not in ("start", "host") and args.user is not None:
+        act_as(User(args.user))
+
     if args.command == "start":
-        run = Node(args.userid).run(
+        run = Node(args.userid, storage_engine=args.storage_engine).run(
+            args.kademlia_port,
+            args.bootstrap_nodes,
+            local_port=args.local_port,
+            cache_frequency=args.cache_frequency,
+            time_to_live=args.cache_time_to_live,
+            max_cached_posts=args.max_cached_posts,
+            metrics_port=args.metrics_port,
+            trace_sample_rate=args.trace_sample_rate,
+            admission=AdmissionControl(
+                args.max_public_requests,
+                args.max_requests_per_peer,
+                args.public_rate_limit,
+                args.public_burst
+            ),
+            dht_chunk_count=args.dht_chunk_count,
+            dht_chunk_size=args.dht_chunk_size,
+            public_workers=args.public_workers,
+            disk_budget=None if args.disk_budget is None else args.disk_budget * 1024 * 1024
+        )
+    elif args.command == "host":
+        run = Host(args.userids, storage_engine=args.storage_engine).run(
             args.kademlia_port,
             args.bootstrap_nodes,
             local_port=args.local_port,
             cache_frequency=args.cache_frequency,
             time_to_live=args.cache_time_to_live,
-            max_cached_posts=args.max_cached_posts
+            max_cached_posts=args.max_cached_posts,
+            metrics_port=args.metrics_port,
+            trace_sample_rate=args.trace_sample_rate,
+            admission_limits=(
+                args.max_public_requests,
+                args.max_requests_per_peer,
+                args.public_rate_limit,
+                args.public_burst
+            ),
+            dht_chunk_count=args.dht_chunk_count,
+            dht_chunk_size=args.dht_chunk_size,
+            disk_budget=None if args.disk_budget is None else args.disk_budget * 1024 * 1024
         )
     elif args.command == "get":
-        run = get(args.userid, local_port=args.local_port, max_posts=args.max_posts)
+        run = get(args.userid, local_port=args.local_port, max_posts=args.max_posts, stream=args.stream)
     elif args.command == "post":
         run = post(args.filepath, local_port=args.local_port)
     elif args.command == "remove":
@@ -83,9 +205,27 @@ def main():
     elif args.command == "unsub":
         run = unsub(args.userid, local_port=args.local_port)
     elif args.command == "view":
-        run = view(local_port=args.local_port, max_posts=args.max_posts)
+        run = view(local_port=args.local_port, max_posts=args.max_posts, stream=args.stream)
     elif args.command == "people-i-may-know":
         run = people_i_may_know(local_port=args.local_port, max_users=args.max_users)
+    elif args.command == "stats":
+        run = stats(local_port=args.local_port, prometheus=args.prometheus)
+    elif args.command == "profile":
+        run = profile(args.action, local_port=args.local_port, mode=args.mode)
+    elif args.command == "memory-snapshot":
+        run = memory_snapshot(local_port=args.local_port, stop=args.stop)
+    elif args.command == "slow-callbacks":
+        run = slow_callbacks(local_port=args.local_port, threshold=args.threshold, stop=args.stop)
+    elif args.command == "traces":
+        run = traces(local_port=args.local_port, trace_id=args.trace_id, output=args.output, clear=args.clear)
+    elif args.command == "search":
+        run = search(" ".join(args.query), local_port=args.local_port, max_results=args.max_results, page=args.page)
+    elif args.command == "batch":
+        run = batch(args.filepath, local_port=args.local_port)
+    elif args.command == "get-post":
+        run = get_post(args.userid, args.post_id, local_port=args.local_port)
+    elif args.command == "archive":
+        run = archive(local_port=args.local_port, page=args.page)
     
     asyncio.run(run, debug=args.debug)
 
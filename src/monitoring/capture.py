@@ -0,0 +1,78 @@
+"""Capture of the commands a node receives, to replay real workloads against a node later.
+
+Each command is a line of JSON with when it was received, through which
+connection, the sizes of the request and the response, how long it took and
+its status. Redaction replaces the text of posts and queries by as many x's,
+so a replay sends requests of the same size without their contents.
+"""
+import json
+import logging
+import time
+
+log = logging.getLogger("timeline")
+
+
+class TrafficCapture:
+    # Fields whose text is replaced when redacting, wherever they are in a message
+    REDACTED_FIELDS = ("content", "query")
+
+    def __init__(self):
+        self.file = None
+        self.redacted = False
+
+    def start(self, path, redacted=False):
+        # Line buffered, so commands are not lost if the node is killed
+        self.file = open(path, "a", buffering=1)
+        self.redacted = redacted
+        log.debug("Capturing commands to %s", path)
+
+    def is_running(self):
+        return self.file is not None
+
+    @staticmethod
+    def redact(value):
+        if isinstance(value, dict):
+            return {
+                key: "x" * len(field) if key in TrafficCapture.REDACTED_FIELDS and isinstance(field, str)
+                else TrafficCapture.redact(field)
+                for key, field in value.items()
+            }
+        if isinstance(value, list):
+            return [TrafficCapture.redact(item) for item in value]
+        return value
+
+    def record(self, connection, message, received, sent, duration, status):
+        # The trace of the captured command is not continued by a replay
+        message = {key: value for key, value in message.items() if key != "trace"}
+        if self.redacted:
+            message = TrafficCapture.redact(message)
+        record = {
+            "time": round(time.time(), 6),
+            "connection": connection,
+            "in": received,
+            "out": sent,
+            "duration": round(duration, 6),
+            "status": status,
+            "message": message,
+        }
+        try:
+            self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        except (OSError, TypeError, ValueError) as e:
+            log.error("Could not capture command: %s", e)
+
+    @staticmethod
+    def read(path):
+        """The captured commands, oldest first. Lines cut short by a crash are skipped."""
+        records = []
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        records.sort(key=lambda record: record["time"])
+        return records
+
+
+# Shared by every connection of this process
+capture = TrafficCapture()
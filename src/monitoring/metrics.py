@@ -0,0 +1,143 @@
+"""Counters and latency histograms describing the activity of a node."""
+import bisect
+import time
+
+
+class Histogram:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(Histogram.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (None if above every bucket)."""
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(Histogram.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def cumulative(self):
+        total = 0
+        buckets = []
+        for bound, count in zip(Histogram.BUCKETS + ("+Inf",), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def to_serializable(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {str(bound): total for bound, total in self.cumulative()},
+        }
+
+
+class Timer:
+    """Context manager that records the time spent inside it in a histogram."""
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics:
+    PROMETHEUS_PREFIX = "timeline_"
+
+    def __init__(self):
+        # Keyed by (name, sorted label pairs), so recording is a dict lookup
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        if not labels:
+            return (name, ())
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = Metrics.key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = Metrics.key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def to_serializable(self):
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            "histograms": [
+                {"name": name, "labels": dict(labels), **histogram.to_serializable()}
+                for (name, labels), histogram in sorted(self.histograms.items())
+            ],
+        }
+
+    @staticmethod
+    def prometheus_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def to_prometheus(self):
+        lines = []
+        typed = set()
+
+        for (name, labels), value in sorted(self.counters.items()):
+            name = Metrics.PROMETHEUS_PREFIX + name
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{Metrics.prometheus_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            name = Metrics.PROMETHEUS_PREFIX + name
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, total in histogram.cumulative():
+                lines.append(f"{name}_bucket{Metrics.prometheus_labels(labels, [('le', bound)])} {total}")
+            lines.append(f"{name}_sum{Metrics.prometheus_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{Metrics.prometheus_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Shared by every connection and the node of this process
+metrics = Metrics()
@@ -0,0 +1,201 @@
+"""On-demand profiling of a running node: CPU profiles, memory snapshots and slow callbacks."""
+import asyncio
+import cProfile
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from datetime import datetime
+
+log = logging.getLogger("timeline")
+
+
+def thread_stack(thread_id, limit=None):
+    """Returns the current stack of a thread, outermost frame first."""
+    frame = sys._current_frames().get(thread_id)
+    stack = []
+    while frame is not None and (limit is None or len(stack) < limit):
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class SamplingProfiler:
+    """Periodically samples the stack of a thread from a background thread."""
+    DEFAULT_INTERVAL_S = 0.005
+
+    def __init__(self, thread_id, interval=DEFAULT_INTERVAL_S):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.running = False
+
+    def sample(self):
+        while self.running:
+            stack = thread_stack(self.thread_id)
+            if stack:
+                self.samples[";".join(stack)] += 1
+            time.sleep(self.interval)
+
+    def enable(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def disable(self):
+        self.running = False
+        self.thread.join()
+
+    def dump_stats(self, path):
+        # Collapsed stacks, the input format of flame graph tools
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class SlowCallbackMonitor:
+    """Reports callbacks that block the event loop for longer than a threshold.
+
+    A task on the loop beats periodically while a watchdog thread checks that
+    the beats keep coming. When they stop, the loop thread's stack is captured
+    to identify the callback that is blocking it.
+    """
+    MAX_REPORTS = 100
+    STACK_LIMIT = 20
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.reports = deque(maxlen=SlowCallbackMonitor.MAX_REPORTS)
+        self.running = False
+
+    async def heartbeat(self):
+        while self.running:
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 2)
+
+    def watch(self):
+        blocked_beat = None
+        while self.running:
+            time.sleep(self.threshold / 4)
+            beat = self.last_beat
+            # The heartbeat itself sleeps for half the threshold
+            lag = time.monotonic() - beat - self.threshold / 2
+            if lag < self.threshold:
+                continue
+
+            if blocked_beat != beat:
+                blocked_beat = beat
+                report = {
+                    "detected": datetime.now().isoformat(),
+                    "duration": lag,
+                    "stack": thread_stack(self.thread_id, SlowCallbackMonitor.STACK_LIMIT),
+                }
+                self.reports.append(report)
+            else:
+                report["duration"] = lag
+
+    def start(self):
+        # Must be called from the event loop thread
+        self.thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.running = True
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.heartbeat_task.cancel()
+
+    def report(self):
+        return sorted(self.reports, key=lambda r: r["duration"], reverse=True)
+
+
+class Profiler:
+    PROFILES_FOLDER = "profiles"
+    MODES = ("cprofile", "sampling")
+    MEMORY_TOP_STATS = 20
+    DEFAULT_SLOW_CALLBACK_S = 0.1
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.storage.create_dir(Profiler.PROFILES_FOLDER)
+        self.session = None
+        self.mode = None
+        self.slow_callbacks = None
+
+    def get_file(self, kind, extension):
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{kind}.{extension}"
+        return self.storage.get_path(Profiler.PROFILES_FOLDER, name)
+
+    def is_running(self):
+        return self.session is not None
+
+    def start(self, mode):
+        """Starts profiling the event loop thread. Must be called from it."""
+        if mode == "cprofile":
+            self.session = cProfile.Profile()
+        else:
+            self.session = SamplingProfiler(threading.get_ident())
+        self.mode = mode
+        self.session.enable()
+        log.info("Started %s profiling session", mode)
+
+    def stop(self):
+        """Stops the current session and returns the file its results were written to."""
+        self.session.disable()
+        if self.mode == "cprofile":
+            path = self.get_file("cprofile", "prof")
+        else:
+            path = self.get_file("sampling", "folded")
+        self.session.dump_stats(path)
+        self.session = None
+        log.info("Wrote %s profile to %s", self.mode, path)
+        return path
+
+    def memory_snapshot(self, stop=False):
+        """Returns the files of the snapshot and its top allocations, or None if tracing just started."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            log.info("Started tracing memory allocations")
+            return None
+
+        snapshot = tracemalloc.take_snapshot()
+        if stop:
+            tracemalloc.stop()
+
+        path = self.get_file("memory", "snapshot")
+        snapshot.dump(path)
+
+        top = [str(stat) for stat in snapshot.statistics("lineno")[:Profiler.MEMORY_TOP_STATS]]
+        top_path = self.get_file("memory", "txt")
+        with open(top_path, "w") as f:
+            f.write("\n".join(top) + "\n")
+
+        log.info("Wrote memory snapshot to %s", path)
+        return path, top
+
+    def slow_callbacks_report(self, threshold=None, stop=False):
+        """Starts monitoring if needed (or restarts it with a new threshold) and returns what was found."""
+        if stop:
+            if self.slow_callbacks is not None:
+                self.slow_callbacks.stop()
+            report = [] if self.slow_callbacks is None else self.slow_callbacks.report()
+            self.slow_callbacks = None
+            return report
+
+        if self.slow_callbacks is not None and threshold is not None \
+                and threshold != self.slow_callbacks.threshold:
+            self.slow_callbacks.stop()
+            self.slow_callbacks = None
+
+        if self.slow_callbacks is None:
+            self.slow_callbacks = SlowCallbackMonitor(
+                threshold if threshold is not None else Profiler.DEFAULT_SLOW_CALLBACK_S
+            )
+            self.slow_callbacks.start()
+
+        return self.slow_callbacks.report()
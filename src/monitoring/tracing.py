@@ -0,0 +1,142 @@
+"""Traces of the operations of a node, propagated to the peers it contacts."""
+import contextvars
+import functools
+import random as rnd
+import secrets
+import time
+from collections import deque
+from datetime import datetime
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class NoopSpan:
+    """Stands in for a span when the trace is not being recorded."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, key, value):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, trace_id, parent_id, sampled, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = secrets.token_hex(8)
+        self.sampled = sampled
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = datetime.now()
+        self.start_counter = time.perf_counter()
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start_counter
+        current_span.reset(self.token)
+        if exc is not None:
+            self.attributes["error"] = repr(exc)
+        if self.sampled:
+            self.tracer.record(self)
+        return False
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def context(self):
+        return {"trace-id": self.trace_id, "parent-id": self.span_id, "sampled": self.sampled}
+
+    def to_serializable(self):
+        return {
+            "name": self.name,
+            "trace-id": self.trace_id,
+            "span-id": self.span_id,
+            "parent-id": self.parent_id,
+            "node": self.tracer.node,
+            "start": self.start.isoformat(),
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    MAX_SPANS = 10000
+
+    def __init__(self):
+        self.node = None
+        self.sample_rate = 0.0
+        self.spans = deque(maxlen=Tracer.MAX_SPANS)
+
+    def trace(self, name, context=None, **attributes):
+        """Span for an entry point: continues the given or current trace, otherwise starts a new one."""
+        if context is not None:
+            try:
+                return Span(
+                    self, name, str(context["trace-id"]), context.get("parent-id"),
+                    bool(context.get("sampled")), attributes
+                )
+            except (KeyError, TypeError):
+                pass
+
+        parent = current_span.get()
+        if parent is not None:
+            return Span(self, name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+
+        # Unsampled traces still get an id, so it can be logged and propagated
+        sampled = self.sample_rate > 0 and rnd.random() < self.sample_rate
+        return Span(self, name, secrets.token_hex(16), None, sampled, attributes)
+
+    def span(self, name, **attributes):
+        """Span for an operation inside a recorded trace."""
+        parent = current_span.get()
+        if parent is None or not parent.sampled:
+            return NOOP_SPAN
+        return Span(self, name, parent.trace_id, parent.span_id, True, attributes)
+
+    def traced(self, name, entry_point=False):
+        """Decorator that records calls to a coroutine method as spans, with its positional arguments."""
+        def decorator(method):
+            @functools.wraps(method)
+            async def wrapper(instance, *args, **kwargs):
+                span = self.trace(name) if entry_point else self.span(name)
+                if span is not NOOP_SPAN and span.sampled:
+                    span.set("args", ", ".join(str(a) for a in args))
+                with span:
+                    return await method(instance, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def inject(self, data):
+        """Returns the data of a request with the current trace attached, if there is one."""
+        span = current_span.get()
+        if span is None:
+            return data
+        return {**data, "trace": span.context()}
+
+    @staticmethod
+    def current_trace_id():
+        span = current_span.get()
+        return None if span is None else span.trace_id
+
+    def record(self, span):
+        self.spans.append(span.to_serializable())
+
+    def dump(self, trace_id=None, clear=False):
+        spans = [s for s in self.spans if trace_id is None or s["trace-id"] == trace_id]
+        if clear:
+            self.spans.clear()
+        return spans
+
+
+# Shared by every connection and the node of this process
+tracer = Tracer()
@@ -1,16 +1,39 @@
 """Class for the node that runs the timeline service."""
 import asyncio
 import logging
+import multiprocessing
+import os
 import random as rnd
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from src.connection import (ErrorResponse, KademliaConnection, LocalConnection,
-                            OkResponse, PublicConnection, request)
+                            MetricsConnection, NotModifiedResponse, OkResponse, PublicConnection,
+                            StreamResponse, request, request_stream)
+from src.connection.breaker import CircuitBreakers
+from src.connection.deadline import deadline
+from src.data.archive import Archive
+from src.data.body_cache import BodyCache
+from src.data.disk_budget import DiskBudget
+from src.data.engines import STORAGE_ENGINES
+from src.data.feed import Feed
 from src.data.merged_timeline import MergedTimeline
 from src.data.next_post_id import NextPostId
-from src.data.storage import PersistentStorage
+from src.data.peer_scores import PeerScores
+from src.data.post_body import PostBody
+from src.data.search_index import SearchIndex
+from src.data.snapshot import Snapshot
+from src.data.storage_queue import StorageQueue
 from src.data.subscriptions import Subscriptions
 from src.data.timeline import Timeline
+from src.data.timeline_chunks import TimelineChunks
+from src.data.timeline_revision import TimelineRevision
 from src.data.user import User
+from src.monitoring.metrics import metrics
+from src.monitoring.profiler import Profiler
+from src.monitoring.tracing import tracer
+from src.worker import serve
 
 log = logging.getLogger("timeline")
 
@@ -23,12 +46,26 @@ class Node:
     DEFAULT_LOCAL_PORT = 8600
     TRY_ANOTHER_SUBSCRIBER_PROBABILITY = 0.75
     TRY_ANOTHER_SUBSCRIBER_PROBABILITY_DECAY = 0.5
+    MAX_BUSY_REPLICAS = 5
+    DEFAULT_MAX_SEARCH_RESULTS = 20
+    POOL_WORKERS = 4
+    DEFAULT_DHT_CHUNK_COUNT = 0
+    # Newest own posts kept in the timeline, older ones are archived a segment at a time
+    RECENT_POSTS = 200
+    # Longest the refresh of a cached timeline may take, so slow peers do not pile refreshes up
+    REFRESH_BUDGET_S = 60
+    # Changes to the snapshot made within this many seconds are published together
+    SNAPSHOT_DELAY_S = 0.5
 
-    def __init__(self, userid):
+    DEFAULT_STORAGE_ENGINE = "json"
+
+    def __init__(self, userid, storage_engine=DEFAULT_STORAGE_ENGINE, kademlia_connection=None, pool=None, storage_executor=None):
+        """The connection to the DHT and the pools can be shared with other nodes of the same process."""
         self.userid = User(userid)
+        tracer.node = str(self.userid)
 
         # Connections
-        self.kademlia_connection = KademliaConnection(self.userid)
+        self.kademlia_connection = KademliaConnection(self.userid) if kademlia_connection is None else kademlia_connection
         self.local_connection = LocalConnection(
             self.handle_get,
             self.handle_post,
@@ -36,90 +73,434 @@ class Node:
             self.handle_sub,
             self.handle_unsub,
             self.handle_view,
-            self.handle_people_i_may_know
+            self.handle_people_i_may_know,
+            self.handle_stats,
+            self.handle_profile_start,
+            self.handle_profile_stop,
+            self.handle_memory_snapshot,
+            self.handle_slow_callbacks,
+            self.handle_traces,
+            self.handle_search,
+            self.handle_batch,
+            self.handle_archive,
+            self.handle_get_post
         )
-        self.public_connection = PublicConnection(self.handle_public_get)
+        self.public_connection = PublicConnection(self.handle_public_get, self.get_replicas, self.handle_public_get_post)
+        # Sorting and encoding of large timelines happens here instead of in the loop
+        self.pool = ThreadPoolExecutor(max_workers=self.POOL_WORKERS, thread_name_prefix="work") if pool is None else pool
+        self.local_connection.executor = self.pool
+        self.public_connection.executor = self.pool
+        # Peers that stopped answering are not contacted until they are probed again
+        self.breakers = CircuitBreakers()
+        # (timeline userid, reader userid) -> when the reader last got that timeline from this node
+        self.replica_reads = {}
 
         # Storage
-        self.storage = PersistentStorage(self.userid)
+        self.storage_engine = storage_engine
+        self.storage = STORAGE_ENGINES[storage_engine](self.userid)
         self.storage.create_dir(Timeline.TIMELINES_FOLDER)
+        self.storage.create_dir(Archive.ARCHIVE_FOLDER)
+        self.storage.create_dir(PostBody.BODIES_FOLDER)
+        self.profiler = Profiler(self.storage)
+        self.storage_queue = StorageQueue(storage_executor)
 
+        # Only the index of the stored timelines is read now, their posts are read when needed
         try:
-            self.timeline = Timeline.read(self.storage, self.userid)
+            self.storage.timeline_exists(self.userid)
         except Exception as e:
-            log.error("Could not read timeline from storage.", e)
+            log.error("Could not read timeline index from storage: %s", e)
             exit(1)
+        self.own_timeline = None
+        # Built from the stored timelines on the first search, then kept up to date
+        self.search_index = None
+        self.search_builder = None
+        # Built from the stored timelines on the first view, then kept up to date
+        self.feed = None
+        # Timelines published for the public workers, if there are any
+        self.snapshot = None
+        self.snapshot_outdated = False
+
+        # Publishing of the newest posts in the DHT, disabled with no chunks
+        self.chunk_count = self.DEFAULT_DHT_CHUNK_COUNT
+        self.chunk_size = TimelineChunks.DEFAULT_CHUNK_SIZE
+        self.chunk_publisher = None
+        self.chunks_outdated = False
 
         try:
             self.subscriptions = Subscriptions.read(self.storage)
         except Exception as e:
-            log.error("Could not read subscriptions from storage.", e)
+            log.error("Could not read subscriptions from storage: %s", e)
             exit(1)
 
         try:
             self.next_post_id = NextPostId.read(self.storage)
         except Exception as e:
-            log.error("Could not read next post id from storage.", e)
+            log.error("Could not read next post id from storage: %s", e)
+            exit(1)
+
+        try:
+            self.timeline_revision = TimelineRevision.read(self.storage)
+        except Exception as e:
+            log.error("Could not read timeline revision from storage: %s", e)
             exit(1)
+        # Of the own timeline at its current revision, computed when first asked for
+        self.own_digest = None
+
+        try:
+            self.archive = Archive.read(self.storage)
+        except Exception as e:
+            log.error("Could not read archive index from storage: %s", e)
+            exit(1)
+        self.archiving = False
+
+        # Space taken by the timelines, unlimited unless started with a budget
+        self.disk_budget = DiskBudget(None)
+        self.budget_enforcer = None
+        self.budget_outdated = False
+
+        try:
+            self.body_cache = BodyCache.read(self.storage)
+        except Exception as e:
+            # The bodies are fetched again if needed, the ones left behind are not known anymore
+            log.error("Could not read body cache from storage: %s", e)
+            self.body_cache = BodyCache([])
+
+        try:
+            self.peer_scores = PeerScores.read(self.storage)
+        except Exception as e:
+            # Only a heuristic, so it can start over
+            log.error("Could not read peer scores from storage: %s", e)
+            self.peer_scores = PeerScores({})
+
+    @property
+    def timeline(self):
+        if self.own_timeline is None:
+            self.own_timeline = Timeline.read(self.storage, self.userid)
+        return self.own_timeline
+
+    async def search(self):
+        # Searches made while it is built wait for it, instead of using it half built
+        if self.search_builder is None:
+            self.search_builder = asyncio.create_task(self.build_search_index())
+        return await asyncio.shield(self.search_builder)
+
+    async def build_search_index(self):
+        # Assigned right away, so the changes made while it is built are applied to it
+        self.search_index = SearchIndex()
+        try:
+            self.search_index.set_posts(self.userid, self.timeline.posts)
+            for userid in list(self.subscriptions.subscriptions):
+                key = Timeline.get_file(userid)
+                if not await self.storage_queue.run(Timeline.exists, self.storage, userid, key=key):
+                    continue
+                timeline = await self.storage_queue.run(Timeline.read, self.storage, userid, key=key)
+                # Unless it changed while reading, then it is already newer
+                if userid in self.subscriptions.subscriptions and not self.search_index.has_timeline(userid):
+                    self.search_index.set_posts(userid, timeline.posts)
+        except BaseException:
+            # The next search tries again
+            self.search_index = None
+            self.search_builder = None
+            raise
+        return self.search_index
+
+    async def materialized_feed(self):
+        if self.feed is None:
+            self.feed = Feed()
+            self.feed.set_timeline(self.userid, self.timeline.posts)
+            for userid in self.subscriptions.subscriptions:
+                key = Timeline.get_file(userid)
+                metadata = await self.storage_queue.run(Timeline.read_metadata, self.storage, userid, key=key)
+                if metadata is None or not metadata.is_valid():
+                    continue
+                timeline = await self.storage_queue.run(Timeline.read, self.storage, userid, key=key)
+                # Unless it changed while reading, then it is already newer
+                if not self.feed.has_timeline(userid):
+                    self.feed.set_timeline(userid, timeline.posts, metadata.valid_until)
+        return self.feed
+
+    async def offload(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def cache_own_timeline(self, max_posts, *args):
+        # The posts as they are now, the timeline may change while the pool reads them
+        timeline = Timeline(self.userid, list(self.timeline.posts))
+        return await self.offload(timeline.cache, max_posts, *args)
+
+    def store_timeline(self, timeline):
+        data = timeline.to_serializable()
+        # The posts as they are now, the timeline may change before it is written
+        data["posts"] = list(data["posts"])
+        self.storage_queue.write(Timeline.get_file(timeline.userid), self.storage.write_timeline, timeline.userid, data)
+
+    def store_document(self, data, *paths):
+        """Queues the write of a small document, such as the subscriptions, as it is now."""
+        self.storage_queue.write(os.path.join(*paths), self.storage.write, data, *paths)
+
+    def delete_document(self, *paths):
+        self.storage_queue.write(os.path.join(*paths), self.storage.delete, *paths)
+
+    def delete_cached_timeline(self, userid):
+        self.storage_queue.write(Timeline.get_file(userid), self.storage.delete_timeline, userid)
+        self.disk_budget.removed(userid)
+        if self.search_index is not None:
+            self.search_index.remove_timeline(userid)
+        if self.feed is not None:
+            self.feed.remove_timeline(userid)
+        self.update_snapshot(userid, None)
 
+    def update_snapshot(self, userid, timeline):
+        """Publishes a changed timeline to the workers, or its removal if timeline is None."""
+        if self.snapshot is None:
+            return
+        if timeline is None:
+            self.snapshot.remove_timeline(userid)
+        else:
+            self.snapshot.set_timeline(timeline)
+        if userid == self.userid:
+            self.snapshot.revision, self.snapshot.digest = self.own_stamp()
+            self.snapshot.archived_posts = self.archive.total_posts()
+
+        # Changes made meanwhile are published together
+        if not self.snapshot_outdated:
+            self.snapshot_outdated = True
+            asyncio.get_running_loop().call_later(Node.SNAPSHOT_DELAY_S, self.publish_snapshot)
+
+    def update_snapshot_replicas(self):
+        self.snapshot.replicas = {
+            userid: [str(r) for r in self.get_replicas(User.from_str(userid), None)]
+            for userid in self.snapshot.timelines
+        }
+
+    def publish_snapshot(self):
+        self.snapshot_outdated = False
+        self.update_snapshot_replicas()
+        # Only copied on the loop, it is encoded and written on the storage thread
+        self.storage_queue.write(
+            Snapshot.SNAPSHOT_FILE, Snapshot.write, Snapshot.get_file(self.storage), self.snapshot.to_serializable()
+        )
+
+    def start_workers(self, count, admission):
+        self.snapshot = Snapshot(str(self.userid), self.time_to_live, {}, {})
+        self.snapshot.set_timeline(self.timeline)
+        self.snapshot.revision, self.snapshot.digest = self.own_stamp()
+        self.snapshot.archived_posts = self.archive.total_posts()
+        for userid in self.subscriptions.subscriptions:
+            metadata = Timeline.read_metadata(self.storage, userid)
+            if metadata is not None and metadata.is_valid():
+                self.snapshot.set_timeline(Timeline.read(self.storage, userid))
+        # Written before the workers start, so they always find one
+        self.update_snapshot_replicas()
+        try:
+            Snapshot.write(Snapshot.get_file(self.storage), self.snapshot.to_serializable())
+        except Exception as e:
+            log.error("Could not publish snapshot: %s", e)
+
+        # Spawned rather than forked, so workers do not inherit the running loop
+        context = multiprocessing.get_context("spawn")
+        for _ in range(count):
+            context.Process(
+                target=serve,
+                args=(
+                    str(self.userid), Snapshot.get_file(self.storage), self.storage_engine, admission, os.getpid(), log.level
+                ),
+                daemon=True,
+            ).start()
+        log.debug("Started %s public workers", count)
+
+    @tracer.traced("get-local")
     async def get_local(self, userid, max_posts):
         # get own timeline
         if userid == self.userid:
-            return self.timeline.cache(max_posts, self.time_to_live)
+            metrics.inc("local_timeline_total", result="own")
+            # Taken together with the posts, before the timeline can change
+            archived = self.archive.total_posts()
+            timeline = await self.cache_own_timeline(max_posts, self.time_to_live, *self.own_stamp())
+            timeline.total_posts += archived
+            return timeline
 
-        # get cached timeline
-        if Timeline.exists(self.storage, userid):
-            try:
-                timeline = Timeline.read(self.storage, userid)
-                if timeline.is_valid():
-                    return timeline.cache(max_posts)
-                else:
-                    Timeline.delete(self.storage, userid)
+        # get cached timeline, checking its validity before reading its posts
+        metadata = await self.storage_queue.run(
+            Timeline.read_metadata, self.storage, userid, key=Timeline.get_file(userid)
+        )
+        if metadata is not None:
+            if not metadata.is_valid():
+                metrics.inc("local_timeline_total", result="expired")
+                self.delete_cached_timeline(userid)
+                return None
 
+            try:
+                timeline = await self.storage_queue.run(
+                    Timeline.read, self.storage, userid, max_posts, key=Timeline.get_file(userid)
+                )
+                metrics.inc("local_timeline_total", result="hit")
+                self.disk_budget.read(userid)
+                return await self.offload(timeline.cache, max_posts)
             except Exception as e:
+                metrics.inc("local_timeline_total", result="error")
                 log.error("Could not read timeline from storage.", e)
+                return None
 
+        metrics.inc("local_timeline_total", result="miss")
         return None
 
+    @tracer.traced("get-peers")
     async def get_peers(
-        self, userid, max_posts, subscribers=None, last_updated_after=None
+        self, userid, max_posts, subscribers=None, last_updated_after=None, known_posts=None, stamp=None
     ):
+        """With the revision and digest of the timeline already stored here as stamp, peers that have
+        nothing newer answer that it was not modified, which is returned as a NotModifiedResponse."""
         # get timeline directly from owner
         data = {
             "command": "get-timeline",
             "userid": str(userid),
             "max-posts": max_posts,
+            "from": str(self.userid),
         }
+        if stamp is not None:
+            data["if-revision"], data["if-digest"] = stamp
+        # Hashes of the posts already stored here, which peers do not send again
+        if known_posts:
+            data["known-posts"] = list(known_posts)
+
+        def retry():
+            return self.get_peers(userid, max_posts, subscribers, last_updated_after, stamp=stamp)
 
         log.debug("Connecting to %s", userid)
 
-        try:
-            response = await request(data, userid.ip, userid.port)
-            if response["status"] == "ok":
-                return OkResponse({"timeline": response["timeline"]})
-        except Exception as e:
-            log.error("Could not connect to %s: %s", userid, e)
+        replicas = []
+        owner_timeline = None
+        start = time.perf_counter()
+        # While the owner is known to be down, its replicas are asked right away
+        if self.breakers.allow(userid):
+            try:
+                response = await request(data, userid.ip, userid.port, site="get-owner")
+                self.breakers.succeeded(userid)
+                if response["status"] == "ok":
+                    # The owner's timeline is always up to date
+                    self.peer_scores.observe(userid, latency=time.perf_counter() - start, staleness=0)
+                    owner_timeline = response["timeline"]
+                elif response["status"] == "not-modified":
+                    self.peer_scores.observe(userid, latency=time.perf_counter() - start, staleness=0)
+                    return NotModifiedResponse(response["last_updated"], response["valid_until"])
+                else:
+                    self.peer_scores.observe(userid, error=True)
+                    if response["status"] == "busy":
+                        # The owner is saturated and suggests subscribers that recently got the timeline from it
+                        replicas = [User.from_str(r) for r in response["replicas"]]
+                        log.debug("%s is busy, suggested replicas: %s", userid, response["replicas"])
+            except Exception as e:
+                self.breakers.failed(userid)
+                self.peer_scores.observe(userid, error=True)
+                log.error("Could not connect to %s: %s", userid, e)
+        else:
+            log.debug("Skipping %s, it is unreachable", userid)
+
+        if owner_timeline is not None:
+            return await self.fill_known_posts(owner_timeline, retry)
+
+        timeline = None
+        not_modified = None
+        if replicas:
+            timeline, not_modified = await self.get_from_subscribers(
+                data, self.peer_scores.rank(replicas), last_updated_after
+            )
 
         # get timeline from a subscriber
-        if subscribers is None:
-            subscribers = await self.kademlia_connection.get_subscribers(userid)
+        if timeline is None:
             if subscribers is None:
-                return ErrorResponse(f"No available source found.")
+                try:
+                    subscribers = await self.kademlia_connection.get_subscribers(userid)
+                except asyncio.TimeoutError:
+                    # The chunks may still be found if there is time left
+                    subscribers = []
+
+            subscribers = self.peer_scores.rank([s for s in subscribers if s not in replicas])
+            timeline, also_not_modified = await self.get_from_subscribers(
+                data, subscribers, last_updated_after
+            )
+            not_modified = Node.latest_not_modified(not_modified, also_not_modified)
+
+        # get timeline from the chunks the owner published in the DHT
+        if timeline is None and not_modified is None:
+            timeline = await self.get_from_chunks(userid, max_posts, last_updated_after)
+
+        if timeline:
+            return await self.fill_known_posts(timeline.to_serializable(), retry)
+        elif not_modified is not None:
+            return NotModifiedResponse(not_modified["last_updated"], not_modified["valid_until"])
+        else:
+            return ErrorResponse(f"No available source found.")
 
+    async def fill_known_posts(self, data, retry):
+        """The response with a timeline whose posts were only sent by hash, or what retry returns if one is
+        no longer stored here. The peer answered correctly, so it is not counted against it."""
+        # Only the posts the peer did not send are read
+        hashes = [post["hash"] for post in data["posts"] if "hash" in post]
+        try:
+            known_posts = {}
+            if hashes:
+                userid = User.from_str(data["userid"])
+                known_posts = await self.storage_queue.run(
+                    self.storage.read_posts, userid, hashes, key=Timeline.get_file(userid)
+                )
+            return OkResponse({"timeline": Timeline.fill_known_posts(data, known_posts)})
+        except Exception as e:
+            log.debug("Known post of %s is gone (%s), asking again without known posts", data["userid"], e)
+            return await retry()
+
+    @staticmethod
+    def latest_not_modified(first, second):
+        """The not modified answer that was last updated, of two that may be None."""
+        if first is None or second is None:
+            return first or second
+        return max(first, second, key=lambda response: datetime.fromisoformat(response["last_updated"]))
+
+    async def get_from_subscribers(self, data, subscribers, last_updated_after):
+        """Tries the subscribers in order, returning the freshest timeline found or None.
+
+        Also returns the latest answer that the timeline was not modified, or None.
+        """
         timeline = None
+        not_modified = None
         last_update_check = last_updated_after
         heuristic_probability = self.TRY_ANOTHER_SUBSCRIBER_PROBABILITY
-        rnd.shuffle(subscribers)
 
         for subscriber in subscribers:
-            if self.userid == subscriber:
+            if deadline.expired():
+                break
+            if self.userid == subscriber or not self.breakers.allow(subscriber):
                 continue
 
             log.debug("Connecting to subscriber %s", subscriber)
-            response = await request(data, subscriber.ip, subscriber.port)
+            start = time.perf_counter()
+            try:
+                response = await request(data, subscriber.ip, subscriber.port, site="get-subscriber")
+                self.breakers.succeeded(subscriber)
+            except Exception as e:
+                self.breakers.failed(subscriber)
+                self.peer_scores.observe(subscriber, error=True)
+                log.debug("Could not connect to subscriber %s: %s", subscriber, e)
+                continue
 
-            if response["status"] == "ok":
+            if response["status"] == "not-modified":
+                # Nothing newer than what is stored here, so like an outdated timeline
+                self.peer_scores.observe(
+                    subscriber,
+                    latency=time.perf_counter() - start,
+                    staleness=(datetime.now() - datetime.fromisoformat(response["last_updated"])).total_seconds(),
+                )
+                not_modified = Node.latest_not_modified(not_modified, response)
+                if rnd.random() >= heuristic_probability:
+                    break
+                heuristic_probability *= self.TRY_ANOTHER_SUBSCRIBER_PROBABILITY_DECAY
+            elif response["status"] == "ok":
                 response_timeline = Timeline.from_serializable(response["timeline"])
+                self.peer_scores.observe(
+                    subscriber,
+                    latency=time.perf_counter() - start,
+                    staleness=(datetime.now() - response_timeline.last_updated).total_seconds(),
+                )
                 if last_update_check and response_timeline.last_updated <= last_update_check:
                     if rnd.random() >= heuristic_probability:
                         break
@@ -128,56 +509,475 @@ class Node:
                     timeline = response_timeline
                     last_update_check = response_timeline.last_updated
             else:
+                self.peer_scores.observe(subscriber, error=True)
                 log.debug("Subscriber %s responded with error: %s", subscriber, response["error"])
-        
-        if timeline:
-            return OkResponse({"timeline": timeline.to_serializable()})
-        else:
-            return ErrorResponse(f"No available source found.")
-    
+
+        return timeline, not_modified
+
+    async def get_from_chunks(self, userid, max_posts, last_updated_after):
+        """Rebuilds the newest posts of a timeline from its chunks in the DHT, or returns None."""
+        try:
+            manifest = await self.kademlia_connection.get_chunk_manifest(userid)
+            if manifest is None:
+                metrics.inc("dht_chunk_fetches_total", result="none")
+                return None
+            if last_updated_after and datetime.fromisoformat(manifest["last_updated"]) <= last_updated_after:
+                metrics.inc("dht_chunk_fetches_total", result="outdated")
+                return None
+
+            count = TimelineChunks.chunks_needed(manifest, max_posts)
+            chunks = await self.kademlia_connection.get_chunks(userid, count)
+            timeline = TimelineChunks.join(userid, manifest, chunks, max_posts)
+            if timeline is None:
+                # Some reused chunks were older than the manifest
+                chunks = await self.kademlia_connection.get_chunks(userid, count, cached=False)
+                timeline = TimelineChunks.join(userid, manifest, chunks, max_posts)
+        except Exception as e:
+            log.debug("Could not get chunks of %s: %s", userid, e)
+            timeline = None
+
+        metrics.inc("dht_chunk_fetches_total", result="error" if timeline is None else "ok")
+        return timeline
+
+    def publish_chunks(self):
+        """Publishes the newest posts in the DHT, again after the current publishing if they changed meanwhile."""
+        if self.chunk_count == 0:
+            return
+        self.chunks_outdated = True
+        if self.chunk_publisher is None or self.chunk_publisher.done():
+            self.chunk_publisher = asyncio.create_task(self.publish_chunks_task())
+
+    async def publish_chunks_task(self):
+        # Not limited by the command that started it, each put is still bounded
+        with deadline.budget(None, detached=True):
+            await self.publish_outdated_chunks()
+
+    async def publish_outdated_chunks(self):
+        while self.chunks_outdated:
+            self.chunks_outdated = False
+            try:
+                manifest, chunks = TimelineChunks.split(
+                    self.timeline, self.chunk_size, self.chunk_count, self.time_to_live
+                )
+                await self.kademlia_connection.publish_chunks(manifest, chunks)
+                log.debug("Published %s posts in %s chunks", sum(manifest["chunks"]), len(chunks))
+            except Exception as e:
+                log.error("Could not publish chunks: %s", e)
+
     async def check_not_subscribed(self, userid):
+        with deadline.budget(self.REFRESH_BUDGET_S, detached=True):
+            try:
+                await self.unsubscribe_if_subscribed(userid)
+            except asyncio.TimeoutError:
+                log.debug("Timed out checking the subscription to %s", userid)
+
+    async def unsubscribe_if_subscribed(self, userid):
         subscribers = await self.kademlia_connection.get_subscribers(userid)
         if self.userid in subscribers:
             await self.kademlia_connection.unsubscribe(userid, [str(s) for s in subscribers])
 
-    async def handle_public_get(self, userid, max_posts):
+    def get_replicas(self, userid, requester):
+        """Subscribers of a timeline to send readers to when busy, the ones that got it from this node most recently first."""
+        replicas = [
+            s for s in self.kademlia_connection.get_cached_subscribers(userid)
+            if s != self.userid and str(s) != requester
+        ]
+        replicas.sort(key=lambda s: self.replica_reads.get((str(userid), str(s)), 0), reverse=True)
+        return replicas[:self.MAX_BUSY_REPLICAS]
+
+    async def handle_public_get(self, userid, max_posts, requester=None, known_posts=(), condition=None):
         if userid != self.userid and userid not in self.subscriptions.subscriptions:
             # This node is not subscribed, so it is strange to receive a request
             # Because of this, it will check the subscription value in the DHT
             asyncio.create_task(self.check_not_subscribed(userid))
             return ErrorResponse(f"Not locally available.")
 
+        if condition is not None:
+            # Checked before reading any posts
+            response = await self.check_not_modified(userid, condition)
+            if response is not None:
+                return response
+
         timeline = await self.get_local(userid, max_posts)
         if timeline is None:
             return ErrorResponse(f"Not locally available.")
-        return OkResponse({"timeline": timeline.to_serializable()})
+        # Only subscribers, so peers cannot grow it with any userid
+        if requester is not None and requester in {str(s) for s in self.kademlia_connection.get_cached_subscribers(userid)}:
+            self.replica_reads[(str(userid), requester)] = time.monotonic()
+
+        data = timeline.to_serializable()
+        if known_posts:
+            data = Timeline.strip_known_posts(data, known_posts)
+            metrics.inc("known_posts_skipped_total", sum("hash" in post for post in data["posts"]))
+        return OkResponse({"timeline": data})
 
-    async def handle_get(self, userid, max_posts):
+    async def check_not_modified(self, userid, condition):
+        """A NotModifiedResponse if the requester's revision and digest are current, or newer than the one here."""
+        if userid == self.userid:
+            if condition != self.own_stamp():
+                return None
+            now = datetime.now()
+            valid_until = None if self.time_to_live is None else now + timedelta(seconds=self.time_to_live)
+            return NotModifiedResponse(now.isoformat(), None if valid_until is None else valid_until.isoformat())
+
+        metadata = await self.storage_queue.run(
+            Timeline.read_metadata, self.storage, userid, key=Timeline.get_file(userid)
+        )
+        if metadata is None or not metadata.is_valid():
+            return None
+        if not metadata.is_current(*condition) and not metadata.is_older(condition[0]):
+            return None
+        return NotModifiedResponse(
+            metadata.last_updated.isoformat(),
+            None if metadata.valid_until is None else metadata.valid_until.isoformat(),
+        )
+
+    async def get_timeline(self, userid, max_posts):
         timeline = await self.get_local(userid, max_posts)
         if timeline is not None:
             return OkResponse({"timeline": timeline.to_serializable()})
-        response = await self.get_peers(userid, max_posts)
+        return await self.get_peers(userid, max_posts)
+
+    async def handle_get(self, userid, max_posts, stream=False):
+        # Asked for, so it is cached again if it was evicted
+        self.disk_budget.read(userid)
+        response = await self.get_timeline(userid, max_posts)
+
+        if stream and response.status == "ok":
+            return StreamResponse(self.stream_timeline(response.data["timeline"]))
         return response
 
+    async def stream_timeline(self, data):
+        # The metadata first, then one record per post
+        posts = data.pop("posts")
+        yield {"timeline": data}
+        for post in posts:
+            yield {"post": post}
+
+    async def own_post_body(self, post_id):
+        """The full content of an own post, archived or not, or None if there is no such post."""
+        post = self.timeline.get_post_by_id(post_id)
+        if post is None:
+            post = await self.read_archived_post(post_id)
+        if post is None:
+            return None
+        if not PostBody.is_truncated(post):
+            return post["content"]
+        key = PostBody.get_file(self.userid, post_id)
+        return await self.storage_queue.run(PostBody.read, self.storage, self.userid, post_id, key=key)
+
+    async def cached_post_body(self, userid, post_id):
+        """The full content of a post of another user fetched before, or None."""
+        key = PostBody.get_file(userid, post_id)
+        if not self.body_cache.touch(key):
+            return None
+        try:
+            return await self.storage_queue.run(PostBody.read, self.storage, userid, post_id, key=key)
+        except Exception as e:
+            log.debug("Could not read cached body of post %s of %s: %s", post_id, userid, e)
+            return None
+
+    def cache_post_body(self, userid, post_id, content):
+        key = PostBody.get_file(userid, post_id)
+        self.store_document({"content": content}, key)
+        for dropped in self.body_cache.add(key, len(content)):
+            self.delete_document(dropped)
+        self.store_document(self.body_cache.to_serializable(), BodyCache.BODY_CACHE_FILE)
+
+    async def handle_public_get_post(self, userid, post_id):
+        try:
+            if userid == self.userid:
+                content = await self.own_post_body(post_id)
+            else:
+                content = await self.cached_post_body(userid, post_id)
+        except Exception as e:
+            log.error("Could not read body of post %s of %s: %s", post_id, userid, e)
+            content = None
+
+        if content is None:
+            return ErrorResponse(f"Not locally available.")
+        return StreamResponse(PostBody.stream(content))
+
+    async def handle_get_post(self, userid, post_id):
+        if userid == self.userid:
+            try:
+                content = await self.own_post_body(post_id)
+            except Exception as e:
+                log.error("Could not read body of post %s: %s", post_id, e)
+                return ErrorResponse("Could not read post.")
+        else:
+            content = await self.cached_post_body(userid, post_id)
+            if content is None:
+                content = await self.fetch_post_body(userid, post_id, await self.cached_post(userid, post_id))
+                # Short ones are already whole in the cached timeline
+                if content is not None and len(content) > PostBody.PREVIEW_CHARS:
+                    self.cache_post_body(userid, post_id, content)
+
+        if content is None:
+            return ErrorResponse("Post not found.")
+        return OkResponse({"post-id": post_id, "content": content})
+
+    async def cached_post(self, userid, post_id):
+        """A post as in the cached timeline of its owner, with its preview and length, or None."""
+        key = Timeline.get_file(userid)
+        try:
+            if await self.storage_queue.run(Timeline.read_metadata, self.storage, userid, key=key) is None:
+                return None
+            timeline = await self.storage_queue.run(Timeline.read, self.storage, userid, key=key)
+        except Exception as e:
+            log.debug("Could not read cached timeline of %s: %s", userid, e)
+            return None
+        return timeline.get_post_by_id(post_id)
+
+    @tracer.traced("fetch-post")
+    async def fetch_post_body(self, userid, post_id, post=None):
+        """Fetches the full content of a post from its owner, or else from a subscriber that has it. None if none does.
+
+        Subscribers are only asked with the cached post, which what they send must match.
+        """
+        data = {"command": "get-post", "userid": str(userid), "post-id": post_id, "from": str(self.userid)}
+        peers = [userid]
+        if post is not None:
+            try:
+                peers += self.peer_scores.rank(await self.kademlia_connection.get_subscribers(userid))
+            except asyncio.TimeoutError:
+                pass
+
+        for peer in peers:
+            if deadline.expired():
+                break
+            if peer == self.userid or not self.breakers.allow(peer):
+                continue
+            try:
+                content = await deadline.bounded("get-post", Node.receive_post_body(data, peer))
+                self.breakers.succeeded(peer)
+            except Exception as e:
+                self.breakers.failed(peer)
+                log.debug("Could not get post %s of %s from %s: %s", post_id, userid, peer, e)
+                continue
+            if content is not None and post is not None and not PostBody.is_body_of(post, content):
+                log.debug("Post %s of %s from %s does not match the cached one", post_id, userid, peer)
+                continue
+            if content is not None:
+                metrics.inc("post_body_fetches_total", source="owner" if peer == userid else "subscriber")
+                return content
+
+        metrics.inc("post_body_fetches_total", source="none")
+        return None
+
+    @staticmethod
+    async def receive_post_body(data, peer):
+        """The body of a post streamed by a peer, or None if it does not have it."""
+        length = None
+        chunks = []
+        async for record in request_stream(data, peer.ip, peer.port):
+            if "length" in record:
+                length = record["length"]
+            elif "chunk" in record:
+                chunks.append(record["chunk"])
+            elif record["status"] != "ok":
+                return None
+
+        content = "".join(chunks)
+        if length is None or len(content) != length:
+            raise ConnectionError("Incomplete post body.")
+        return content
+
+    def add_own_post(self, content):
+        preview, length = PostBody.preview(content)
+        post = self.timeline.add_post(preview, self.next_post_id.get_and_advance(), length)
+        if length is not None:
+            self.store_document({"content": content}, PostBody.get_file(self.userid, post["id"]))
+        if self.search_index is not None:
+            self.search_index.add_post(self.userid, post)
+        if self.feed is not None:
+            self.feed.add_post(self.userid, post)
+        return post
+
+    def remove_own_post(self, post_id):
+        post = self.timeline.get_post_by_id(post_id)
+        if post is None or not self.timeline.remove_post(post):
+            return False
+        if PostBody.is_truncated(post):
+            self.delete_document(PostBody.get_file(self.userid, post_id))
+        if self.search_index is not None:
+            self.search_index.remove_post(self.userid, post_id)
+        if self.feed is not None:
+            self.feed.remove_post(self.userid, post_id)
+        return True
+
+    def own_timeline_changed(self):
+        """Stores and publishes the own timeline, once for any number of posts added or removed."""
+        self.timeline_revision.advance()
+        self.own_digest = None
+        self.store_document(self.timeline_revision.to_serializable(), TimelineRevision.TIMELINE_REVISION_FILE)
+        self.store_timeline(self.timeline)
+        self.update_snapshot(self.userid, self.timeline)
+        self.publish_chunks()
+        self.archive_if_needed()
+        if self.disk_budget.budget is not None:
+            self.update_own_usage()
+            self.enforce_disk_budget()
+
+    def own_stamp(self):
+        """The revision of the own timeline and the digest of its posts."""
+        if self.own_digest is None:
+            self.own_digest = self.timeline.digest()
+        return self.timeline_revision.revision, self.own_digest
+
+    def archive_if_needed(self):
+        if not self.archiving and len(self.timeline.posts) >= self.RECENT_POSTS + Archive.SEGMENT_POSTS:
+            self.archiving = True
+            asyncio.create_task(self.archive_old_posts())
+
+    async def archive_old_posts(self):
+        """Moves the oldest posts of the own timeline into archive segments while it keeps too many."""
+        try:
+            while len(self.timeline.posts) >= self.RECENT_POSTS + Archive.SEGMENT_POSTS:
+                posts = self.timeline.posts[:Archive.SEGMENT_POSTS]
+                name, data = self.archive.add_segment(self.userid, posts, DiskBudget.estimate(posts))
+                try:
+                    # Stored before the posts leave the timeline, so they are always somewhere
+                    await self.storage_queue.run(self.storage.write, data, Archive.get_segment_file(name))
+                    await self.storage_queue.run(
+                        self.storage.write, self.archive.to_serializable(), Archive.ARCHIVE_FILE, key=Archive.ARCHIVE_FILE
+                    )
+                except Exception as e:
+                    self.archive.segments.pop()
+                    log.error("Could not archive posts: %s", e)
+                    return
+
+                archived = {post["id"] for post in posts}
+                remaining = {post["id"] for post in self.timeline.posts}
+                self.timeline.posts = [post for post in self.timeline.posts if post["id"] not in archived]
+                # Posts removed while the segment was written are in it, so they are marked as removed
+                removed = archived - remaining
+                if removed:
+                    self.archive.removed.extend(sorted(removed))
+                    self.store_document(self.archive.to_serializable(), Archive.ARCHIVE_FILE)
+                for post in posts:
+                    if self.search_index is not None:
+                        self.search_index.remove_post(self.userid, post["id"])
+                    if self.feed is not None:
+                        self.feed.remove_post(self.userid, post["id"])
+                self.own_timeline_changed()
+                metrics.inc("archive_segments_total")
+                log.debug("Archived %s posts in %s", len(posts), name)
+        finally:
+            self.archiving = False
+
+    async def read_archived_post(self, post_id):
+        """An archived post that was not removed, or None."""
+        segment = self.archive.find_segment(post_id)
+        if segment is None or post_id in self.archive.removed:
+            return None
+        # A copy, the index changes on the loop while the segment is read
+        return await self.storage_queue.run(
+            Archive.read_post, self.storage, dict(segment), post_id, key=Archive.get_segment_file(segment["name"])
+        )
+
+    async def remove_archived_post(self, post_id):
+        post = await self.read_archived_post(post_id)
+        if post is None:
+            return False
+        if post_id in self.archive.removed:
+            # Removed by another command while it was read
+            return False
+        # Segments are never written again, the post is only hidden
+        self.archive.removed.append(post_id)
+        self.store_document(self.archive.to_serializable(), Archive.ARCHIVE_FILE)
+        # The total of posts changed, so subscribers must not be told it is not modified
+        self.timeline_revision.advance()
+        self.own_digest = None
+        self.store_document(self.timeline_revision.to_serializable(), TimelineRevision.TIMELINE_REVISION_FILE)
+        self.update_snapshot(self.userid, self.timeline)
+        if PostBody.is_truncated(post):
+            self.delete_document(PostBody.get_file(self.userid, post_id))
+        return True
+
+    def update_own_usage(self):
+        self.disk_budget.own = DiskBudget.estimate(self.timeline.posts) + self.archive.total_bytes()
+
+    def enforce_disk_budget(self):
+        """Trims and evicts cached timelines while over the disk budget, again after the current run if needed."""
+        if self.disk_budget.budget is None:
+            return
+        self.budget_outdated = True
+        if self.budget_enforcer is None or self.budget_enforcer.done():
+            self.budget_enforcer = asyncio.create_task(self.enforce_disk_budget_task())
+
+    async def enforce_disk_budget_task(self):
+        while self.budget_outdated:
+            self.budget_outdated = False
+            trims, evictions = self.disk_budget.plan()
+            for userid in evictions:
+                self.delete_cached_timeline(User.from_str(userid))
+                self.disk_budget.evict(userid)
+                metrics.inc("disk_budget_total", action="evicted")
+                log.debug("Evicted cached timeline of %s", userid)
+            for userid in trims:
+                try:
+                    await self.trim_cached_timeline(User.from_str(userid))
+                except Exception as e:
+                    log.error("Could not trim cached timeline of %s: %s", userid, e)
+
+    async def trim_cached_timeline(self, userid):
+        key = Timeline.get_file(userid)
+        metadata = await self.storage_queue.run(Timeline.read_metadata, self.storage, userid, key=key)
+        if metadata is None:
+            return
+        timeline = await self.storage_queue.run(Timeline.read, self.storage, userid, DiskBudget.TRIMMED_POSTS, key=key)
+        timeline = timeline.cache(DiskBudget.TRIMMED_POSTS)
+
+        self.store_timeline(timeline)
+        self.disk_budget.stored(userid, timeline.posts)
+        if self.search_index is not None:
+            self.search_index.set_posts(userid, timeline.posts)
+        if self.feed is not None and self.feed.has_timeline(userid):
+            self.feed.set_timeline(userid, timeline.posts, timeline.valid_until)
+        self.update_snapshot(userid, timeline)
+        metrics.inc("disk_budget_total", action="trimmed")
+        log.debug("Trimmed cached timeline of %s", userid)
+
+    async def load_disk_usage(self):
+        """Estimates the space taken by the stored timelines, to start enforcing the disk budget."""
+        self.update_own_usage()
+        for userid in list(self.subscriptions.subscriptions):
+            key = Timeline.get_file(userid)
+            try:
+                metadata = await self.storage_queue.run(Timeline.read_metadata, self.storage, userid, key=key)
+                if metadata is None:
+                    continue
+                timeline = await self.storage_queue.run(Timeline.read, self.storage, userid, key=key)
+            except Exception as e:
+                log.error("Could not read cached timeline of %s: %s", userid, e)
+                continue
+            # Unless stored again while reading, then it is already known
+            if str(userid) not in self.disk_budget.cached:
+                self.disk_budget.stored(userid, timeline.posts)
+        self.enforce_disk_budget()
+
     async def handle_post(self, content):
         post = None
         try:
-            post = self.timeline.add_post(content, self.next_post_id.get_and_advance())
-            self.timeline.store(self.storage)
-            self.next_post_id.store(self.storage)
+            post = self.add_own_post(content)
+            self.own_timeline_changed()
+            self.store_document(self.next_post_id.to_serializable(), NextPostId.NEXT_POST_ID_FILE)
             return OkResponse()
         except Exception as e:
             if post is not None:
-                self.timeline.remove_post(post)
+                self.remove_own_post(post["id"])
                 self.next_post_id.rollback()
             log.error("Could not post message.", e)
             return ErrorResponse("Could not post message.")
 
     async def handle_remove(self, post_id):
-        if not self.timeline.remove_post_by_id(post_id):
-            return ErrorResponse("Post not found.")
-        self.timeline.store(self.storage)
-        return OkResponse()
+        if self.remove_own_post(post_id):
+            self.own_timeline_changed()
+            return OkResponse()
+        if await self.remove_archived_post(post_id):
+            return OkResponse()
+        return ErrorResponse("Post not found.")
 
     async def handle_sub(self, userid):
         if userid == self.userid:
@@ -188,7 +988,8 @@ class Node:
         try:
             if not self.subscriptions.subscribe(userid):
                 return ErrorResponse("Already subscribed.")
-            self.subscriptions.store(self.storage)
+            self.disk_budget.read(userid)
+            self.store_document(self.subscriptions.to_serializable(), Subscriptions.SUBSCRIPTIONS_FILE)
             await self.kademlia_connection.subscribe(
                 userid, self.subscriptions.to_serializable()
             )
@@ -207,8 +1008,8 @@ class Node:
         try:
             if not self.subscriptions.unsubscribe(userid):
                 return ErrorResponse("Not subscribed.")
-            Timeline.delete(self.storage, userid)
-            self.subscriptions.store(self.storage)
+            self.delete_cached_timeline(userid)
+            self.store_document(self.subscriptions.to_serializable(), Subscriptions.SUBSCRIPTIONS_FILE)
             await self.kademlia_connection.unsubscribe(
                 userid, self.subscriptions.to_serializable()
             )
@@ -218,34 +1019,162 @@ class Node:
             log.error("Could not unsubscribe.", e)
             return ErrorResponse("Could not unsubscribe.")
 
-    async def handle_view(self, max_posts):
-        timelines = [self.timeline]
-        warnings = []
+    async def handle_batch(self, operations):
+        """Applies several operations in order, storing each changed file once and updating each DHT key once.
 
-        for subscription in self.subscriptions.subscriptions:
-            response = await self.handle_get(subscription, max_posts=None)
+        Invalid operations are given as an ErrorResponse. Returns the result of each operation.
+        """
+        results = []
+        posted = False
+        timeline_changed = False
+        subscriptions_backup = self.subscriptions.subscriptions.copy()
+        # userid -> whether it ends up subscribed, and the index and command of the operations that changed it
+        changes = {}
+
+        for operation in operations:
+            if isinstance(operation, ErrorResponse):
+                results.append(operation)
+                continue
+
+            command, argument = operation
+            if command == "post":
+                try:
+                    self.add_own_post(argument)
+                    posted = timeline_changed = True
+                    result = OkResponse()
+                except Exception as e:
+                    log.error("Could not post message: %s", e)
+                    result = ErrorResponse("Could not post message.")
+            elif command == "remove":
+                if self.remove_own_post(argument):
+                    timeline_changed = True
+                    result = OkResponse()
+                elif await self.remove_archived_post(argument):
+                    result = OkResponse()
+                else:
+                    result = ErrorResponse("Post not found.")
+            elif argument == self.userid:
+                result = ErrorResponse("Cannot subscribe to self." if command == "sub" else "Cannot unsubscribe from self.")
+            elif command == "sub":
+                if self.subscriptions.subscribe(argument):
+                    self.disk_budget.read(argument)
+                    result = OkResponse()
+                else:
+                    result = ErrorResponse("Already subscribed.")
+            elif self.subscriptions.unsubscribe(argument):
+                self.delete_cached_timeline(argument)
+                result = OkResponse()
+            else:
+                result = ErrorResponse("Not subscribed.")
 
+            if command in ("sub", "unsub") and result.status == "ok":
+                operations_changed = changes.get(argument, (None, []))[1]
+                operations_changed.append((len(results), command))
+                changes[argument] = (command == "sub", operations_changed)
+            metrics.inc("batch_operations_total", command=command, status=result.status)
+            results.append(result)
+
+        if timeline_changed:
+            self.own_timeline_changed()
+        if posted:
+            self.store_document(self.next_post_id.to_serializable(), NextPostId.NEXT_POST_ID_FILE)
+        if changes:
+            await self.apply_subscription_changes(changes, subscriptions_backup, results)
+
+        return OkResponse({"results": [result.to_dict() for result in results]})
+
+    async def apply_subscription_changes(self, changes, subscriptions_backup, results):
+        """Publishes the subscriptions changed by a batch, undoing the changes that could not be published."""
+        def fail(userid):
+            for index, command in changes[userid][1]:
+                results[index] = ErrorResponse("Could not subscribe." if command == "sub" else "Could not unsubscribe.")
+
+        # Subscribing and unsubscribing from the same user in a batch changes nothing
+        changed = {
+            userid: subscribed for userid, (subscribed, _) in changes.items()
+            if subscribed != (userid in subscriptions_backup)
+        }
+        self.store_document(self.subscriptions.to_serializable(), Subscriptions.SUBSCRIPTIONS_FILE)
+        try:
+            failed = await self.kademlia_connection.set_subscriptions(changed)
+            for userid in failed:
+                log.error("Could not update the subscribers of %s", userid)
+                if changed[userid]:
+                    self.subscriptions.unsubscribe(userid)
+                else:
+                    self.subscriptions.subscribe(userid)
+                fail(userid)
+            await self.kademlia_connection.publish_subscribed(self.subscriptions.to_serializable())
+        except Exception as e:
+            log.error("Could not publish subscriptions: %s", e)
+            self.subscriptions.subscriptions = subscriptions_backup
+            failed = list(changes)
+            for userid in changes:
+                fail(userid)
+        if failed:
+            self.store_document(self.subscriptions.to_serializable(), Subscriptions.SUBSCRIPTIONS_FILE)
+
+        for userid, subscribed in changed.items():
+            if subscribed and userid not in failed:
+                asyncio.create_task(self.update_cached_timeline(userid))
+
+    async def handle_view(self, max_posts, stream=False):
+        if stream:
+            return StreamResponse(self.stream_view(max_posts))
+
+        feed = await self.materialized_feed()
+        warnings = []
+
+        # Only the timelines that are missing or expired are looked up, as much of them as is cached
+        stale = feed.stale(self.subscriptions.subscriptions)
+        metrics.inc("feed_reads_total", result="stale" if stale else "fresh")
+        responses = await asyncio.gather(
+            *(self.get_timeline(subscription, self.max_cached_posts) for subscription in stale)
+        )
+        for subscription, response in zip(stale, responses):
             if response.status == "ok":
-                timelines.append(Timeline.from_serializable(response.data["timeline"]))
+                timeline = Timeline.from_serializable(response.data["timeline"])
+                feed.set_timeline(subscription, timeline.posts, timeline.valid_until)
             else:
+                feed.remove_timeline(subscription)
                 warnings.append({"message": response.data["error"], "subscription": str(subscription)})
 
         return OkResponse(
             {
-                "timeline": MergedTimeline.from_timelines(
-                    timelines, max_posts
-                ).to_serializable(),
+                "timeline": MergedTimeline(feed.read(max_posts)).to_serializable(),
                 "warnings": warnings,
             }
         )
 
+    async def stream_view(self, max_posts):
+        """Posts of each timeline of the feed as soon as it is found, with warnings as they happen.
+
+        Timelines are looked up concurrently, so each is sorted but the feed as a whole is not.
+        """
+        own = await self.cache_own_timeline(max_posts)
+        for post in own.posts:
+            yield {"post": {**post, "userid": str(self.userid)}}
+
+        async def get(subscription):
+            return subscription, await self.get_timeline(subscription, max_posts)
+
+        for lookup in asyncio.as_completed([get(s) for s in self.subscriptions.subscriptions]):
+            subscription, response = await lookup
+            if response.status != "ok":
+                yield {"warning": {"message": response.data["error"], "subscription": str(subscription)}}
+                continue
+            for post in response.data["timeline"]["posts"]:
+                yield {"post": {**post, "userid": str(subscription)}}
+
     async def handle_people_i_may_know(self, max_users):
         suggestions = set()
         subscribed_by = {}
 
-        for subscription in self.subscriptions.to_serializable():
-            current_subscriptions = await self.kademlia_connection.get_subscribed(subscription)
+        subscribed = await self.kademlia_connection.get_subscribed_many(
+            self.subscriptions.to_serializable()
+        )
 
+        for subscription, current_subscriptions in subscribed.items():
             for sub in current_subscriptions:
                 if sub == self.userid:
                     continue
@@ -270,51 +1199,208 @@ class Node:
 
         return OkResponse(response)
 
+    async def handle_stats(self, format):
+        if format == "prometheus":
+            return OkResponse({"text": metrics.to_prometheus()})
+        return OkResponse({"stats": metrics.to_serializable()})
+
+    async def handle_profile_start(self, mode):
+        if self.profiler.is_running():
+            return ErrorResponse("A profiling session is already running.")
+        self.profiler.start(mode)
+        return OkResponse()
+
+    async def handle_profile_stop(self):
+        if not self.profiler.is_running():
+            return ErrorResponse("No profiling session is running.")
+        try:
+            return OkResponse({"file": self.profiler.stop()})
+        except Exception as e:
+            log.error("Could not write profile: %s", e)
+            return ErrorResponse("Could not write profile.")
+
+    async def handle_memory_snapshot(self, stop):
+        try:
+            snapshot = self.profiler.memory_snapshot(stop)
+        except Exception as e:
+            log.error("Could not write memory snapshot: %s", e)
+            return ErrorResponse("Could not write memory snapshot.")
+        if snapshot is None:
+            return OkResponse({"file": None, "top": []})
+        path, top = snapshot
+        return OkResponse({"file": path, "top": top})
+
+    async def handle_slow_callbacks(self, threshold, stop):
+        return OkResponse({"callbacks": self.profiler.slow_callbacks_report(threshold, stop)})
+
+    async def handle_traces(self, trace_id, clear):
+        return OkResponse({"node": str(self.userid), "spans": tracer.dump(trace_id, clear)})
+
+    async def handle_archive(self, page):
+        pages = self.archive.pages()
+        if pages == 0:
+            return OkResponse({"timeline": Timeline(self.userid, []).to_serializable(), "page": page, "pages": 0})
+        if page > pages:
+            return ErrorResponse(f"Page out of range, the archive has {pages} pages.")
+
+        # Copies, the index changes on the loop while the segment is read
+        segment = dict(self.archive.get_page(page))
+        posts = await self.storage_queue.run(
+            Archive.read_segment, self.storage, segment, set(self.archive.removed), key=Archive.get_segment_file(segment["name"])
+        )
+        return OkResponse({"timeline": Timeline(self.userid, posts).to_serializable(), "page": page, "pages": pages})
+
+    async def handle_search(self, query, max_results, page):
+        if max_results is None:
+            max_results = self.DEFAULT_MAX_SEARCH_RESULTS
+        try:
+            posts, more = (await self.search()).search(query, max_results, page)
+        except Exception as e:
+            log.error("Could not search timelines: %s", e)
+            return ErrorResponse("Could not search timelines.")
+        return OkResponse({"timeline": MergedTimeline(posts).to_serializable(), "page": page, "more": more})
+
+    @tracer.traced("refresh", entry_point=True)
     async def update_cached_timeline(self, userid):
+        # Its own budget, also when started by a command that is done long before
+        with deadline.budget(self.REFRESH_BUDGET_S, detached=True):
+            try:
+                await self.refresh_cached_timeline(userid)
+            except asyncio.TimeoutError:
+                metrics.inc("cache_refresh_total", result="timeout")
+                log.debug("Timed out refreshing cached timeline for %s", userid)
+
+    async def refresh_cached_timeline(self, userid):
         subscribers = await self.kademlia_connection.get_subscribers(userid)
+        # Otherwise the key is republished with the others close to expiring, once per period
         if self.userid not in subscribers:
             await self.kademlia_connection.subscribe(userid, [str(s) for s in subscribers])
-        else:
-            await self.kademlia_connection.republish(userid)
 
         last_updated = None
-        if Timeline.exists(self.storage, userid):
-            try:
-                timeline = Timeline.read(self.storage, userid)
-                if timeline.is_valid():
-                    last_updated = timeline.last_updated
-                else:
-                    Timeline.delete(self.storage, userid)
-            except Exception as e:
-                log.debug("Could not read cached timeline for %s: %s", userid, e)
+        known_posts = []
+        stamp = None
+        metadata = await self.storage_queue.run(
+            Timeline.read_metadata, self.storage, userid, key=Timeline.get_file(userid)
+        )
+        if metadata is not None:
+            if metadata.is_valid():
+                last_updated = metadata.last_updated
+                if metadata.revision is not None:
+                    stamp = (metadata.revision, metadata.digest)
+                # Only the hashes, the posts peers do not send again are read once they answer
+                try:
+                    known_posts = await self.storage_queue.run(
+                        self.storage.timeline_post_hashes, userid, key=Timeline.get_file(userid)
+                    )
+                except Exception as e:
+                    log.debug("Could not read cached timeline for %s: %s", userid, e)
+            else:
+                self.delete_cached_timeline(userid)
         
         response = await self.get_peers(
             userid,
             self.max_cached_posts,
             subscribers=subscribers,
             last_updated_after=last_updated,
+            known_posts=known_posts,
+            stamp=stamp,
         )
 
-        if response.status == "ok":
+        if response.status == "not-modified":
+            # Only valid for longer, if the answer is more recent than what is stored
+            response_updated = datetime.fromisoformat(response.data["last_updated"])
+            if metadata is not None and response_updated > metadata.last_updated:
+                valid_until = response.data["valid_until"]
+                valid_until = None if valid_until is None else datetime.fromisoformat(valid_until)
+                # The posts stay as they are, so they are not read nor written again
+                try:
+                    await self.storage_queue.run(
+                        self.storage.update_timeline_validity, userid,
+                        response.data["last_updated"], response.data["valid_until"], key=Timeline.get_file(userid)
+                    )
+                except Exception as e:
+                    log.debug("Could not extend cached timeline for %s: %s", userid, e)
+                if self.feed is not None and userid in self.subscriptions.subscriptions:
+                    self.feed.set_valid_until(userid, valid_until)
+                published = None if self.snapshot is None else self.snapshot.timelines.get(str(userid))
+                if published is not None:
+                    published.last_updated = response_updated
+                    published.valid_until = valid_until
+                    self.update_snapshot(userid, published)
+            metrics.inc("cache_refresh_total", result="not-modified")
+            log.debug("Cached timeline for %s was not modified", userid)
+        elif response.status == "ok":
             try:
-                Timeline.from_serializable(response.data["timeline"]).store(
-                    self.storage
-                )
+                timeline = Timeline.from_serializable(response.data["timeline"])
+                self.store_timeline(timeline)
+                self.disk_budget.stored(userid, timeline.posts)
+                if self.search_index is not None:
+                    self.search_index.set_posts(userid, timeline.posts)
+                # Not if it was unsubscribed meanwhile, the feed only has the current subscriptions
+                if self.feed is not None and userid in self.subscriptions.subscriptions:
+                    self.feed.set_timeline(userid, timeline.posts, timeline.valid_until)
+                self.update_snapshot(userid, timeline)
+                metrics.inc("cache_refresh_total", result="updated")
                 log.debug("Updated cached timeline for %s", userid)
+                self.enforce_disk_budget()
             except Exception as e:
+                metrics.inc("cache_refresh_total", result="store-error")
                 log.debug("Could not update cached timeline for %s: %s", userid, e)
+        else:
+            metrics.inc("cache_refresh_total", result="no-source")
 
     async def run(
-        self, port, bootstrap_nodes, local_port, cache_frequency, time_to_live, max_cached_posts
+        self, port, bootstrap_nodes, local_port, cache_frequency, time_to_live, max_cached_posts,
+        metrics_port=None, trace_sample_rate=0.0, admission=None,
+        dht_chunk_count=DEFAULT_DHT_CHUNK_COUNT, dht_chunk_size=TimelineChunks.DEFAULT_CHUNK_SIZE,
+        public_workers=0, disk_budget=None
     ):
         await self.kademlia_connection.start(port, bootstrap_nodes)
-        asyncio.create_task(self.local_connection.start(local_port))
-        asyncio.create_task(self.public_connection.start(self.userid))
+        self.start(
+            local_port, time_to_live, max_cached_posts, metrics_port, trace_sample_rate, admission,
+            dht_chunk_count, dht_chunk_size, public_workers, disk_budget
+        )
+
+        while True:
+            self.refresh()
+            await asyncio.sleep(cache_frequency)
 
+    def start(
+        self, local_port, time_to_live, max_cached_posts,
+        metrics_port=None, trace_sample_rate=0.0, admission=None,
+        dht_chunk_count=DEFAULT_DHT_CHUNK_COUNT, dht_chunk_size=TimelineChunks.DEFAULT_CHUNK_SIZE,
+        public_workers=0, disk_budget=None
+    ):
+        """Starts serving, once connected to the DHT. Without a local port, local commands reach it through a host."""
         self.max_cached_posts = max_cached_posts
         self.time_to_live = time_to_live
 
-        while True:
-            for subscription in self.subscriptions.subscriptions:
+        self.public_connection.admission = admission
+        if local_port is not None:
+            asyncio.create_task(self.local_connection.start(local_port))
+        asyncio.create_task(self.public_connection.start(self.userid, reuse_port=public_workers > 0))
+        if public_workers > 0:
+            self.start_workers(public_workers, admission)
+        if metrics_port is not None:
+            asyncio.create_task(MetricsConnection().start(metrics_port))
+
+        tracer.sample_rate = trace_sample_rate
+        self.chunk_count = dht_chunk_count
+        self.chunk_size = dht_chunk_size
+        self.publish_chunks()
+        self.kademlia_connection.track_subscriptions(self.subscriptions.subscriptions)
+        self.archive_if_needed()
+        if disk_budget is not None:
+            self.disk_budget.budget = disk_budget
+            asyncio.create_task(self.load_disk_usage())
+
+    def refresh(self):
+        """Starts a caching period, refreshing the cached timeline of every subscription."""
+        # Keeps the subscribers of this node's timeline known, to suggest them when busy
+        asyncio.create_task(self.kademlia_connection.get_subscribers(self.userid))
+        asyncio.create_task(self.kademlia_connection.republish_due())
+        self.store_document(self.peer_scores.to_serializable(), PeerScores.PEER_SCORES_FILE)
+        for subscription in self.subscriptions.subscriptions:
+            # Evicted timelines are cached again once read
+            if not self.disk_budget.is_evicted(subscription):
                 asyncio.create_task(self.update_cached_timeline(subscription))
-            await asyncio.sleep(cache_frequency)
@@ -1,16 +1,33 @@
 """Operations made to the node via a local socket."""
+import asyncio
+import json
 import logging
+import math
 from tabulate import tabulate
 
-from src.connection import request
+from datetime import datetime
+
+from src.connection import request, request_stream
 from src.data.merged_timeline import MergedTimeline
-from src.data.timeline import TimelineCache
+from src.data.post_body import PostBody
+from src.data.timeline import Timeline, TimelineCache
 from src.data.user import User
+from src.monitoring.capture import TrafficCapture
 
 log = logging.getLogger("timeline")
 
+# The user to act as, when the node at the local port hosts several
+local_user = None
+
+
+def act_as(userid):
+    global local_user
+    local_user = str(userid)
+
 
 async def execute(data, local_port):
+    if local_user is not None:
+        data["as"] = local_user
     log.debug("Connecting to local server on port %s", local_port)
     response = await request(data, "127.0.0.1", local_port)
 
@@ -19,11 +36,41 @@ async def execute(data, local_port):
     return response
 
 
-async def get(userid, local_port, max_posts=None):
+async def execute_stream(data, local_port):
+    """Yields the records of a streamed response, printing the error if it ends with one."""
+    if local_user is not None:
+        data["as"] = local_user
+    log.debug("Connecting to local server on port %s", local_port)
+    async for record in request_stream(data, "127.0.0.1", local_port):
+        if "status" in record:
+            if record["status"] != "ok":
+                print(f"Error: {record['error']}")
+            return
+        yield record
+
+
+def print_row(first, time, content):
+    # Fixed widths, since rows are printed before the rest are known
+    print(f"{str(first):<21}  {time:<19}  {content}".rstrip(), flush=True)
+
+
+def post_time(post):
+    return datetime.fromisoformat(post["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+
+
+async def get(userid, local_port, max_posts=None, stream=False):
     userid = User(userid)
-    response = await execute(
-        {"command": "get", "userid": str(userid), "max-posts": max_posts}, local_port
-    )
+    data = {"command": "get", "userid": str(userid), "max-posts": max_posts}
+    if stream:
+        data["stream"] = True
+        async for record in execute_stream(data, local_port):
+            if "timeline" in record:
+                print_row("id", "time", "content")
+            elif "post" in record:
+                print_row(record["post"]["id"], post_time(record["post"]), PostBody.listing(record["post"]))
+        return
+
+    response = await execute(data, local_port)
 
     if response["status"] == "ok":
         print(TimelineCache.from_serializable(response["timeline"]).pretty_str())
@@ -38,6 +85,14 @@ async def post(filepath, local_port):
         print("Successfully posted to the timeline.")
 
 
+async def get_post(userid, post_id, local_port):
+    userid = User(userid)
+    response = await execute({"command": "get-post", "userid": str(userid), "post-id": post_id}, local_port)
+
+    if response["status"] == "ok":
+        print(response["content"])
+
+
 async def remove(post_id, local_port):
     response = await execute({"command": "remove", "post-id": post_id}, local_port)
 
@@ -61,7 +116,17 @@ async def unsub(userid, local_port):
         print(f"Successfully unsubscribed from {userid}.")
 
 
-async def view(local_port, max_posts=None):
+async def view(local_port, max_posts=None, stream=False):
+    if stream:
+        print_row("userid", "time", "content")
+        async for record in execute_stream({"command": "view", "max-posts": max_posts, "stream": True}, local_port):
+            if "post" in record:
+                print_row(record["post"]["userid"], post_time(record["post"]), PostBody.listing(record["post"]))
+            else:
+                warning = record["warning"]
+                print(f"Warning: Could not get posts from user {warning['subscription']}: {warning['message']}", flush=True)
+        return
+
     response = await execute({"command": "view", "max-posts": max_posts}, local_port)
 
     if response["status"] == "ok":
@@ -86,3 +151,204 @@ async def people_i_may_know(local_port, max_users=None):
 
         tabledata = [table_row(post) for post in response["users"]]
         print(tabulate(tabledata, headers=["userid", "subscribed by"]))
+
+
+async def stats(local_port, prometheus=False):
+    response = await execute(
+        {"command": "stats", "format": "prometheus" if prometheus else "json"}, local_port
+    )
+
+    if response["status"] == "ok":
+        if prometheus:
+            print(response["text"], end="")
+            return
+
+        def labels_str(labels):
+            return ", ".join(f"{k}={v}" for k, v in labels.items())
+
+        counters = [
+            [c["name"], labels_str(c["labels"]), c["value"]]
+            for c in response["stats"]["counters"]
+        ]
+        print(tabulate(counters, headers=["counter", "labels", "value"]))
+        print()
+
+        def ms(value):
+            return "inf" if value is None else f"{value * 1000:g}"
+
+        histograms = [
+            [h["name"], labels_str(h["labels"]), h["count"],
+             f"{h['sum'] / h['count'] * 1000:.2f}" if h["count"] else "0",
+             ms(h["p50"]), ms(h["p90"]), ms(h["p99"])]
+            for h in response["stats"]["histograms"]
+        ]
+        print(tabulate(histograms, headers=["histogram", "labels", "count", "avg (ms)", "p50 (ms)", "p90 (ms)", "p99 (ms)"]))
+
+
+async def profile(action, local_port, mode="cprofile"):
+    if action == "start":
+        response = await execute({"command": "profile-start", "mode": mode}, local_port)
+        if response["status"] == "ok":
+            print(f"Started {mode} profiling session.")
+    else:
+        response = await execute({"command": "profile-stop"}, local_port)
+        if response["status"] == "ok":
+            print(f"Profile written to {response['file']}")
+
+
+async def memory_snapshot(local_port, stop=False):
+    response = await execute({"command": "memory-snapshot", "stop": stop}, local_port)
+
+    if response["status"] == "ok":
+        if response["file"] is None:
+            print("Started tracing memory allocations. Take another snapshot later to see them.")
+            return
+        for line in response["top"]:
+            print(line)
+        print(f"Snapshot written to {response['file']}")
+
+
+async def slow_callbacks(local_port, threshold=None, stop=False):
+    response = await execute(
+        {"command": "slow-callbacks", "threshold": threshold, "stop": stop}, local_port
+    )
+
+    if response["status"] == "ok":
+        if not response["callbacks"]:
+            print("No slow callbacks detected." if stop else "Monitoring slow callbacks. No slow callbacks detected yet.")
+        for callback in response["callbacks"]:
+            print(f"{callback['detected']}: blocked the loop for at least {callback['duration'] * 1000:.0f} ms")
+            for frame in callback["stack"]:
+                print(f"    {frame}")
+
+
+async def traces(local_port, trace_id=None, output=None, clear=False):
+    response = await execute(
+        {"command": "traces", "trace-id": trace_id, "clear": clear}, local_port
+    )
+
+    if response["status"] == "ok":
+        dump = json.dumps({"node": response["node"], "spans": response["spans"]}, indent=2)
+        if output is None:
+            print(dump)
+        else:
+            with open(output, "w") as f:
+                f.write(dump)
+            print(f"Wrote {len(response['spans'])} spans to {output}")
+
+
+async def search(query, local_port, max_results=None, page=1):
+    response = await execute(
+        {"command": "search", "query": query, "max-results": max_results, "page": page}, local_port
+    )
+
+    if response["status"] == "ok":
+        print(MergedTimeline.from_serializable(response["timeline"]).pretty_str())
+        if response["more"]:
+            print()
+            print(f"There are more results, see them with --page {page + 1}.")
+
+
+async def archive(local_port, page=1):
+    response = await execute({"command": "archive", "page": page}, local_port)
+
+    if response["status"] == "ok":
+        if response["pages"] == 0:
+            print("No posts were archived yet.")
+            return
+        print(Timeline.from_serializable(response["timeline"]).pretty_str())
+        if page < response["pages"]:
+            print()
+            print(f"There are older posts, see them with archive {page + 1}.")
+
+
+async def batch(filepath, local_port):
+    with open(filepath, "r") as f:
+        operations = json.load(f)
+    response = await execute({"command": "batch", "operations": operations}, local_port)
+
+    if response["status"] == "ok":
+        def table_row(i, operation, result):
+            command = operation.get("command") if isinstance(operation, dict) else None
+            return [i, command, "ok" if result["status"] == "ok" else result["error"]]
+
+        tabledata = [
+            table_row(i, operation, result)
+            for i, (operation, result) in enumerate(zip(operations, response["results"]))
+        ]
+        print(tabulate(tabledata, headers=["#", "command", "result"]))
+        failed = sum(result["status"] != "ok" for result in response["results"])
+        print()
+        print(f"Applied {len(operations) - failed} of {len(operations)} operations.")
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+async def replay(filepath, ip, port, speed=1.0, concurrency=8, connection="local"):
+    """Sends the commands of a capture to a node, at the pace they were captured scaled by speed.
+
+    With speed 0 they are sent as fast as possible. Otherwise latency is
+    measured from when each command was due, so it includes any wait for
+    the concurrency limit.
+    """
+    records = [record for record in TrafficCapture.read(filepath) if record["connection"] == connection]
+    if not records:
+        print(f"No {connection} commands were captured in {filepath}.")
+        return
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = {}
+    errors = {}
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def send(record):
+        command = str(record["message"].get("command"))
+        async with semaphore:
+            sent = loop.time()
+            status = "error"
+            try:
+                async for response in request_stream(record["message"], ip, port):
+                    status = response.get("status", status)
+            except Exception as e:
+                log.debug("Replayed command %s failed: %s", command, e)
+            done = loop.time()
+
+        due = start + (record["time"] - records[0]["time"]) / speed if speed > 0 else sent
+        latencies.setdefault(command, []).append(done - due)
+        # Answers that did not come back as they were captured, a not-modified is as good as an ok
+        if status == "error" and record["status"] != "error":
+            errors[command] = errors.get(command, 0) + 1
+
+    tasks = []
+    pending = set()
+    for record in records:
+        if speed > 0:
+            delay = start + (record["time"] - records[0]["time"]) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif len(pending) >= concurrency:
+            # Do not create more tasks than can be sent at once
+            await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.create_task(send(record))
+        tasks.append(task)
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - start
+
+    def table_row(command, values, failed):
+        values = sorted(values)
+        return [command, len(values), failed] + [
+            round(value * 1000, 1)
+            for value in (percentile(values, 0.5), percentile(values, 0.9), percentile(values, 0.99), values[-1])
+        ]
+
+    tabledata = [table_row(command, values, errors.get(command, 0)) for command, values in sorted(latencies.items())]
+    tabledata.append(table_row("all", [value for values in latencies.values() for value in values], sum(errors.values())))
+    print(tabulate(tabledata, headers=["command", "count", "errors", "p50 ms", "p90 ms", "p99 ms", "max ms"]))
+    print()
+    print(f"Replayed {len(records)} commands in {elapsed:.2f}s ({len(records) / elapsed:.1f}/s) at speed {speed}.")
@@ -49,6 +49,24 @@ class PositiveIntegerValidator:
             raise ValueError
         return i
 
+class PositiveFloatValidator:
+    @staticmethod
+    def positive_float(s):
+        """Validates and parses a positive float."""
+        f = float(s)
+        if f <= 0:
+            raise ValueError
+        return f
+
+class FractionValidator:
+    @staticmethod
+    def fraction(s):
+        """Validates and parses a float between 0 and 1."""
+        f = float(s)
+        if f < 0 or f > 1:
+            raise ValueError
+        return f
+
 class NonNegativeIntegerValidator:
     @staticmethod
     def non_negative_integer(s):
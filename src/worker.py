@@ -0,0 +1,133 @@
+"""Worker process that serves the public endpoint of a node from the snapshots the node publishes.
+
+Workers share the public port with the node, so the kernel spreads the
+requests of other nodes among them. The node stays the only one writing
+timelines.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from src.connection import ErrorResponse, NotModifiedResponse, OkResponse, PublicConnection, StreamResponse
+from src.data.archive import Archive
+from src.data.engines import STORAGE_ENGINES
+from src.data.post_body import PostBody
+from src.data.snapshot import Snapshot
+from src.data.timeline import Timeline
+from src.data.user import User
+
+log = logging.getLogger("timeline")
+
+
+class PublicWorker:
+    PARENT_CHECK_INTERVAL_S = 1
+
+    def __init__(self, userid, snapshot_file, storage_engine, admission):
+        self.userid = User.from_str(userid)
+        self.snapshot_file = snapshot_file
+        self.snapshot = None
+        self.snapshot_mtime = None
+        # Only read from, for the bodies of posts, opened on the first one asked for
+        self.storage_engine = storage_engine
+        self.storage = None
+
+        self.public_connection = PublicConnection(self.handle_public_get, self.get_replicas, self.handle_public_get_post)
+        self.public_connection.admission = admission
+
+    def current_snapshot(self):
+        """The latest published snapshot, read again only when the node replaced it."""
+        mtime = os.stat(self.snapshot_file).st_mtime_ns
+        if mtime != self.snapshot_mtime:
+            self.snapshot = Snapshot.read(self.snapshot_file)
+            self.snapshot_mtime = mtime
+            log.debug("Loaded snapshot with %s timelines", len(self.snapshot.timelines))
+        return self.snapshot
+
+    def get_replicas(self, userid, requester):
+        replicas = self.current_snapshot().replicas.get(str(userid), [])
+        return [User.from_str(r) for r in replicas if r != requester]
+
+    async def handle_public_get(self, userid, max_posts, requester=None, known_posts=(), condition=None):
+        try:
+            snapshot = self.current_snapshot()
+        except Exception as e:
+            log.error("Could not read snapshot: %s", e)
+            return ErrorResponse(f"Not locally available.")
+
+        data = snapshot.timelines.get(str(userid))
+        if data is None:
+            return ErrorResponse(f"Not locally available.")
+
+        # Same as Node.get_local, but with the timelines of the snapshot
+        timeline = Timeline.from_serializable(dict(data))
+        if userid == self.userid:
+            if condition == (snapshot.revision, snapshot.digest):
+                now = datetime.now()
+                valid_until = None if snapshot.time_to_live is None else now + timedelta(seconds=snapshot.time_to_live)
+                return NotModifiedResponse(now.isoformat(), None if valid_until is None else valid_until.isoformat())
+            timeline = timeline.cache(max_posts, snapshot.time_to_live, snapshot.revision, snapshot.digest)
+            timeline.total_posts += snapshot.archived_posts
+        elif timeline.is_valid():
+            if condition is not None and (timeline.is_current(*condition) or timeline.is_older(condition[0])):
+                return NotModifiedResponse(
+                    timeline.last_updated.isoformat(),
+                    None if timeline.valid_until is None else timeline.valid_until.isoformat(),
+                )
+            timeline = timeline.cache(max_posts)
+        else:
+            return ErrorResponse(f"Not locally available.")
+
+        data = timeline.to_serializable()
+        if known_posts:
+            data = Timeline.strip_known_posts(data, known_posts)
+        return OkResponse({"timeline": data})
+
+    def read_post_body(self, userid, post_id):
+        """Same as Node.own_post_body and Node.cached_post_body, but with the own posts of the snapshot."""
+        if self.storage is None:
+            self.storage = STORAGE_ENGINES[self.storage_engine](self.userid)
+        if userid != self.userid:
+            if not self.storage.exists(PostBody.get_file(userid, post_id)):
+                return None
+            return PostBody.read(self.storage, userid, post_id)
+
+        post = Timeline.from_serializable(dict(self.current_snapshot().timelines[str(userid)])).get_post_by_id(post_id)
+        if post is None:
+            post = Archive.read(self.storage).find_post(self.storage, post_id)
+        if post is None:
+            return None
+        if not PostBody.is_truncated(post):
+            return post["content"]
+        return PostBody.read(self.storage, userid, post_id)
+
+    async def handle_public_get_post(self, userid, post_id):
+        try:
+            content = self.read_post_body(userid, post_id)
+        except Exception as e:
+            log.error("Could not read body of post %s of %s: %s", post_id, userid, e)
+            content = None
+
+        if content is None:
+            return ErrorResponse(f"Not locally available.")
+        return StreamResponse(PostBody.stream(content))
+
+    async def watch_parent(self, parent):
+        # Workers must not keep the port once the node is gone
+        while os.getppid() == parent:
+            await asyncio.sleep(PublicWorker.PARENT_CHECK_INTERVAL_S)
+        log.debug("Node exited, stopping worker %s", os.getpid())
+
+    async def run(self, parent):
+        server = asyncio.create_task(self.public_connection.start(self.userid, reuse_port=True))
+        await self.watch_parent(parent)
+        server.cancel()
+
+
+def serve(userid, snapshot_file, storage_engine, admission, parent, log_level):
+    """Entry point of a worker process."""
+    log.setLevel(log_level)
+    try:
+        asyncio.run(PublicWorker(userid, snapshot_file, storage_engine, admission).run(parent))
+    except KeyboardInterrupt:
+        pass